@@ -8,8 +8,8 @@ import webbrowser
 import http.server
 import socketserver
 import urllib.parse
-from user_profile import UserProfile, MusicPreference, UserProfileManager
-from auth import AuthManager
+from user_profile import UserProfile, MusicPreference
+from services import get_services
 from auth_window import AuthWindow
 from profile_setup import ProfileSetupWindow
 from search_dropdown import SpotifySearchDropdown
@@ -24,9 +24,13 @@ from config import (
     SCOPE,
     DISCORD_CLIENT_ID
 )
+import config
 import tkinter.messagebox as messagebox
 from tkinter import filedialog
 
+# Seconds profile saves are held back to coalesce repeated edits into one write
+PROFILE_WRITE_DELAY = 0.5
+
 # --- THEME SETUP ---
 def create_vertical_gradient(width, height, color1, color2):
     from PIL import Image, ImageTk
@@ -501,8 +505,12 @@ class SpotifyApp:
         self.session_token = None
         self.preloaded_top_items = None  # Cache for preloaded data
         
-        # Initialize auth manager
-        self.auth_manager = AuthManager()
+        # Managers shared by every window of the process (saves are written behind, off the UI thread)
+        # Password hashing cost tuned for this machine, see benchmarks/password_hashing.py
+        self.services = get_services(profile_write_delay=PROFILE_WRITE_DELAY,
+                                     password_hashing=getattr(config, 'PASSWORD_HASHING', None))
+        self.auth_manager = self.services.auth_manager
+        self.profile_manager = None
         
         # Show login/signup window first
         auth_window = AuthWindow(root)
@@ -535,8 +543,8 @@ class SpotifyApp:
             'long_term': 'All Time'
         }
         
-        # Initialize profile manager
-        self.profile_manager = UserProfileManager()
+        # Shared profile manager, kept across logins
+        self.profile_manager = self.services.profile_manager
         
         # Check if profile setup is needed
         self.check_profile_setup()
@@ -952,12 +960,7 @@ class SpotifyApp:
         )
         
         # Update or add preference
-        for i, pref in enumerate(profile.music_preferences):
-            if pref.track_id == track_preference.track_id:
-                profile.music_preferences[i] = track_preference
-                break
-        else:
-            profile.music_preferences.append(track_preference)
+        profile.upsert_preference(track_preference)
         
         # Update top items with current time range
         profile.top_artists = get_user_top_items(
@@ -993,7 +996,7 @@ class SpotifyApp:
         if not self.current_user_id:
             return
             
-        matches = self.profile_manager.find_matches(self.current_user_id)
+        matches = self.profile_manager.get_matches(self.current_user_id)
         self.matches_list.delete(0, tk.END)
         
         for profile, score in matches:
@@ -1149,6 +1152,9 @@ class SpotifyApp:
         except:
             pass  # Ignore errors if Discord RPC is not connected
         
+        # Write pending profile saves before switching user
+        self.flush_profile_manager()
+        
         # Delete current session
         if self.session_token:
             self.auth_manager.delete_session(self.session_token)
@@ -1200,6 +1206,9 @@ class SpotifyApp:
         except:
             pass  # Ignore errors if Discord RPC is not connected
         
+        # Write pending profile saves before switching user
+        self.flush_profile_manager()
+        
         # Delete all sessions for current user
         if self.session_token:
             self.auth_manager.delete_session(self.session_token)
@@ -1233,6 +1242,16 @@ class SpotifyApp:
         self.session_token = new_session_token
         self.initialize_app_after_login()
 
+    def flush_profile_manager(self):
+        """Write any pending profile saves, e.g. before switching user"""
+        if self.profile_manager is not None:
+            self.profile_manager.flush()
+
+    def close_profile_manager(self):
+        """Write any pending profile saves and release the shared managers (on exit)"""
+        self.services.close()
+        self.profile_manager = None
+
     def reset_app_state(self):
         """Reset all application state variables"""
         # Reset Spotify-related variables
@@ -1249,7 +1268,7 @@ class SpotifyApp:
         }
         
         # Reset profile manager
-        self.profile_manager = UserProfileManager()
+        self.profile_manager = self.services.profile_manager
         
         # Reset thread state
         self.is_running = True
@@ -1346,12 +1365,6 @@ class SpotifyApp:
         artist_counts = {}
         album_counts = {}
         genre_counts = {}
-        # Helper: get or create MusicPreference
-        def get_pref(track_id, name, artists, album):
-            for p in profile.music_preferences:
-                if p.track_id == track_id:
-                    return p
-            return MusicPreference(track_id=track_id, name=name, artists=artists, album=album, rating=0.5)
         for event in all_history:
             # Try to extract fields from various Spotify formats
             track_name = event.get('trackName') or event.get('track_name') or event.get('songName') or event.get('name')
@@ -1370,9 +1383,10 @@ class SpotifyApp:
             for genre in genres:
                 genre_counts[genre] = genre_counts.get(genre, 0) + 1
             # Add to music_preferences if not present
-            pref = get_pref(track_id, track_name, [artist_name], album_name or "")
-            if pref not in profile.music_preferences:
-                profile.music_preferences.append(pref)
+            if profile.get_preference(track_id) is None:
+                profile.upsert_preference(MusicPreference(
+                    track_id=track_id, name=track_name, artists=[artist_name], album=album_name or "", rating=0.5
+                ))
         # Update top lists
         profile.top_artists = [a for a, _ in sorted(artist_counts.items(), key=lambda x: x[1], reverse=True)[:10]]
         profile.top_songs = [{
@@ -1399,4 +1413,5 @@ class SpotifyApp:
 if __name__ == "__main__":
     root = tk.Tk()
     app = SpotifyApp(root)
-    root.mainloop() 
\ No newline at end of file
+    root.mainloop()
+    app.close_profile_manager() 
\ No newline at end of file
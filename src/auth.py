@@ -1,134 +1,131 @@
-import json
 import os
-import hashlib
 import secrets
-import time
-from typing import Optional, Tuple
+from typing import Dict, NamedTuple, Optional
+from auth_store import open_auth_stores
+from password_hashing import PasswordHasher
+from session_store import SessionStore
 from user_profile import UserProfile, UserProfileManager
 
+class PasswordCheck(NamedTuple):
+    """Outcome of AuthManager.check_password, applied by complete_login"""
+    user_id: Optional[str]
+    stored_hash: Optional[str] = None
+    # Set when the stored hash uses an outdated scheme or cost
+    new_hash: Optional[str] = None
+
 class AuthManager:
-    def __init__(self, auth_file: str = 'data/auth.json', session_file: str = 'data/session.json'):
+    def __init__(self, auth_file: str = 'data/auth.json', session_file: str = 'data/session.json',
+                 storage_backend: str = 'journal', profile_manager: Optional[UserProfileManager] = None,
+                 password_hasher: Optional[PasswordHasher] = None):
+        """
+        `storage_backend` is 'journal' (append-only files next to auth_file),
+        'sqlite' or 'json' (auth_file and session_file themselves), see
+        auth_store; auth_file and session_file are imported into a new store.
+        Profiles are created and deleted through `profile_manager`, by default
+        a new UserProfileManager. Passwords are hashed with `password_hasher`
+        (default: scrypt with the default cost, see password_hashing).
+        """
         self.auth_file = auth_file
         self.session_file = session_file
-        self.profile_manager = UserProfileManager()
+        self.profile_manager = profile_manager if profile_manager is not None else UserProfileManager()
+        self.password_hasher = password_hasher if password_hasher is not None else PasswordHasher()
         os.makedirs(os.path.dirname(auth_file), exist_ok=True)
+        # Only changed accounts and sessions are written
+        self.accounts, session_records = open_auth_stores(storage_backend, auth_file, session_file)
         self._load_auth_data()
-        self._load_session_data()
+        # Expired sessions are swept in the background, see session_store
+        self.sessions = SessionStore(session_records)
 
     def _load_auth_data(self):
-        """Load authentication data from file"""
-        if os.path.exists(self.auth_file):
-            with open(self.auth_file, 'r') as f:
-                self.auth_data = json.load(f)
-        else:
-            self.auth_data = {}
-            self._save_auth_data()
-
-    def _save_auth_data(self):
-        """Save authentication data to file"""
-        with open(self.auth_file, 'w') as f:
-            json.dump(self.auth_data, f, indent=2)
-
-    def _load_session_data(self):
-        """Load session data from file"""
-        if os.path.exists(self.session_file):
-            with open(self.session_file, 'r') as f:
-                self.session_data = json.load(f)
-        else:
-            self.session_data = {}
-            self._save_session_data()
-
-    def _save_session_data(self):
-        """Save session data to file"""
-        with open(self.session_file, 'w') as f:
-            json.dump(self.session_data, f, indent=2)
-
-    def _hash_password(self, password: str, salt: Optional[str] = None) -> Tuple[str, str]:
-        """Hash password with salt"""
-        if salt is None:
-            salt = secrets.token_hex(16)
-        hashed = hashlib.sha256((password + salt).encode()).hexdigest()
-        return hashed, salt
+        """Load authentication data from the store"""
+        self.auth_data = self.accounts.load()
+        # username/email -> user_id, so login and signup never scan every account
+        self.user_ids_by_username: Dict[str, str] = {}
+        self.user_ids_by_email: Dict[str, str] = {}
+        for user_id, data in self.auth_data.items():
+            self._index_user(user_id, data)
+
+    def refresh(self) -> bool:
+        """Pick up accounts and sessions changed since they were loaded, e.g. by another process"""
+        accounts_changed = self.accounts.refresh()
+        if accounts_changed:
+            self._load_auth_data()
+        return self.sessions.refresh() or accounts_changed
+
+    def close(self):
+        """Stop the session sweeper and close the stores"""
+        self.sessions.close()
+        self.accounts.close()
+        self.sessions.records.close()
+
+    def _index_user(self, user_id: str, data: dict):
+        # The first account with a name keeps it, as with the former linear scans
+        self.user_ids_by_username.setdefault(data['username'], user_id)
+        if data.get('email') is not None:
+            self.user_ids_by_email.setdefault(data['email'], user_id)
+
+    def _unindex_user(self, user_id: str, data: dict):
+        if self.user_ids_by_username.get(data['username']) == user_id:
+            del self.user_ids_by_username[data['username']]
+        if data.get('email') is not None and self.user_ids_by_email.get(data['email']) == user_id:
+            del self.user_ids_by_email[data['email']]
+
+    def hash_password(self, password: str) -> str:
+        """Hash a new password (slow on purpose; safe to call from a worker thread)"""
+        return self.password_hasher.hash(password)
 
     def create_session(self, user_id: str, remember_me: bool = False) -> str:
         """Create a new session for a user"""
         session_token = secrets.token_hex(32)
-        current_time = time.time()
-        
         # Session expires in 30 days if remember me is checked, otherwise 24 hours
-        expiry_time = current_time + (30 * 24 * 3600 if remember_me else 24 * 3600)
-        
-        self.session_data[session_token] = {
-            'user_id': user_id,
-            'created_at': current_time,
-            'expires_at': expiry_time,
-            'remember_me': remember_me
-        }
-        
-        self._save_session_data()
+        self.sessions.create(session_token, user_id, remember_me)
         return session_token
 
     def validate_session(self, session_token: str) -> Optional[str]:
-        """Validate a session token and return user_id if valid"""
-        if session_token not in self.session_data:
-            return None
-            
-        session = self.session_data[session_token]
-        current_time = time.time()
-        
-        # Check if session has expired
-        if current_time > session['expires_at']:
-            del self.session_data[session_token]
-            self._save_session_data()
-            return None
-            
-        # Extend session if remember me is enabled
-        if session['remember_me']:
-            session['expires_at'] = current_time + (30 * 24 * 3600)  # Extend by 30 days
-            self._save_session_data()
-            
-        return session['user_id']
+        """Validate a session token and return user_id if valid (remember-me sessions are extended)"""
+        return self.sessions.validate(session_token)
 
     def delete_session(self, session_token: str):
         """Delete a session"""
-        if session_token in self.session_data:
-            del self.session_data[session_token]
-            self._save_session_data()
+        self.sessions.delete(session_token)
 
     def get_remembered_user(self) -> Optional[dict]:
         """Get the remembered user's data if available"""
-        for session_token, session in self.session_data.items():
-            if session['remember_me'] and time.time() <= session['expires_at']:
-                user_id = session['user_id']
-                user_data = self.get_user_data(user_id)
-                if user_data:
-                    return {
-                        'user_id': user_id,
-                        'username': user_data['username'],
-                        'session_token': session_token
-                    }
+        for session_token, session in self.sessions.remembered():
+            user_id = session['user_id']
+            user_data = self.get_user_data(user_id)
+            if user_data:
+                return {
+                    'user_id': user_id,
+                    'username': user_data['username'],
+                    'session_token': session_token
+                }
         return None
 
-    def register_user(self, username: str, password: str, email: str) -> Optional[str]:
-        """Register a new user"""
+    def register_user(self, username: str, password: str, email: str,
+                      password_hash: Optional[str] = None) -> Optional[str]:
+        """
+        Register a new user. `password_hash` is hash_password(password) when it
+        was already computed, e.g. off the UI thread.
+        """
         # Check if username or email already exists
-        for user_id, data in self.auth_data.items():
-            if data['username'] == username or data['email'] == email:
-                return None
+        if username in self.user_ids_by_username or email in self.user_ids_by_email:
+            return None
 
         # Generate user ID
         user_id = secrets.token_hex(8)
         
         # Hash password
-        hashed_password, salt = self._hash_password(password)
+        if password_hash is None:
+            password_hash = self.hash_password(password)
         
         # Store user data
         self.auth_data[user_id] = {
             'username': username,
-            'password': hashed_password,
-            'salt': salt,
+            'password': password_hash,
             'email': email
         }
+        self._index_user(user_id, self.auth_data[user_id])
         
         # Create initial profile
         profile = UserProfile(
@@ -142,17 +139,44 @@ class AuthManager:
         )
         self.profile_manager.save_profile(profile)
         
-        self._save_auth_data()
+        self.accounts.put(user_id, self.auth_data[user_id])
         return user_id
 
     def authenticate_user(self, username: str, password: str) -> Optional[str]:
         """Authenticate a user and return their user_id if successful"""
-        for user_id, data in self.auth_data.items():
-            if data['username'] == username:
-                hashed_password, _ = self._hash_password(password, data['salt'])
-                if hashed_password == data['password']:
-                    return user_id
-        return None
+        return self.complete_login(self.check_password(username, password))
+
+    def check_password(self, username: str, password: str) -> PasswordCheck:
+        """
+        The slow half of authenticate_user: verify the password and, if the
+        stored hash is outdated, compute its replacement. Modifies nothing, so
+        it can run in a worker thread; pass the result to complete_login.
+        """
+        user_id = self.user_ids_by_username.get(username)
+        if user_id is None:
+            # Take as long as for a real account, so logins do not reveal which usernames exist
+            self.password_hasher.hash(password)
+            return PasswordCheck(None)
+        data = self.auth_data[user_id]
+        stored_hash = data['password']
+        if not self.password_hasher.verify(password, stored_hash, data.get('salt')):
+            return PasswordCheck(None)
+        new_hash = None
+        if self.password_hasher.needs_rehash(stored_hash):
+            new_hash = self.password_hasher.hash(password)
+        return PasswordCheck(user_id, stored_hash, new_hash)
+
+    def complete_login(self, check: PasswordCheck) -> Optional[str]:
+        """Store the upgraded hash of a successful check_password, returns the user_id (or None)"""
+        data = self.auth_data.get(check.user_id) if check.user_id is not None else None
+        if data is None:
+            return None
+        # Unless the password was changed in the meantime
+        if check.new_hash is not None and data['password'] == check.stored_hash:
+            data['password'] = check.new_hash
+            data.pop('salt', None)
+            self.accounts.put(check.user_id, data)
+        return check.user_id
 
     def get_user_data(self, user_id: str) -> Optional[dict]:
         """Get user data by user_id"""
@@ -161,23 +185,17 @@ class AuthManager:
     def update_user_data(self, user_id: str, data: dict):
         """Update user data"""
         if user_id in self.auth_data:
+            self._unindex_user(user_id, self.auth_data[user_id])
             self.auth_data[user_id].update(data)
-            self._save_auth_data()
+            self._index_user(user_id, self.auth_data[user_id])
+            self.accounts.put(user_id, self.auth_data[user_id])
 
     def delete_user(self, user_id: str):
         """Delete a user and their profile"""
         if user_id in self.auth_data:
-            del self.auth_data[user_id]
-            self._save_auth_data()
+            self._unindex_user(user_id, self.auth_data.pop(user_id))
+            self.accounts.delete(user_id)
             # Delete profile file
-            profile_file = os.path.join(self.profile_manager.storage_dir, f"{user_id}.json")
-            if os.path.exists(profile_file):
-                os.remove(profile_file)
+            self.profile_manager.delete_profile(user_id)
             # Delete all sessions for this user
-            session_tokens_to_delete = []
-            for session_token, session in self.session_data.items():
-                if session['user_id'] == user_id:
-                    session_tokens_to_delete.append(session_token)
-            for token in session_tokens_to_delete:
-                del self.session_data[token]
-            self._save_session_data() 
\ No newline at end of file
+            self.sessions.delete_user(user_id)
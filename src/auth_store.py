@@ -0,0 +1,293 @@
+"""
+Persistence of AuthManager's accounts and sessions, one record per key.
+
+AuthManager keeps accounts ({user_id: account}) and sessions ({token:
+session}) in memory and tells a record store about every changed or
+deleted record, so a login, signup or logout writes that record only:
+
+    'journal'  append-only JSON lines (auth.jsonl, session.jsonl), fsynced
+               on every change and compacted with an atomic rename
+    'sqlite'   auth.db with an `accounts` and a `sessions` table
+    'json'     the former whole-file auth.json/session.json, rewritten on
+               every change
+
+The first time a journal or SQLite store is opened, the existing JSON file
+(auth_file/session_file) is imported into it and, once the import is
+committed, renamed to *.imported, so no stale copy of the records (with
+password hashes that logins since upgraded) stays live next to the store;
+delete it once the migration is trusted. `python auth_store.py --backend
+...` exports the records back to the JSON files, e.g. to return to the
+'json' backend. `refresh()` tells whether another process (or another store on the
+same files) changed the records since they were last read, cheaply enough
+to call before every use.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+from journal import RecordJournal
+
+
+def _read_json(path: Optional[str]) -> Dict[str, dict]:
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _retire_import(path: Optional[str]):
+    """Move an imported JSON file aside once its records are committed to the new store"""
+    if path is not None and os.path.exists(path):
+        os.replace(path, path + '.imported')
+
+
+class JsonRecordStore:
+    """All records in one JSON file, rewritten on every change"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._records = _read_json(path)
+        if not os.path.exists(path):
+            self._save()
+        self._signature = self._stat()
+
+    def _stat(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _save(self):
+        with open(self.path, 'w') as f:
+            json.dump(self._records, f, indent=2)
+        self._signature = self._stat()
+
+    def refresh(self) -> bool:
+        """Re-read the file if someone else rewrote it; True if it changed"""
+        signature = self._stat()
+        if signature == self._signature:
+            return False
+        self._records = _read_json(self.path)
+        self._signature = signature
+        return True
+
+    def load(self) -> Dict[str, dict]:
+        return dict(self._records)
+
+    def put_many(self, records: Dict[str, dict]):
+        if records:
+            self._records.update(records)
+            self._save()
+
+    def delete_many(self, keys: Iterable[str]):
+        keys = [key for key in keys if key in self._records]
+        for key in keys:
+            del self._records[key]
+        if keys:
+            self._save()
+
+    def put(self, key: str, value: dict):
+        self.put_many({key: value})
+
+    def delete(self, key: str):
+        self.delete_many([key])
+
+    def close(self):
+        pass
+
+
+class JournalRecordStore(JsonRecordStore):
+    """Records in a RecordJournal: {"key": ..., "value": ...} or {"key": ..., "deleted": true}"""
+
+    def __init__(self, path: str, import_file: Optional[str] = None):
+        self.path = path
+        self.journal = RecordJournal(path)
+        self._records: Dict[str, dict] = {}
+        # Outside changes picked up while appending, not reported by refresh() yet
+        self._changed = False
+        if not self.journal.exists():
+            self._records = _read_json(import_file)
+            self.journal.write_all(self._entries(), durable=True)
+            _retire_import(import_file)
+        self._read()
+
+    def refresh(self) -> bool:
+        """Apply records appended by others since the last refresh; True if there were any"""
+        changed = self._read() or self._changed
+        self._changed = False
+        return changed
+
+    def _read(self) -> bool:
+        restarted, records = self.journal.read()
+        if restarted:
+            self._records = {}
+        for record in records:
+            if record.get('deleted'):
+                self._records.pop(record['key'], None)
+            else:
+                self._records[record['key']] = record['value']
+        return restarted or bool(records)
+
+    def _append(self, records: list):
+        # Never compact over records another process appended meanwhile
+        if self._read():
+            self._changed = True
+        self.journal.append(records, durable=True)
+        if self.journal.needs_compaction(len(self._records)):
+            self.journal.write_all(self._entries(), durable=True)
+
+    def _entries(self) -> Iterable[dict]:
+        return ({'key': key, 'value': value} for key, value in self._records.items())
+
+    def put_many(self, records: Dict[str, dict]):
+        if records:
+            self._records.update(records)
+            self._append([{'key': key, 'value': value} for key, value in records.items()])
+
+    def delete_many(self, keys: Iterable[str]):
+        keys = [key for key in keys if key in self._records]
+        for key in keys:
+            del self._records[key]
+        if keys:
+            self._append([{'key': key, 'deleted': True} for key in keys])
+
+
+def connect(database_file: str) -> sqlite3.Connection:
+    dirname = os.path.dirname(database_file)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    connection = sqlite3.connect(database_file, timeout=30, check_same_thread=False, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=FULL")
+    return connection
+
+
+class SqliteRecordStore:
+    """Records as JSON documents in a (key, value) table of an SQLite database"""
+
+    def __init__(self, database_file: str, table: str, import_file: Optional[str] = None,
+                 connection: Optional[sqlite3.Connection] = None, lock=None):
+        """Stores of several tables of a database may share one `connection` and its `lock`"""
+        self.database_file = database_file
+        self.table = table
+        self._lock = lock if lock is not None else threading.RLock()
+        self.connection = connection if connection is not None else connect(database_file)
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                exists = self.connection.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+                ).fetchone()
+                if not exists:
+                    self.connection.execute(
+                        f"CREATE TABLE {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID"
+                    )
+                    self._insert(_read_json(import_file))
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            if not exists:
+                _retire_import(import_file)
+            self._data_version = self._current_data_version()
+
+    def _current_data_version(self) -> int:
+        # Changes whenever another connection commits to the database
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def refresh(self) -> bool:
+        """True if another connection changed the database since the last check"""
+        with self._lock:
+            version = self._current_data_version()
+            changed, self._data_version = version != self._data_version, version
+        return changed
+
+    def _insert(self, records: Dict[str, dict]):
+        self.connection.executemany(
+            f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)",
+            ((key, json.dumps(value)) for key, value in records.items())
+        )
+
+    def load(self) -> Dict[str, dict]:
+        with self._lock:
+            rows = self.connection.execute(f"SELECT key, value FROM {self.table}").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def put_many(self, records: Dict[str, dict]):
+        if records:
+            with self._lock:
+                self.connection.execute("BEGIN IMMEDIATE")
+                try:
+                    self._insert(records)
+                    self.connection.execute("COMMIT")
+                except BaseException:
+                    self.connection.execute("ROLLBACK")
+                    raise
+
+    def delete_many(self, keys: Iterable[str]):
+        keys = [(key,) for key in keys]
+        if keys:
+            with self._lock:
+                self.connection.execute("BEGIN IMMEDIATE")
+                try:
+                    self.connection.executemany(f"DELETE FROM {self.table} WHERE key = ?", keys)
+                    self.connection.execute("COMMIT")
+                except BaseException:
+                    self.connection.execute("ROLLBACK")
+                    raise
+
+    def put(self, key: str, value: dict):
+        self.put_many({key: value})
+
+    def delete(self, key: str):
+        self.delete_many([key])
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+def open_auth_stores(backend: str, auth_file: str, session_file: str) -> Tuple[object, object]:
+    """
+    (accounts, sessions) record stores for a backend name: 'journal'
+    (default), 'sqlite' or 'json'. The new stores sit next to auth_file.
+    """
+    if backend == 'json':
+        return JsonRecordStore(auth_file), JsonRecordStore(session_file)
+    if backend == 'journal':
+        return (JournalRecordStore(os.path.splitext(auth_file)[0] + '.jsonl', import_file=auth_file),
+                JournalRecordStore(os.path.splitext(session_file)[0] + '.jsonl', import_file=session_file))
+    if backend == 'sqlite':
+        database_file = os.path.splitext(auth_file)[0] + '.db'
+        # One connection, so writing sessions does not look like an outside change to accounts
+        connection, lock = connect(database_file), threading.RLock()
+        return (SqliteRecordStore(database_file, 'accounts', auth_file, connection, lock),
+                SqliteRecordStore(database_file, 'sessions', session_file, connection, lock))
+    raise ValueError(f"Unknown auth storage backend '{backend}'")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export accounts and sessions back to auth.json/session.json "
+                                                 "(the way back to the 'json' backend after an import)")
+    parser.add_argument('--backend', default='journal', choices=('journal', 'sqlite'))
+    parser.add_argument('--auth-file', default='data/auth.json')
+    parser.add_argument('--session-file', default='data/session.json')
+    args = parser.parse_args()
+
+    accounts, sessions = open_auth_stores(args.backend, args.auth_file, args.session_file)
+    for store, path in ((accounts, args.auth_file), (sessions, args.session_file)):
+        records = store.load()
+        with open(path + '.tmp', 'w') as f:
+            json.dump(records, f, indent=2)
+        os.replace(path + '.tmp', path)
+        print(f"Exported {len(records)} records to {path}")
+    # After both exports: the SQLite stores share one connection
+    accounts.close()
+    sessions.close()
+
+
+if __name__ == "__main__":
+    main()
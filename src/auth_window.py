@@ -1,12 +1,17 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
-from auth import AuthManager
+from concurrent.futures import ThreadPoolExecutor
+from services import get_services
 import re
 
+# Password hashing is slow on purpose; it runs here instead of blocking the Tk main loop
+_hashing_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='password-hashing')
+
 class AuthWindow:
     def __init__(self, parent):
         self.parent = parent
-        self.auth_manager = AuthManager()
+        # Shared with the app, see services
+        self.auth_manager = get_services().auth_manager
         self.user_id = None
         self.session_token = None
         
@@ -73,7 +78,8 @@ class AuthWindow:
         ttk.Checkbutton(remember_frame, text="Remember me", variable=self.remember_me_var).pack(side=tk.LEFT)
         
         # Login button
-        ttk.Button(login_frame, text="Login", command=self.login).pack(pady=10)
+        self.login_button = ttk.Button(login_frame, text="Login", command=self.login)
+        self.login_button.pack(pady=10)
         
     def setup_signup_tab(self):
         # Signup form
@@ -109,8 +115,37 @@ class AuthWindow:
         ttk.Checkbutton(signup_remember_frame, text="Remember me", variable=self.signup_remember_me_var).pack(side=tk.LEFT)
         
         # Signup button
-        ttk.Button(signup_frame, text="Sign Up", command=self.signup).pack(pady=10)
+        self.signup_button = ttk.Button(signup_frame, text="Sign Up", command=self.signup)
+        self.signup_button.pack(pady=10)
         
+    def _run_in_background(self, function, callback, *args):
+        """Run function(*args) on the hashing thread, then callback(result) on the Tk main loop"""
+        future = _hashing_executor.submit(function, *args)
+        self._set_busy(True)
+
+        def poll():
+            if not self.window.winfo_exists():
+                return  # Window closed meanwhile
+            if not future.done():
+                self.window.after(20, poll)
+                return
+            self._set_busy(False)
+            try:
+                result = future.result()
+            except Exception as e:
+                # e.g. a malformed stored hash; the form is usable again
+                messagebox.showerror("Error", f"Password check failed: {e}")
+                return
+            callback(result)
+
+        self.window.after(20, poll)
+
+    def _set_busy(self, busy):
+        state = ['disabled'] if busy else ['!disabled']
+        self.login_button.state(state)
+        self.signup_button.state(state)
+        self.window.config(cursor='watch' if busy else '')
+
     def validate_email(self, email):
         """Validate email format"""
         pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
@@ -125,7 +160,11 @@ class AuthWindow:
             messagebox.showerror("Error", "Please fill in all fields")
             return
             
-        user_id = self.auth_manager.authenticate_user(username, password)
+        self._run_in_background(self.auth_manager.check_password,
+                                lambda check: self._finish_login(check, remember_me), username, password)
+
+    def _finish_login(self, check, remember_me):
+        user_id = self.auth_manager.complete_login(check)
         if user_id:
             # Create session
             session_token = self.auth_manager.create_session(user_id, remember_me)
@@ -159,8 +198,20 @@ class AuthWindow:
             messagebox.showerror("Error", "Password must be at least 8 characters long")
             return
             
+        if (username in self.auth_manager.user_ids_by_username
+                or email in self.auth_manager.user_ids_by_email):
+            messagebox.showerror("Error", "Username or email already exists")
+            return
+            
+        self._run_in_background(
+            self.auth_manager.hash_password,
+            lambda password_hash: self._finish_signup(username, password, email, password_hash, remember_me),
+            password
+        )
+
+    def _finish_signup(self, username, password, email, password_hash, remember_me):
         # Register user
-        user_id = self.auth_manager.register_user(username, password, email)
+        user_id = self.auth_manager.register_user(username, password, email, password_hash)
         if user_id:
             # Create session
             session_token = self.auth_manager.create_session(user_id, remember_me)
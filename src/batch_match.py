@@ -0,0 +1,259 @@
+"""
+Parallel full-population match scoring.
+
+The parent process encodes every profile once and writes the encoded
+matrices as plain .npy files; worker processes open them with
+mmap_mode='r', so all workers share the same pages through the OS page
+cache instead of receiving pickled copies. Each worker scores a shard of
+users against the whole population with the manager's ScoringPipeline
+and returns only their top-K rows, which the parent writes as one
+consolidated match table. Column-major postings give the upper bound of
+every user sharing an item with the querying user, as the inverted index
+does; only those that can reach the threshold are copied out of the shared
+matrices and scored, as MatchEngine.score would score them.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+from typing import Dict, List, Optional, Tuple
+from match_engine import EncodedProfiles
+from scoring import DEFAULT_SCORER, ScoringPipeline
+
+# Arrays written by write_shared_matrices, per field: row-major (CSR) for the
+# querying user and column-major postings (users per item) for the candidates
+ARRAY_NAMES = (
+    'artist_indptr', 'artist_indices', 'artist_data', 'artist_csc_indptr', 'artist_csc_users', 'artist_csc_data',
+    'genre_indptr', 'genre_indices', 'genre_data', 'genre_csc_indptr', 'genre_csc_users', 'genre_csc_data',
+    'track_indptr', 'track_indices', 'track_data', 'track_csc_indptr', 'track_csc_users', 'track_csc_data',
+    'artist_counts', 'genre_counts', 'track_counts', 'n_cols'
+)
+FIELDS = ('artist', 'genre', 'track')
+
+
+def _transpose(indptr: np.ndarray, indices: np.ndarray, data: np.ndarray, n_cols: int):
+    """CSR -> CSC arrays, keeping duplicate entries"""
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    order = np.argsort(indices, kind='stable')
+    csc_indptr = np.zeros(n_cols + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=n_cols), out=csc_indptr[1:])
+    return csc_indptr, rows[order], data[order]
+
+
+def write_shared_matrices(encoded: EncodedProfiles, directory: str):
+    """Write an encoded population as .npy files that workers can memory-map"""
+    arrays = {}
+    for field, matrix in (('artist', encoded.artists), ('genre', encoded.genres)):
+        # Index dtypes as chosen by scipy, so workers can wrap the maps without a copy
+        arrays[f'{field}_indptr'] = matrix.indptr
+        arrays[f'{field}_indices'] = matrix.indices
+        arrays[f'{field}_data'] = matrix.data
+    arrays['track_indptr'] = encoded.track_indptr
+    arrays['track_indices'] = encoded.track_cols
+    arrays['track_data'] = encoded.track_ratings
+    n_track_cols = int(encoded.track_cols.max()) + 1 if len(encoded.track_cols) else 0
+    arrays['n_cols'] = np.array([encoded.artists.shape[1], encoded.genres.shape[1], n_track_cols], dtype=np.int64)
+    for field, n_cols in zip(FIELDS, arrays['n_cols'].tolist()):
+        csc = _transpose(arrays[f'{field}_indptr'], arrays[f'{field}_indices'], arrays[f'{field}_data'], n_cols)
+        arrays[f'{field}_csc_indptr'], arrays[f'{field}_csc_users'], arrays[f'{field}_csc_data'] = csc
+    arrays['artist_counts'] = encoded.artist_counts
+    arrays['genre_counts'] = encoded.genre_counts
+    arrays['track_counts'] = encoded.track_counts
+    for name in ARRAY_NAMES:
+        np.save(os.path.join(directory, f'{name}.npy'), arrays[name])
+    with open(os.path.join(directory, 'user_ids.json'), 'w') as f:
+        json.dump(encoded.user_ids, f)
+
+
+def open_shared_matrices(directory: str) -> Dict[str, np.ndarray]:
+    """
+    Memory-map the arrays written by write_shared_matrices (read-only, zero
+    copy), plus the 'artists' and 'genres' count matrices over the maps
+    """
+    m = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r') for name in ARRAY_NAMES}
+    n_users = len(m['artist_counts'])
+    for field, n_cols in zip(FIELDS[:2], m['n_cols'].tolist()):
+        m[f'{field}s'] = sparse.csr_matrix((m[f'{field}_data'], m[f'{field}_indices'], m[f'{field}_indptr']),
+                                           shape=(n_users, n_cols))
+    return m
+
+
+def _gather(indptr: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Positions of every entry of the given rows of a CSR-style indptr, and which row each came from"""
+    starts = np.asarray(indptr[rows])
+    lengths = np.asarray(indptr[rows + 1]) - starts
+    owner = np.repeat(np.arange(len(rows)), lengths)
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return offsets + np.arange(int(lengths.sum())), owner
+
+
+def encoded_row(m: Dict[str, np.ndarray], row: int) -> tuple:
+    """User `row` as the (artist cols, genre cols, track cols, ratings) tuple of MatchEngine.encode_row"""
+    fields = []
+    for field in FIELDS[:2]:
+        start, stop = m[f'{field}_indptr'][row], m[f'{field}_indptr'][row + 1]
+        # The count matrices hold repeated names as counts; repeat them back
+        fields.append(np.repeat(np.asarray(m[f'{field}_indices'][start:stop], dtype=np.int64),
+                                np.asarray(m[f'{field}_data'][start:stop]).astype(np.int64)))
+    start, stop = m['track_indptr'][row], m['track_indptr'][row + 1]
+    fields.append(np.asarray(m['track_indices'][start:stop], dtype=np.int64))
+    fields.append(np.asarray(m['track_data'][start:stop], dtype=np.float64))
+    return tuple(fields)
+
+
+def _field_bounds(bound, pairs: np.ndarray, own_size: int, other_sizes: np.ndarray) -> np.ndarray:
+    """A Scorer.bound for every candidate, calling it once per distinct (pairs, other size)"""
+    stride = int(other_sizes.max()) + 1 if len(other_sizes) else 1
+    keys, inverse = np.unique(pairs * stride + other_sizes, return_inverse=True)
+    values = np.array([bound(key // stride, own_size, key % stride) for key in keys.tolist()], dtype=np.float64)
+    return values[inverse]
+
+
+def candidate_bounds(m: Dict[str, np.ndarray], row: tuple,
+                     scorer: ScoringPipeline) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Rows sharing at least one item with an encoded row in a field the scorer
+    weighs, with the highest score each can reach (ScoringPipeline.upper_bound
+    of their matching pairs, as InvertedIndex.overlaps counts them)
+    """
+    found = []
+    for field_name, scorer_field, weight in scorer.stages:
+        field = field_name[:-1]
+        cols = row[FIELDS.index(field)]
+        items, own_counts = np.unique(cols, return_counts=True)
+        positions, owner = _gather(m[f'{field}_csc_indptr'], items)
+        users = np.asarray(m[f'{field}_csc_users'][positions])
+        # Tracks are listed once per entry; artist and genre postings carry the multiplicity
+        other_counts = 1 if field == 'track' else np.asarray(m[f'{field}_csc_data'][positions])
+        users, inverse = np.unique(users, return_inverse=True)
+        pairs = np.bincount(inverse, weights=own_counts[owner] * other_counts, minlength=len(users))
+        other_sizes = np.asarray(m[f'{field}_counts'][users])
+        found.append((users, weight * _field_bounds(scorer_field.bound, pairs.astype(np.int64), len(cols),
+                                                    other_sizes)))
+    candidates = np.unique(np.concatenate([users for users, _ in found] + [np.zeros(0, dtype=np.int64)]))
+    bounds = np.zeros(len(candidates))
+    for users, field_bounds in found:
+        bounds[np.searchsorted(candidates, users)] += field_bounds
+    return candidates, np.minimum(bounds, 1.0)
+
+
+def subset(m: Dict[str, np.ndarray], rows: np.ndarray) -> EncodedProfiles:
+    """EncodedProfiles of the given rows only, copied out of the shared matrices"""
+    positions, _ = _gather(m['track_indptr'], rows)
+    track_counts = np.asarray(m['track_counts'][rows])
+    track_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(track_counts, out=track_indptr[1:])
+    return EncodedProfiles(
+        # Kernels only need the number of users, not their ids
+        rows.tolist(), m['artists'][rows], m['genres'][rows], track_indptr,
+        np.asarray(m['track_indices'][positions]), np.asarray(m['track_data'][positions]),
+        artist_counts=np.asarray(m['artist_counts'][rows]), genre_counts=np.asarray(m['genre_counts'][rows]),
+        track_counts=track_counts
+    )
+
+
+def score_row(m: Dict[str, np.ndarray], row: int, min_compatibility: float,
+              scorer: ScoringPipeline = DEFAULT_SCORER,
+              idf_inputs: tuple = (None, None)) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compatibility of user `row` with every other user whose upper bound
+    reaches `min_compatibility`, scored by `scorer` (IDF kernels use
+    `idf_inputs`, see MatchEngine.idf_inputs). Work is proportional to the
+    posting lists of the user's items and to the remaining candidates' profiles.
+    """
+    query = encoded_row(m, row)
+    candidates, bounds = candidate_bounds(m, query, scorer)
+    candidates = candidates[(bounds >= min_compatibility) & (candidates != row)]
+    if not len(candidates):
+        return candidates, np.zeros(0)
+    encoded = subset(m, candidates)
+    rows = np.arange(len(candidates))
+    if scorer.uses_idf:
+        return candidates, scorer(encoded, query, rows, *idf_inputs)
+    return candidates, scorer(encoded, query, rows)
+
+
+_worker_matrices: Optional[Dict[str, np.ndarray]] = None
+_worker_scoring: Tuple[ScoringPipeline, tuple] = (DEFAULT_SCORER, (None, None))
+
+
+def _init_worker(directory: str, scorer: ScoringPipeline, idf_inputs: tuple):
+    global _worker_matrices, _worker_scoring
+    _worker_matrices = open_shared_matrices(directory)
+    _worker_scoring = (scorer, idf_inputs)
+
+
+def _score_shard(args: Tuple[int, int, int, float]) -> List[Tuple[int, List[Tuple[int, float]]]]:
+    """Top-k (row, score) pairs of each user in rows [start, stop)"""
+    start, stop, k, min_compatibility = args
+    results = []
+    for row in range(start, stop):
+        candidates, scores = score_row(_worker_matrices, row, min_compatibility, *_worker_scoring)
+        keep = scores >= min_compatibility
+        candidates, scores = candidates[keep], scores[keep]
+        if len(scores) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            candidates, scores = candidates[best], scores[best]
+        order = np.argsort(-scores, kind='stable')
+        results.append((row, list(zip(candidates[order].tolist(), scores[order].tolist()))))
+    return results
+
+
+def parallel_match_rows(encoded: EncodedProfiles, k: int = 50, min_compatibility: float = 0.5,
+                        workers: Optional[int] = None, shard_size: int = 2048,
+                        work_dir: Optional[str] = None, scorer: ScoringPipeline = DEFAULT_SCORER,
+                        idf_inputs: tuple = (None, None)) -> List[Tuple[str, List[Tuple[str, float]]]]:
+    """
+    Score every encoded user against the whole population across a process pool.
+    Returns (user_id, [(partner_id, score), ...]) rows ready for MatchTable.rebuild.
+    `scorer` travels to the workers by kernel name, so custom kernels must be
+    registered in the worker processes too (they are when forked).
+    """
+    if min_compatibility <= 0:
+        raise ValueError("min_compatibility must be positive: users without overlap are never scored")
+    directory = tempfile.mkdtemp(prefix='match_matrices_', dir=work_dir)
+    try:
+        write_shared_matrices(encoded, directory)
+        shards = [
+            (start, min(start + shard_size, len(encoded)), k, min_compatibility)
+            for start in range(0, len(encoded), shard_size)
+        ]
+        user_ids = encoded.user_ids
+        rows = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(directory, scorer, idf_inputs)) as executor:
+            for shard in executor.map(_score_shard, shards):
+                for row, partners in shard:
+                    rows.append((user_ids[row], [(user_ids[other], score) for other, score in partners]))
+        return rows
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    from user_profile import UserProfileManager
+
+    parser = argparse.ArgumentParser(description="Rebuild the match table across all CPU cores")
+    parser.add_argument('--storage-dir', default='data/profiles')
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument('--shard-size', type=int, default=2048, help="Users scored per task")
+    parser.add_argument('--k', type=int, default=50, help="Partners kept per user")
+    parser.add_argument('--min-compatibility', type=float, default=0.5)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    profile_manager = UserProfileManager(storage_dir=args.storage_dir)
+    profile_manager.match_table.k = args.k
+    profile_manager.match_table.min_compatibility = args.min_compatibility
+    profile_manager.build_match_table(workers=args.workers, shard_size=args.shard_size)
+    print(f"Match table rebuilt for {len(profile_manager.match_table)} users "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
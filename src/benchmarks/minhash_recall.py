@@ -0,0 +1,119 @@
+"""
+Recall-vs-latency benchmark of approximate (MinHash/LSH) matching against the
+exact batch scorer on synthetic user populations.
+
+Usage (from src/):
+    python benchmarks/minhash_recall.py --sizes 10000,100000,1000000
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from match_engine import MatchEngine
+from minhash_lsh import MinHashLSH
+from user_profile import MusicPreference, UserProfile
+
+
+def synthetic_profiles(n_users: int, seed: int = 0):
+    """
+    Users drawn from taste clusters: most items come from the cluster's pool,
+    the rest from a Zipf-distributed global catalogue, so the population
+    contains both close matches and a long tail of unrelated users.
+    """
+    rng = np.random.RandomState(seed)
+    n_artists, n_genres, n_tracks = max(n_users // 5, 500), 600, max(n_users * 2, 5000)
+    n_clusters = max(n_users // 50, 1)
+
+    def zipf(size, high):
+        return (rng.zipf(1.3, size=size) - 1) % high
+
+    pools = [
+        (rng.randint(n_artists, size=16), zipf(6, n_genres), rng.randint(n_tracks, size=40))
+        for _ in range(n_clusters)
+    ]
+    for user in range(n_users):
+        artist_pool, genre_pool, track_pool = pools[rng.randint(n_clusters)]
+        artists = np.unique(np.concatenate((rng.choice(artist_pool, 8, replace=False), zipf(2, n_artists))))
+        genres = np.unique(np.concatenate((rng.choice(genre_pool, 3, replace=False), zipf(1, n_genres))))
+        tracks = np.unique(np.concatenate((rng.choice(track_pool, 16, replace=False), zipf(4, n_tracks))))
+        ratings = np.round(rng.rand(len(tracks)), 1)
+        yield UserProfile(
+            user_id=f"user{user}",
+            username=f"user{user}",
+            music_preferences=[
+                MusicPreference(track_id=f"track{t}", name='', artists=[], album='', rating=float(r))
+                for t, r in zip(tracks, ratings)
+            ],
+            top_artists=[f"Artist {a}" for a in artists],
+            top_genres=[f"genre {g}" for g in genres],
+            top_songs=[],
+            top_albums=[]
+        )
+
+
+def run(n_users: int, n_queries: int, min_compatibility: float, num_perm: int, bands: int, seed: int):
+    profiles = list(synthetic_profiles(n_users, seed))
+
+    start = time.perf_counter()
+    engine = MatchEngine()
+    for profile in profiles:
+        engine.update(profile)
+    encoded = engine.matrix()
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    lsh = MinHashLSH(num_perm=num_perm, bands=bands)
+    lsh.rebuild(profiles)
+    lsh_time = time.perf_counter() - start
+
+    rng = np.random.RandomState(seed + 1)
+    exact_times, approx_times, candidate_counts, recalls = [], [], [], []
+    for row in rng.choice(n_users, size=min(n_queries, n_users), replace=False):
+        profile = profiles[row]
+
+        start = time.perf_counter()
+        scores = engine.score(profile, encoded)
+        exact = {encoded.user_ids[i] for i in np.flatnonzero(scores >= min_compatibility)}
+        exact_times.append(time.perf_counter() - start)
+        exact.discard(profile.user_id)
+
+        start = time.perf_counter()
+        candidates = list(lsh.query(profile))
+        subset = engine.subset(candidates)
+        approx_scores = engine.score(profile, subset)
+        approx = {subset.user_ids[i] for i in np.flatnonzero(approx_scores >= min_compatibility)}
+        approx_times.append(time.perf_counter() - start)
+
+        candidate_counts.append(len(candidates))
+        if exact:
+            recalls.append(len(approx & exact) / len(exact))
+
+    print(
+        f"{n_users:>9,} users | encode {encode_time:6.1f}s  lsh build {lsh_time:6.1f}s | "
+        f"exact p50 {np.median(exact_times) * 1000:8.2f} ms | "
+        f"approx p50 {np.median(approx_times) * 1000:7.2f} ms "
+        f"({np.mean(candidate_counts):,.0f} candidates) | "
+        f"recall {np.mean(recalls) if recalls else float('nan'):.3f} over {len(recalls)} queries"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000,1000000', help="Comma separated population sizes")
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--min-compatibility', type=float, default=0.5)
+    parser.add_argument('--num-perm', type=int, default=64)
+    parser.add_argument('--bands', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for size in (int(s) for s in args.sizes.split(',')):
+        run(size, args.queries, args.min_compatibility, args.num_perm, args.bands, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Pick the password hashing cost for this machine: the most expensive
+setting whose median hash time stays under a target latency. Run it on the
+deployment hardware and copy the printed PASSWORD_HASHING into config.py.
+
+Usage (from src/):
+    python benchmarks/password_hashing.py --target-ms 250
+    python benchmarks/password_hashing.py --scheme pbkdf2-sha256 --target-ms 250
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from password_hashing import DEFAULT_SCRYPT, PasswordHasher
+
+
+def median_ms(hasher: PasswordHasher, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        hasher.hash('correct horse battery staple')
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def calibrate_scrypt(target_ms: float, r: int, p: int, max_memory_mb: float, repeat: int) -> dict:
+    best = None
+    n = 2 ** 12
+    # Memory grows with n as well: 128 * r * n bytes
+    while 128 * r * n <= max_memory_mb * 2 ** 20:
+        elapsed = median_ms(PasswordHasher('scrypt', n=n, r=r, p=p), repeat)
+        print(f"  scrypt n=2^{n.bit_length() - 1:<2} r={r} p={p}  {128 * r * n / 2 ** 20:6.0f} MiB  "
+              f"{elapsed:8.1f} ms")
+        if elapsed > target_ms:
+            break
+        best = {'scheme': 'scrypt', 'n': n, 'r': r, 'p': p}
+        n *= 2
+    return best
+
+
+def calibrate_pbkdf2(target_ms: float, repeat: int) -> dict:
+    # PBKDF2 time is linear in the iterations: extrapolate, then check
+    probe = 100_000
+    elapsed = median_ms(PasswordHasher('pbkdf2-sha256', iterations=probe), repeat)
+    iterations = max(10_000, int(probe * target_ms / elapsed) // 10_000 * 10_000)
+    while True:
+        elapsed = median_ms(PasswordHasher('pbkdf2-sha256', iterations=iterations), repeat)
+        print(f"  pbkdf2-sha256 i={iterations:<9} {elapsed:8.1f} ms")
+        if elapsed <= target_ms or iterations <= 10_000:
+            return {'scheme': 'pbkdf2-sha256', 'iterations': iterations}
+        iterations = max(10_000, int(iterations * target_ms / elapsed) // 10_000 * 10_000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scheme', default='scrypt', choices=('scrypt', 'pbkdf2-sha256'))
+    parser.add_argument('--target-ms', type=float, default=250.0, help="Latency budget of one hash")
+    parser.add_argument('--r', type=int, default=DEFAULT_SCRYPT['r'], help="scrypt block size")
+    parser.add_argument('--p', type=int, default=DEFAULT_SCRYPT['p'], help="scrypt parallelism")
+    parser.add_argument('--max-memory-mb', type=float, default=256.0, help="scrypt memory limit per hash")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"Target: {args.target_ms:.0f} ms per hash")
+    if args.scheme == 'scrypt':
+        best = calibrate_scrypt(args.target_ms, args.r, args.p, args.max_memory_mb, args.repeat)
+    else:
+        best = calibrate_pbkdf2(args.target_ms, args.repeat)
+    if best is None:
+        print("Even the cheapest setting exceeds the target; raise --target-ms")
+        return
+    print(f"\nPASSWORD_HASHING = {best!r}")
+
+
+if __name__ == "__main__":
+    main()
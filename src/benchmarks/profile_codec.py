@@ -0,0 +1,89 @@
+"""
+Size and parse-time comparison of the JSON and binary (profile_codec) profile
+formats on synthetic profiles.
+
+Usage (from src/):
+    python benchmarks/profile_codec.py --users 2000 --tracks 200
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import profile_codec
+from user_profile import MusicPreference, UserProfile
+
+
+def synthetic_profile(rng: np.random.RandomState, user: int, n_tracks: int) -> UserProfile:
+    return UserProfile(
+        user_id=f"user{user}",
+        username=f"user{user}",
+        age=int(rng.randint(18, 70)),
+        bio="Listening to everything",
+        music_preferences=[
+            MusicPreference(
+                track_id=f"{rng.randint(1 << 62):022x}",
+                name=f"Track {rng.randint(100000)}",
+                artists=[f"Artist {a}" for a in rng.randint(5000, size=rng.randint(1, 4))],
+                album=f"Album {rng.randint(20000)}",
+                rating=float(np.round(rng.rand(), 2))
+            ) for _ in range(n_tracks)
+        ],
+        top_artists=[f"Artist {a}" for a in rng.randint(5000, size=20)],
+        top_genres=[f"genre {g}" for g in rng.randint(600, size=5)],
+        top_songs=[{'name': f"Track {s}", 'artist': f"Artist {s % 5000}"} for s in rng.randint(100000, size=10)],
+        top_albums=[{'name': f"Album {a}", 'image': None} for a in rng.randint(20000, size=10)],
+        favorite_artists=[f"Artist {a}" for a in rng.randint(5000, size=5)]
+    )
+
+
+def timed(function, payloads):
+    start = time.perf_counter()
+    for payload in payloads:
+        function(payload)
+    return time.perf_counter() - start
+
+
+def run(n_users: int, n_tracks: int, seed: int):
+    rng = np.random.RandomState(seed)
+    profiles = [synthetic_profile(rng, user, n_tracks).to_dict() for user in range(n_users)]
+    json_payloads = [json.dumps(p, indent=2).encode() for p in profiles]
+    binary_payloads = [profile_codec.encode(p) for p in profiles]
+
+    json_size = sum(map(len, json_payloads))
+    binary_size = sum(map(len, binary_payloads))
+    print(f"{n_users} profiles x {n_tracks} tracks")
+    print(f"  size    json {json_size / 1e6:8.2f} MB   binary {binary_size / 1e6:8.2f} MB   "
+          f"({binary_size / json_size:.0%})")
+
+    json_decode = timed(json.loads, json_payloads)
+    binary_decode = timed(profile_codec.decode, binary_payloads)
+    print(f"  decode  json {json_decode * 1000:8.1f} ms   binary {binary_decode * 1000:8.1f} ms   "
+          f"({json_decode / binary_decode:.1f}x)")
+
+    json_load = timed(lambda payload: UserProfile.from_dict(json.loads(payload)), json_payloads)
+    binary_load = timed(lambda payload: UserProfile.from_dict(profile_codec.decode(payload)), binary_payloads)
+    print(f"  profile json {json_load * 1000:8.1f} ms   binary {binary_load * 1000:8.1f} ms   "
+          f"({json_load / binary_load:.1f}x)")
+
+    json_encode = timed(lambda p: json.dumps(p, indent=2), profiles)
+    binary_encode = timed(profile_codec.encode, profiles)
+    print(f"  encode  json {json_encode * 1000:8.1f} ms   binary {binary_encode * 1000:8.1f} ms   "
+          f"({json_encode / binary_encode:.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--tracks', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    run(args.users, args.tracks, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Append-only log of profile changes for downstream consumers.
+
+Every profile save or deletion appends one compact JSON line:
+
+    {"user_id": ..., "op": "save" | "delete", "fields": [changed top-level
+     fields of UserProfile.to_dict], "version": store version, "time": ...}
+
+The log is split into segments named after the global byte offset of their
+first record (<offset>.log), and a new segment is started once the active
+one reaches `segment_bytes`; only the newest `max_segments` are kept. A
+record's position (segment offset + offset in the segment) never changes,
+so consumers (match tables, feature snapshots, search indexes) keep a
+position and tail the log with a FeedCursor instead of rescanning the
+store. Appends take an exclusive lock, so several processes can write to
+the same feed.
+"""
+import argparse
+import json
+import os
+import time
+from typing import Hashable, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are not coordinated between processes
+    fcntl = None
+
+
+class ChangeFeed:
+    """Writer side of a segmented change log in `directory`"""
+
+    SUFFIX = '.log'
+
+    def __init__(self, directory: str, segment_bytes: int = 8 << 20, max_segments: int = 16):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+        self.lock_file = os.path.join(directory, 'feed.lock')
+
+    def segments(self) -> List[int]:
+        """Start offsets of the retained segments, oldest first"""
+        return sorted(
+            int(name[:-len(self.SUFFIX)]) for name in os.listdir(self.directory)
+            if name.endswith(self.SUFFIX) and name[:-len(self.SUFFIX)].isdigit()
+        )
+
+    def segment_path(self, start: int) -> str:
+        return os.path.join(self.directory, f'{start:020d}{self.SUFFIX}')
+
+    def append(self, user_id: str, op: str, fields: List[str], version: Hashable = None):
+        self.append_records([{
+            'user_id': user_id, 'op': op, 'fields': fields, 'version': version, 'time': time.time()
+        }])
+
+    def append_records(self, records: List[dict]) -> int:
+        """Append records (in one write), returns the position after them"""
+        data = b''.join((json.dumps(r, separators=(',', ':')) + '\n').encode() for r in records)
+        with open(self.lock_file, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            segments = self.segments()
+            start = segments[-1] if segments else 0
+            path = self.segment_path(start)
+            size = os.path.getsize(path) if segments else 0
+            if size >= self.segment_bytes:
+                start += size
+                path = self.segment_path(start)
+                size = 0
+                segments.append(start)
+            with open(path, 'ab') as f:
+                f.write(data)
+            for old in segments[:-self.max_segments]:
+                os.remove(self.segment_path(old))
+        return start + size + len(data)
+
+    def end(self) -> int:
+        """Position after the last record, where a consumer that is up to date starts"""
+        segments = self.segments()
+        if not segments:
+            return 0
+        return segments[-1] + os.path.getsize(self.segment_path(segments[-1]))
+
+
+class FeedCursor:
+    """Reader side: the records appended since `position`, segment by segment"""
+
+    def __init__(self, feed: ChangeFeed, position: int = 0):
+        self.feed = feed
+        self.position = position
+
+    def poll(self, limit: Optional[int] = None) -> Tuple[bool, List[dict]]:
+        """
+        Return (gap, records) for up to `limit` records after the cursor's
+        position and advance it. `gap` is True when records the cursor had not
+        read were already dropped by rotation: the consumer must rebuild from
+        the store and can then continue from here.
+        """
+        segments = self.feed.segments()
+        gap = False
+        if segments and self.position < segments[0]:
+            gap = self.position > 0 or segments[0] > 0
+            self.position = segments[0]
+        records = []
+        for index, start in enumerate(segments):
+            end = segments[index + 1] if index + 1 < len(segments) else None
+            if end is not None and self.position >= end:
+                continue
+            with open(self.feed.segment_path(start), 'rb') as f:
+                f.seek(self.position - start)
+                for line in f:
+                    if not line.endswith(b'\n') or (limit is not None and len(records) >= limit):
+                        break  # Partially written record, pick it up next time
+                    self.position += len(line)
+                    records.append(json.loads(line))
+            if end is None or (limit is not None and len(records) >= limit):
+                break
+            # A finished segment ends exactly where the next one starts
+            self.position = end
+        return gap, records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print profile change records")
+    parser.add_argument('--feed-dir', default='data/changes')
+    parser.add_argument('--position', type=int, default=0, help="Start after this position")
+    parser.add_argument('--follow', action='store_true', help="Keep printing new records")
+    args = parser.parse_args()
+
+    cursor = FeedCursor(ChangeFeed(args.feed_dir), args.position)
+    while True:
+        gap, records = cursor.poll()
+        if gap:
+            print("# records before this point were rotated away")
+        for record in records:
+            print(json.dumps(record))
+        if not args.follow:
+            break
+        time.sleep(1.0)
+    print(f"# position {cursor.position}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,4 +7,8 @@ SCOPE = 'user-read-playback-state user-read-currently-playing user-top-read'
 
 # Discord Rich Presence
 # Get this from https://discord.com/developers/applications
-DISCORD_CLIENT_ID = 'your_discord_client_id_here' 
\ No newline at end of file
+DISCORD_CLIENT_ID = 'your_discord_client_id_here' 
+
+# Password hashing cost, tuned to take ~250 ms per login on this machine:
+# run `python benchmarks/password_hashing.py` and paste its suggestion here
+PASSWORD_HASHING = {'scheme': 'scrypt', 'n': 32768, 'r': 8, 'p': 1}
@@ -0,0 +1,257 @@
+"""
+Memory-mapped snapshot of every profile's match features.
+
+`build_snapshot` writes, per field, the CSR arrays of a users x vocabulary
+matrix as plain .npy files:
+
+    artists  user x artist counts (float32)
+    genres   user x genre counts (float32)
+    tracks   user x track ratings (float64; a track rated twice gets its
+             mean rating), plus tracks_counts.npy, the number of ratings
+             of each entry, with the same indptr/indices
+
+All matrices are in canonical form (sorted, no duplicates), so SciPy never
+needs to rewrite the read-only arrays.
+
+Columns are global vocabulary ids (see vocabulary.py), rows follow
+`user_ids.json`. Consumers open the arrays with mmap_mode='r' through
+`open_snapshot`, so any number of processes share the same pages.
+
+Builds are incremental: the manifest records the store version (file
+mtime and size for the file backends) every row was encoded from, and
+only new or changed profiles are read and encoded again; the rows of
+unchanged profiles are copied from the previous snapshot. Every build
+goes to a new generation directory and the CURRENT file is switched
+atomically, so readers holding the previous generation keep working.
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+import numpy as np
+from scipy import sparse
+from typing import Dict, List, Optional, Tuple
+from match_engine import KEY_FORMAT
+
+SNAPSHOT_FORMAT = 1
+FIELDS = ('artists', 'genres', 'tracks')
+ARRAYS = {'artists': ('indptr', 'indices', 'data'), 'genres': ('indptr', 'indices', 'data'),
+          'tracks': ('indptr', 'indices', 'data', 'counts')}
+_DATA_TYPES = {'artists': np.float32, 'genres': np.float32, 'tracks': np.float64}
+
+
+class FeatureSnapshot:
+    """A snapshot generation opened read-only; matrices share the memory-mapped arrays"""
+
+    def __init__(self, directory: str, mmap_mode: Optional[str] = 'r'):
+        with open(os.path.join(directory, 'CURRENT')) as f:
+            self.path = os.path.join(directory, f.read().strip())
+        with open(os.path.join(self.path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        with open(os.path.join(self.path, 'user_ids.json')) as f:
+            self.user_ids: List[str] = json.load(f)
+        self.arrays = {
+            field: {name: np.load(os.path.join(self.path, f'{field}_{name}.npy'), mmap_mode=mmap_mode)
+                    for name in ARRAYS[field]}
+            for field in FIELDS
+        }
+        self._rows: Optional[Dict[str, int]] = None
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    @property
+    def rows(self) -> Dict[str, int]:
+        """user_id -> row"""
+        if self._rows is None:
+            self._rows = {user_id: row for row, user_id in enumerate(self.user_ids)}
+        return self._rows
+
+    def matrix(self, field: str) -> sparse.csr_matrix:
+        """users x vocabulary CSR matrix of a field, without copying the arrays"""
+        arrays = self.arrays[field]
+        shape = (len(self.user_ids), self.manifest['columns'][field])
+        return sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False)
+
+    @property
+    def artists(self) -> sparse.csr_matrix:
+        return self.matrix('artists')
+
+    @property
+    def genres(self) -> sparse.csr_matrix:
+        return self.matrix('genres')
+
+    @property
+    def tracks(self) -> sparse.csr_matrix:
+        return self.matrix('tracks')
+
+    @property
+    def track_counts(self) -> sparse.csr_matrix:
+        """How many times each user rated each track, same structure as `tracks`"""
+        arrays = self.arrays['tracks']
+        shape = (len(self.user_ids), self.manifest['columns']['tracks'])
+        return sparse.csr_matrix((arrays['counts'], arrays['indices'], arrays['indptr']), shape=shape, copy=False)
+
+
+def open_snapshot(directory: str, mmap_mode: Optional[str] = 'r') -> FeatureSnapshot:
+    return FeatureSnapshot(directory, mmap_mode)
+
+
+def _index_dtype(size: int):
+    return np.int32 if size < 2 ** 31 else np.int64
+
+
+def _canonical(rows: np.ndarray, cols: np.ndarray, values: np.ndarray, shape: Tuple[int, int]) -> sparse.csr_matrix:
+    matrix = sparse.csr_matrix((values, (rows, cols)), shape=shape)
+    matrix.sum_duplicates()
+    return matrix
+
+
+def _encode(features_list: List, vocabulary) -> Dict[str, Dict[str, np.ndarray]]:
+    """Arrays (see ARRAYS) per field of freshly encoded profiles"""
+    ids = [f.item_arrays(vocabulary) for f in features_list]
+    encoded = {}
+    for field in FIELDS:
+        cols = [i[field] for i in ids]
+        lengths = np.fromiter(map(len, cols), dtype=np.int64, count=len(cols))
+        rows = np.repeat(np.arange(len(cols)), lengths)
+        cols = np.concatenate(cols).astype(np.int64) if cols else np.zeros(0, dtype=np.int64)
+        shape = (len(features_list), len(vocabulary[field]))
+        counts = _canonical(rows, cols, np.ones(len(cols)), shape)
+        arrays = encoded[field] = {'indptr': counts.indptr, 'indices': counts.indices, 'data': counts.data}
+        if field == 'tracks':
+            ratings = [np.frombuffer(f.music_preferences.ratings, dtype=np.float64) for f in features_list]
+            ratings = np.concatenate(ratings) if ratings else np.zeros(0)
+            # Same coordinates, so the same structure as `counts`
+            sums = _canonical(rows, cols, ratings, shape)
+            arrays['data'] = sums.data / counts.data
+            arrays['counts'] = counts.data
+    return encoded
+
+
+def _gather_rows(indptr: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Lengths of the given CSR rows and the positions of their entries"""
+    starts = np.asarray(indptr[rows], dtype=np.int64)
+    lengths = np.asarray(indptr[rows + 1], dtype=np.int64) - starts
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return lengths, offsets + np.arange(int(lengths.sum()))
+
+
+def _previous(directory: str, vocabulary) -> Optional[FeatureSnapshot]:
+    """The current snapshot if its rows can be reused with this vocabulary"""
+    try:
+        snapshot = FeatureSnapshot(directory)
+    except (FileNotFoundError, ValueError):
+        return None
+    manifest = snapshot.manifest
+    if manifest.get('format') != SNAPSHOT_FORMAT or manifest.get('key_format') != KEY_FORMAT:
+        return None
+    # Vocabulary ids are append-only; a smaller vocabulary means it was rebuilt
+    if any(manifest['columns'][field] > len(vocabulary[field]) for field in FIELDS):
+        return None
+    return snapshot
+
+
+def build_snapshot(profile_manager, directory: str) -> Dict[str, int]:
+    """
+    Write a new snapshot generation of every stored profile, re-encoding only
+    profiles whose store version changed since the previous one. Returns the
+    number of users, encoded and reused rows.
+    """
+    os.makedirs(directory, exist_ok=True)
+    vocabulary = profile_manager.vocabulary
+    previous = _previous(directory, vocabulary)
+    old_versions = {}
+    if previous is not None:
+        old_versions = {user_id: (row, version) for row, (user_id, version)
+                        in enumerate(zip(previous.user_ids, previous.manifest['versions']))}
+
+    user_ids = profile_manager.list_user_ids()
+    store = profile_manager.store
+    # As stored in the manifest (tuples become lists)
+    versions = json.loads(json.dumps({user_id: store.version(user_id) for user_id in user_ids}))
+    reused_ids, reused_rows, changed = [], [], []
+    for user_id, version in versions.items():
+        if version is None:
+            continue
+        old = old_versions.get(user_id)
+        if old is not None and old[1] == version:
+            reused_ids.append(user_id)
+            reused_rows.append(old[0])
+        else:
+            changed.append(user_id)
+    features = profile_manager.load_match_features_many(changed)
+    changed = [user_id for user_id in changed if user_id in features]
+    encoded = _encode([features[user_id] for user_id in changed], vocabulary)
+
+    reused_rows = np.array(reused_rows, dtype=np.int64)
+    arrays = {}
+    for field in FIELDS:
+        new = encoded[field]
+        columns = [name for name in ARRAYS[field] if name != 'indptr']
+        lengths = np.diff(new['indptr'])
+        if previous is not None and len(reused_rows):
+            old = previous.arrays[field]
+            old_lengths, positions = _gather_rows(old['indptr'], reused_rows)
+            merged = {name: np.concatenate((np.asarray(old[name][positions]), new[name])) for name in columns}
+            lengths = np.concatenate((old_lengths, lengths))
+        else:
+            merged = {name: new[name] for name in columns}
+        indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        index_dtype = _index_dtype(max(len(merged['indices']), len(vocabulary[field])))
+        arrays[field] = {
+            'indptr': indptr.astype(index_dtype),
+            'indices': merged['indices'].astype(index_dtype),
+            'data': merged['data'].astype(_DATA_TYPES[field])
+        }
+        if 'counts' in merged:
+            arrays[field]['counts'] = merged['counts'].astype(np.float32)
+
+    all_ids = reused_ids + changed
+    generation = f'gen-{time.time_ns()}'
+    path = os.path.join(directory, generation)
+    os.makedirs(path)
+    for field in FIELDS:
+        for name in ARRAYS[field]:
+            np.save(os.path.join(path, f'{field}_{name}.npy'), arrays[field][name])
+    with open(os.path.join(path, 'user_ids.json'), 'w') as f:
+        json.dump(all_ids, f)
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump({
+            'format': SNAPSHOT_FORMAT,
+            'key_format': KEY_FORMAT,
+            'columns': {field: len(vocabulary[field]) for field in FIELDS},
+            'versions': [versions[user_id] for user_id in all_ids]
+        }, f)
+    temp_file = os.path.join(directory, f'CURRENT.{os.getpid()}.tmp')
+    with open(temp_file, 'w') as f:
+        f.write(generation)
+    os.replace(temp_file, os.path.join(directory, 'CURRENT'))
+
+    # Keep the previous generation for readers that have not switched yet
+    keep = {generation, os.path.basename(previous.path) if previous is not None else None}
+    for name in os.listdir(directory):
+        if name.startswith('gen-') and name not in keep:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    return {'users': len(all_ids), 'encoded': len(changed), 'reused': len(reused_ids)}
+
+
+def main():
+    from user_profile import UserProfileManager
+
+    parser = argparse.ArgumentParser(description="Build or update the memory-mapped feature snapshot")
+    parser.add_argument('--storage-dir', default='data/profiles')
+    parser.add_argument('--output-dir', default='data/feature_snapshot')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    profile_manager = UserProfileManager(storage_dir=args.storage_dir)
+    stats = build_snapshot(profile_manager, args.output_dir)
+    print(f"Snapshot of {stats['users']} users written to {args.output_dir} "
+          f"({stats['encoded']} encoded, {stats['reused']} reused) in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import argparse
+import os
+import numpy as np
+from typing import Dict, Optional, Set, Tuple
+from scoring import FIELDS, bm25_idf
+from vocabulary import Vocabularies
+
+Entry = Dict[str, Dict[str, int]]
+
+
+class ItemFrequencies:
+    """Population document frequencies of every artist, genre and track, keyed by vocabulary id.
+
+    `counts[field][item_id]` is the number of users listing the item at least
+    once. The arrays are patched from the old and new index entry of every
+    profile the InvertedIndex applies, including entries replayed from saves
+    by other processes, so they are always as fresh as the index without a
+    separate recount. BM25 IDF weights are derived lazily and only the
+    changed items are recomputed while the number of users stays the same.
+    """
+
+    def __init__(self, vocabulary: Vocabularies):
+        self.vocabulary = vocabulary
+        self.reset()
+
+    def reset(self):
+        self.n_documents = 0
+        self.counts: Dict[str, np.ndarray] = {field: np.zeros(0, dtype=np.int64) for field in FIELDS}
+        self._idf: Optional[Dict[str, np.ndarray]] = None
+        self._idf_documents = 0
+        self._changed: Dict[str, Set[int]] = {field: set() for field in FIELDS}
+
+    def _grow(self, field: str, size: int):
+        counts = self.counts[field]
+        if size > len(counts):
+            grown = np.zeros(max(size, 2 * len(counts)), dtype=np.int64)
+            grown[:len(counts)] = counts
+            self.counts[field] = grown
+
+    def apply(self, old: Optional[Entry], new: Optional[Entry]):
+        """Account for a user's index entry changing from `old` to `new` (None: absent)"""
+        self.n_documents += (new is not None) - (old is not None)
+        for field in FIELDS:
+            old_keys = old[field].keys() if old else ()
+            new_keys = new[field].keys() if new else ()
+            removed = [k for k in old_keys if k not in new_keys]
+            added = [k for k in new_keys if k not in old_keys]
+            if not removed and not added:
+                continue
+            vocabulary = self.vocabulary[field]
+            removed_ids = np.frombuffer(vocabulary.ids(removed), dtype=np.uint32).astype(np.int64)
+            added_ids = np.frombuffer(vocabulary.ids(added), dtype=np.uint32).astype(np.int64)
+            self._grow(field, len(vocabulary))
+            counts = self.counts[field]
+            counts[removed_ids] -= 1
+            counts[added_ids] += 1
+            changed = self._changed[field]
+            changed.update(removed_ids.tolist())
+            changed.update(added_ids.tolist())
+
+    def frequencies(self) -> Tuple[int, Dict[str, np.ndarray]]:
+        """(number of users, {field: frequency per vocabulary id}), views of the live arrays"""
+        return self.n_documents, {field: counts[:len(self.vocabulary[field])] for field, counts in self.counts.items()}
+
+    def idf(self) -> Dict[str, np.ndarray]:
+        """BM25 IDF per vocabulary id and field, items nobody lists get the maximum"""
+        if self._idf is None or self._idf_documents != self.n_documents:
+            self._idf = {field: bm25_idf(counts, max(self.n_documents, 1)) for field, counts in self.counts.items()}
+            self._idf_documents = self.n_documents
+        else:
+            for field, changed in self._changed.items():
+                idf = self._idf[field]
+                if len(idf) < len(self.counts[field]):
+                    grown = np.empty(len(self.counts[field]))
+                    grown[:len(idf)] = idf
+                    grown[len(idf):] = bm25_idf(self.counts[field][len(idf):], max(self.n_documents, 1))
+                    idf = self._idf[field] = grown
+                if changed:
+                    ids = np.fromiter(changed, dtype=np.int64, count=len(changed))
+                    idf[ids] = bm25_idf(self.counts[field][ids], max(self.n_documents, 1))
+        for changed in self._changed.values():
+            changed.clear()
+        return self._idf
+
+    def save(self, directory: str):
+        """Write the frequencies as <field>_df.npy arrays indexed by vocabulary id, e.g. for ML jobs"""
+        os.makedirs(directory, exist_ok=True)
+        n_documents, frequencies = self.frequencies()
+        for field, counts in frequencies.items():
+            np.save(os.path.join(directory, f'{field}_df.npy'), counts)
+        np.save(os.path.join(directory, 'n_documents.npy'), np.array(n_documents))
+
+
+def main():
+    from user_profile import UserProfileManager
+
+    parser = argparse.ArgumentParser(description="Export population document frequencies per vocabulary id")
+    parser.add_argument('--storage-dir', default='data/profiles')
+    parser.add_argument('--output-dir', default='data/item_frequencies')
+    args = parser.parse_args()
+
+    profile_manager = UserProfileManager(storage_dir=args.storage_dir)
+    profile_manager.match_index.refresh()
+    profile_manager.item_frequencies.save(args.output_dir)
+    print(f"Document frequencies of {profile_manager.item_frequencies.n_documents} users "
+          f"written to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are not coordinated between processes
+    fcntl = None
+
+
+def _open_locked(path: str):
+    """
+    Open a journal for appending under an exclusive lock (released when the
+    file is closed), reopening it if it was replaced while we waited
+    """
+    while True:
+        f = open(path, 'ab+')
+        if fcntl is None:
+            return f
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
+
+
+def cut_partial_record(f) -> int:
+    """
+    Truncate a JSON-lines file opened for appending ('ab+') after its last
+    complete line and return its size; call it holding the file's lock. A writer that crashed mid-append leaves a partial line,
+    which the next append would otherwise extend into an undecodable one.
+    """
+    size = f.seek(0, os.SEEK_END)
+    if size:
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return size
+    end = size
+    while end > 0:
+        start = max(0, end - 4096)
+        f.seek(start)
+        newline = f.read(end - start).rfind(b'\n')
+        if newline >= 0:
+            end = start + newline + 1
+            break
+        end = start
+    if end < size:
+        f.truncate(end)
+    return end
+
+
+class RecordJournal:
+    """Append-only JSON-lines file of keyed records where the last record for a key wins.
+
+    Writers append one line per change; readers call `read` to pick up the
+    records appended since their last read, including ones written by another
+    process or manager instance. `write_all` compacts the journal down to the
+    live records and atomically replaces the file, which makes every reader
+    start over on its next `read`. Appends and compactions take an exclusive
+    lock on the file, so several processes can append to one journal.
+
+    When a `version` is given it is written as a header record; a journal
+    written with another version (or none) is reported by `is_current` so
+    the owner can rebuild it. The owner's `header` fields (settings the
+    records depend on) are written into the same record and read back as
+    `file_header`.
+    """
+
+    def __init__(self, path: str, version: Optional[int] = None):
+        self.path = path
+        self.version = version
+        self.header: Dict[str, object] = {}
+        self.file_version = None
+        self.file_header: Dict[str, object] = {}
+        self._offset = 0
+        self._inode = None
+        # Records in the file, used to decide when compaction pays off
+        self.record_count = 0
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def is_current(self) -> bool:
+        """True if the journal exists and its last read header matches this journal's version"""
+        if not self.exists():
+            return False
+        return self.version is None or self.file_version == self.version
+
+    def read(self) -> Tuple[bool, List[dict]]:
+        """
+        Return (restarted, records) for everything appended since the last read.
+        When `restarted` is True the file was compacted or replaced and the
+        records are the complete state, so the caller must drop what it had.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False, []
+        restarted = False
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            restarted = self._inode is not None or self._offset > 0
+            self._inode = stat.st_ino
+            self._offset = 0
+            self.record_count = 0
+            self.file_version = None
+            self.file_header = {}
+        if stat.st_size == self._offset:
+            return restarted, []
+        records = []
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # Partially written record, pick it up next time
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    # Torn tails are cut by append(), so a bad complete line is real damage
+                    raise ValueError(f"Corrupt record in {self.path} at byte {self._offset}: {e}") from e
+                self._offset += len(line)
+                if '_version' in record:
+                    self.file_version = record.pop('_version')
+                    self.file_header = record
+                    continue
+                records.append(record)
+        self.record_count += len(records)
+        return restarted, records
+
+    def append(self, records: Iterable[dict], durable: bool = False):
+        """
+        Append records. Call `read` first so records written by others are not
+        skipped. With `durable` the data is fsynced before returning.
+        """
+        records = list(records)
+        if not records:
+            return
+        with _open_locked(self.path) as f:
+            # Under the lock, a partial line can only be left by a writer that died
+            size = cut_partial_record(f)
+            if size == 0 and self.version is not None:
+                records.insert(0, self._header_record())
+                self.file_version, self.file_header = self.version, dict(self.header)
+            data = b''.join(
+                (json.dumps(record, separators=(',', ':')) + '\n').encode() for record in records
+            )
+            f.write(data)
+            f.flush()
+            if durable:
+                os.fsync(f.fileno())
+            inode = os.fstat(f.fileno()).st_ino
+        if (inode, size) == (self._inode, self._offset) or (self._inode, self._offset, size) == (None, 0, 0):
+            self._inode = inode
+            self._offset = size + len(data)
+            self.record_count += data.count(b'\n')
+        # Otherwise others appended since our last read: the next read picks up
+        # their records and then ours again (the last record per key still wins)
+
+    def _header_record(self) -> dict:
+        return {'_version': self.version, **self.header}
+
+    def needs_compaction(self, live_records: int) -> bool:
+        return self.record_count > 2 * live_records + 1000
+
+    def write_all(self, records: Iterable[dict], durable: bool = False):
+        """Replace the journal with the given records (fsynced before the switch with `durable`)"""
+        temp_file = self.path + '.tmp'
+        count = 0
+        # Appends wait for the switch and then go to the new file
+        with _open_locked(self.path):
+            with open(temp_file, 'w') as f:
+                if self.version is not None:
+                    f.write(json.dumps(self._header_record()) + '\n')
+                for record in records:
+                    f.write(json.dumps(record, separators=(',', ':')) + '\n')
+                    count += 1
+                if durable:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(temp_file, self.path)
+        stat = os.stat(self.path)
+        self._inode = stat.st_ino
+        self._offset = stat.st_size
+        self.record_count = count
+        self.file_version = self.version
+        self.file_header = dict(self.header)
@@ -0,0 +1,196 @@
+import sys
+import unicodedata
+import numpy as np
+from scipy import sparse
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from scoring import DEFAULT_SCORER, ScoringPipeline, track_matrices
+from vocabulary import Vocabularies
+
+# Version of the key normalization below. Persisted match structures (index,
+# match table, LSH signatures) built with another version are rebuilt.
+KEY_FORMAT = 2
+
+_normalized_keys: Dict[str, str] = {}
+
+
+def normalize_key(name: str) -> str:
+    """
+    Case- and Unicode-insensitive matching key of an artist or genre name.
+    Keys are interned and memoized, so each distinct name is normalized once
+    per process and equal keys share one string object.
+    """
+    key = _normalized_keys.get(name)
+    if key is None:
+        key = _normalized_keys[name] = sys.intern(unicodedata.normalize('NFKC', name).casefold())
+    return key
+
+
+class EncodedProfiles:
+    """Sparse, one-row-per-user encoding of a batch of profiles.
+
+    Artists and genres are stored as count matrices (users x vocabulary) so the
+    number of matching pairs between two users is a dot product. Track ratings
+    are kept as flat CSR-style arrays because their contribution depends on the
+    rating difference, not just on the overlap.
+    """
+
+    def __init__(self, user_ids: List[str], artists: sparse.csr_matrix, genres: sparse.csr_matrix,
+                 track_indptr: np.ndarray, track_cols: np.ndarray, track_ratings: np.ndarray,
+                 artist_counts: np.ndarray, genre_counts: np.ndarray, track_counts: np.ndarray):
+        self.user_ids = user_ids
+        self.artists = artists
+        self.genres = genres
+        self.track_indptr = track_indptr
+        self.track_cols = track_cols
+        self.track_ratings = track_ratings
+        # Row of every track entry, used to sum entries per user with bincount
+        self.track_rows = np.repeat(np.arange(len(user_ids)), np.diff(track_indptr))
+        # List lengths (duplicates included), the denominators of the formula
+        self.artist_counts = artist_counts
+        self.genre_counts = genre_counts
+        self.track_counts = track_counts
+        # Track count/rating matrices, built on demand by the scoring kernels
+        self._track_matrices = None
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+
+class MatchEngine:
+    """Encodes profiles into sparse vectors and scores one user against many at once.
+
+    Every user added with `update` is kept encoded, so a query only has to
+    encode the querying user and run a few vectorized operations over the
+    stacked matrices. How the operations combine into a score is set by the
+    `scorer` pipeline (see scoring.compile_scorer).
+    """
+
+    def __init__(self, vocabulary: Optional[Vocabularies] = None, scorer: Optional[ScoringPipeline] = None,
+                 frequencies=None):
+        # Columns are global vocabulary ids; a private in-memory vocabulary by default
+        self.vocabulary = vocabulary if vocabulary is not None else Vocabularies()
+        self.scorer = scorer if scorer is not None else DEFAULT_SCORER
+        # Population ItemFrequencies for IDF kernels; without it, frequencies among the known users
+        self.frequencies = frequencies
+        self._frequencies = None
+        self._rows: Dict[str, tuple] = {}
+        self._matrix: Optional[EncodedProfiles] = None
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._rows
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def encode_row(self, profile) -> tuple:
+        """Encode a single profile as (artist cols, genre cols, track cols, ratings)"""
+        ids = profile.item_arrays(self.vocabulary)
+        return (
+            ids['artists'].astype(np.int64),
+            ids['genres'].astype(np.int64),
+            ids['tracks'].astype(np.int64),
+            np.array(profile.music_preferences.ratings, dtype=np.float64)
+        )
+
+    def encode(self, profiles: Iterable) -> EncodedProfiles:
+        """Encode a batch of profiles without adding them to the engine"""
+        profiles = list(profiles)
+        rows = [self.encode_row(p) for p in profiles]
+        return self._stack([p.user_id for p in profiles], rows)
+
+    def update(self, profile) -> bool:
+        """Add or re-encode a user's profile, returns False if its encoding did not change"""
+        row = self.encode_row(profile)
+        old = self._rows.get(profile.user_id)
+        if old is not None and all(np.array_equal(a, b) for a, b in zip(old, row)):
+            return False
+        self._rows[profile.user_id] = row
+        self._matrix = None
+        return True
+
+    def remove(self, user_id: str):
+        """Forget a user"""
+        if self._rows.pop(user_id, None) is not None:
+            self._matrix = None
+
+    def subset(self, user_ids: List[str]) -> EncodedProfiles:
+        """Stack the encoding of the given (known) users only"""
+        return self._stack(list(user_ids), [self._rows[u] for u in user_ids])
+
+    def matrix(self) -> EncodedProfiles:
+        """Return the stacked encoding of every known user, rebuilding it if stale"""
+        if self._matrix is None:
+            user_ids = list(self._rows)
+            self._matrix = self._stack(user_ids, [self._rows[u] for u in user_ids])
+        return self._matrix
+
+    def _stack(self, user_ids: List[str], rows: Sequence[tuple]) -> EncodedProfiles:
+        artists = self._count_matrix([r[0] for r in rows], len(self.vocabulary.artists))
+        genres = self._count_matrix([r[1] for r in rows], len(self.vocabulary.genres))
+        track_counts = np.array([len(r[2]) for r in rows], dtype=np.int64)
+        track_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(track_counts, out=track_indptr[1:])
+        track_cols = np.concatenate([r[2] for r in rows]) if rows else np.zeros(0, dtype=np.int64)
+        track_ratings = np.concatenate([r[3] for r in rows]) if rows else np.zeros(0)
+        return EncodedProfiles(
+            user_ids, artists, genres, track_indptr, track_cols, track_ratings,
+            artist_counts=np.array([len(r[0]) for r in rows], dtype=np.int64),
+            genre_counts=np.array([len(r[1]) for r in rows], dtype=np.int64),
+            track_counts=track_counts
+        )
+
+    @staticmethod
+    def _count_matrix(col_lists: List[np.ndarray], n_cols: int) -> sparse.csr_matrix:
+        indptr = np.zeros(len(col_lists) + 1, dtype=np.int64)
+        np.cumsum([len(c) for c in col_lists], out=indptr[1:])
+        indices = np.concatenate(col_lists) if col_lists else np.zeros(0, dtype=np.int64)
+        matrix = sparse.csr_matrix(
+            (np.ones(len(indices)), indices, indptr),
+            shape=(len(col_lists), n_cols)
+        )
+        # Repeated names in one list become counts, so pairs multiply out in the dot product
+        matrix.sum_duplicates()
+        return matrix
+
+    def score(self, profile, encoded: Optional[EncodedProfiles] = None,
+              rows: Optional[np.ndarray] = None, scorer: Optional[ScoringPipeline] = None) -> np.ndarray:
+        """
+        Compatibility of `profile` with every user in `encoded` (default: all known users),
+        or with the subset of rows given by `rows`, using the engine's scoring
+        pipeline (the weighted artist/genre/track overlap formula by default)
+        or the given one.
+        """
+        if encoded is None:
+            encoded = self.matrix()
+        if rows is None:
+            rows = np.arange(len(encoded))
+        scorer = self.scorer if scorer is None else scorer
+        encoded_row = self.encode_row(profile)
+        if not scorer.uses_idf:
+            return scorer(encoded, encoded_row, rows)
+        return scorer(encoded, encoded_row, rows, *self.idf_inputs())
+
+    def idf_inputs(self) -> tuple:
+        """(document_frequencies, idf) arguments of a ScoringPipeline for IDF kernels"""
+        if self.frequencies is not None:
+            return self.frequencies.frequencies(), self.frequencies.idf()
+        return self.document_frequencies() if len(self) else None, None
+
+    def document_frequencies(self) -> Tuple[int, Dict[str, np.ndarray]]:
+        """(number of users, {field: number of users listing each item}) over every known user"""
+        encoded = self.matrix()
+        if self._frequencies is None or self._frequencies[0] is not encoded:
+            track_counts = track_matrices(encoded)[0]
+            frequencies = {
+                field: np.bincount(matrix.indices, minlength=matrix.shape[1])
+                for field, matrix in (('artists', encoded.artists), ('genres', encoded.genres),
+                                      ('tracks', track_counts))
+            }
+            self._frequencies = (encoded, (len(encoded), frequencies))
+        return self._frequencies[1]
+
+
+def compatibility_scores(profile, candidates: Sequence, scorer: Optional[ScoringPipeline] = None) -> np.ndarray:
+    """Score one profile against a list of candidate profiles in a single batch"""
+    engine = MatchEngine(scorer=scorer)
+    return engine.score(profile, engine.encode(candidates))
@@ -0,0 +1,144 @@
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+from journal import RecordJournal
+from match_engine import KEY_FORMAT
+from scoring import DEFAULT_SCORER, FIELDS, ScoringPipeline
+
+
+def profile_entry(profile) -> Dict[str, Dict[str, int]]:
+    """Matching keys of a profile with their multiplicity, per field"""
+    artist_keys, genre_keys = profile.match_keys()
+    return {
+        'artists': dict(Counter(artist_keys)),
+        'genres': dict(Counter(genre_keys)),
+        'tracks': dict(Counter(profile.music_preferences.track_ids))
+    }
+
+
+def entry_sizes(entry: Dict[str, Dict[str, int]]) -> List[int]:
+    """Length of each list (duplicates included) the entry was built from"""
+    return [sum(entry[field].values()) for field in FIELDS]
+
+
+def score_upper_bound(pairs: List[int], own_sizes: List[int], other_sizes: List[int],
+                      scorer: Optional[ScoringPipeline] = None) -> float:
+    """
+    Highest compatibility two users can reach given their number of matching
+    (item, item) pairs per field. With the default formula artist and genre
+    scores are exact and every track pair is counted as if both ratings were
+    identical.
+    """
+    return (scorer or DEFAULT_SCORER).upper_bound(pairs, own_sizes, other_sizes)
+
+
+class InvertedIndex:
+    """Maps every artist, genre and track to the users listing it.
+
+    The index is persisted as a RecordJournal with one record per profile
+    save, so keeping it up to date costs one small append instead of
+    rewriting the whole index.
+    """
+
+    def __init__(self, index_file: str, frequencies=None):
+        self.journal = RecordJournal(index_file, version=KEY_FORMAT)
+        # Optional ItemFrequencies kept in step with every entry applied
+        self.frequencies = frequencies
+        self._reset()
+        self.refresh()
+
+    def _reset(self):
+        self.entries: Dict[str, Dict[str, Dict[str, int]]] = {}
+        self.postings: Dict[str, Dict[str, Dict[str, int]]] = {field: {} for field in FIELDS}
+        if self.frequencies is not None:
+            self.frequencies.reset()
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def exists(self) -> bool:
+        """True if the persisted index exists and uses the current key format"""
+        return self.journal.is_current()
+
+    def refresh(self):
+        """Replay journal records appended since the last read (e.g. by another manager)"""
+        restarted, records = self.journal.read()
+        if restarted:
+            self._reset()
+        for record in records:
+            self._apply(record['user_id'], None if record.get('deleted') else record['entry'])
+
+    def _apply(self, user_id: str, entry: Optional[Dict[str, Dict[str, int]]]):
+        old = self.entries.pop(user_id, None)
+        if self.frequencies is not None:
+            self.frequencies.apply(old, entry)
+        if old:
+            for field in FIELDS:
+                postings = self.postings[field]
+                for key in old[field]:
+                    users = postings.get(key)
+                    if users is not None:
+                        users.pop(user_id, None)
+                        if not users:
+                            del postings[key]
+        if entry is not None:
+            self.entries[user_id] = entry
+            for field in FIELDS:
+                postings = self.postings[field]
+                for key, count in entry[field].items():
+                    postings.setdefault(key, {})[user_id] = count
+
+    def _append(self, record: dict):
+        self.journal.append([record])
+        if self.journal.needs_compaction(len(self.entries)):
+            self.compact()
+
+    def update(self, profile) -> bool:
+        """Index (or re-index) a saved profile, returns False if its matching keys did not change"""
+        self.refresh()
+        entry = profile_entry(profile)
+        if self.entries.get(profile.user_id) == entry:
+            return False
+        self._apply(profile.user_id, entry)
+        self._append({'user_id': profile.user_id, 'entry': entry})
+        return True
+
+    def remove(self, user_id: str):
+        """Drop a deleted profile from the index"""
+        self.refresh()
+        if user_id in self.entries:
+            self._apply(user_id, None)
+            self._append({'user_id': user_id, 'deleted': True})
+
+    def compact(self):
+        """Rewrite the journal with one record per live profile"""
+        self.journal.write_all({'user_id': u, 'entry': e} for u, e in self.entries.items())
+
+    def rebuild(self, profiles: Iterable):
+        """Build the index from scratch from an iterable of profiles"""
+        self._reset()
+        for profile in profiles:
+            self._apply(profile.user_id, profile_entry(profile))
+        self.compact()
+
+    def sizes(self, user_id: str) -> List[int]:
+        return entry_sizes(self.entries[user_id])
+
+    def overlaps(self, entry: Dict[str, Dict[str, int]]) -> Dict[str, List[int]]:
+        """
+        Number of matching (item, item) pairs per field between `entry` and every
+        user sharing at least one item with it. Cost is proportional to the
+        size of the posting lists touched, not to the number of users.
+        """
+        pairs: Dict[str, List[int]] = {}
+        for position, field in enumerate(FIELDS):
+            postings = self.postings[field]
+            for key, count in entry[field].items():
+                for user_id, other_count in postings.get(key, {}).items():
+                    user_pairs = pairs.get(user_id)
+                    if user_pairs is None:
+                        user_pairs = pairs[user_id] = [0, 0, 0]
+                    user_pairs[position] += count * other_count
+        return pairs
@@ -0,0 +1,206 @@
+import argparse
+import bisect
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from journal import RecordJournal
+from match_engine import KEY_FORMAT
+
+Row = List[Tuple[str, float]]
+
+
+class MatchTable:
+    """Materialized top-K match partners of every user.
+
+    Each row holds a user's best partners (score >= min_compatibility) sorted
+    by descending score. Rows are persisted in a RecordJournal so saving one
+    profile only appends the rows it changed. Compatibility is symmetric, so
+    re-scoring a user updates both its own row and its entry in other users'
+    rows. A row that lost an entry while full may be missing a partner that
+    was just below the cut; it is marked incomplete and recomputed the next
+    time it is looked up.
+
+    `k` and `min_compatibility` are saved in the journal header: an existing
+    table keeps the settings it was built with, whatever is passed here.
+    Change them only before a `rebuild`, which stores the new settings.
+    """
+
+    def __init__(self, table_file: str, k: int = 50, min_compatibility: float = 0.5):
+        self.journal = RecordJournal(table_file, version=KEY_FORMAT)
+        self.k = k
+        self.min_compatibility = min_compatibility
+        self._file_settings = {}
+        self._reset()
+        self.refresh()
+
+    def _reset(self):
+        self.rows: Dict[str, Row] = {}
+        self.incomplete: Set[str] = set()
+        # user_id -> users whose row lists it, to update columns quickly
+        self.listed_by: Dict[str, Set[str]] = {}
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self.rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def exists(self) -> bool:
+        """True if the persisted table exists and was scored with the current key format"""
+        return self.journal.is_current()
+
+    def refresh(self):
+        """Replay rows written since the last read (e.g. by another manager)"""
+        restarted, records = self.journal.read()
+        if restarted:
+            self._reset()
+        # Rows were cut with the settings of whoever built the table; adopt them when they
+        # change on disk, so settings assigned ahead of a rebuild are not reverted meanwhile
+        file_settings = {name: self.journal.file_header[name]
+                         for name in ('k', 'min_compatibility') if name in self.journal.file_header}
+        if file_settings != self._file_settings:
+            self._file_settings = file_settings
+            self.k = file_settings.get('k', self.k)
+            self.min_compatibility = file_settings.get('min_compatibility', self.min_compatibility)
+        for record in records:
+            if record.get('deleted'):
+                self._set_row(record['user_id'], None)
+            else:
+                row = [(other_id, score) for other_id, score in record['row']]
+                self._set_row(record['user_id'], row, record.get('complete', True))
+
+    def _set_row(self, user_id: str, row: Optional[Row], complete: bool = True):
+        for other_id, _ in self.rows.pop(user_id, []):
+            listed = self.listed_by.get(other_id)
+            if listed is not None:
+                listed.discard(user_id)
+                if not listed:
+                    del self.listed_by[other_id]
+        self.incomplete.discard(user_id)
+        if row is None:
+            return
+        self.rows[user_id] = row
+        for other_id, _ in row:
+            self.listed_by.setdefault(other_id, set()).add(user_id)
+        if not complete:
+            self.incomplete.add(user_id)
+
+    def _record(self, user_id: str) -> dict:
+        if user_id not in self.rows:
+            return {'user_id': user_id, 'deleted': True}
+        return {
+            'user_id': user_id,
+            'row': [[other_id, score] for other_id, score in self.rows[user_id]],
+            'complete': user_id not in self.incomplete
+        }
+
+    def _settings(self) -> dict:
+        return {'k': self.k, 'min_compatibility': self.min_compatibility}
+
+    def _persist(self, user_ids: Iterable[str]):
+        # Only used when the append starts a new file
+        self.journal.header = self._settings()
+        self.journal.append(self._record(user_id) for user_id in user_ids)
+        if self.journal.needs_compaction(len(self.rows)):
+            self.compact()
+
+    def get(self, user_id: str) -> Optional[Row]:
+        """A user's (partner_id, score) row, or None if it is missing or incomplete"""
+        self.refresh()
+        if user_id in self.incomplete:
+            return None
+        return self.rows.get(user_id)
+
+    def top_k(self, scores: Iterable[Tuple[str, float]]) -> Row:
+        """Keep the k best (user_id, score) pairs reaching the threshold, best first"""
+        row = [(u, s) for u, s in scores if s >= self.min_compatibility]
+        row.sort(key=lambda x: x[1], reverse=True)
+        return row[:self.k]
+
+    def put(self, user_id: str, row: Row):
+        """Store a freshly computed, complete row"""
+        self.refresh()
+        self._set_row(user_id, row)
+        self._persist([user_id])
+
+    def update_user(self, user_id: str, scores: Dict[str, float]):
+        """
+        Apply a re-scored user: `scores` holds its compatibility with every user
+        that can reach the threshold. Rewrites the user's row and patches the
+        user's entry in every other row (its column).
+        """
+        self.refresh()
+        self._set_row(user_id, self.top_k(scores.items()))
+        changed = {user_id}
+        for other_id in set(self.listed_by.get(user_id, ())) | set(scores):
+            if other_id != user_id and other_id in self.rows and \
+                    self._offer(other_id, user_id, scores.get(other_id, 0.0)):
+                changed.add(other_id)
+        self._persist(changed)
+
+    def _offer(self, user_id: str, partner_id: str, score: float) -> bool:
+        """Update partner_id's entry in user_id's row, returns True if the row changed"""
+        row = self.rows[user_id]
+        full = len(row) >= self.k
+        old = next((s for u, s in row if u == partner_id), None)
+        if old == score or (old is None and score < self.min_compatibility):
+            return False
+        if old is not None:
+            row = [(u, s) for u, s in row if u != partner_id]
+            if full and score < old:
+                # Someone just below the cut may now belong in the row
+                self.incomplete.add(user_id)
+        elif full and score <= row[-1][1]:
+            return False
+        if score >= self.min_compatibility:
+            scores = [-s for _, s in row]
+            row.insert(bisect.bisect_right(scores, -score), (partner_id, score))
+            if len(row) > self.k:
+                row.pop()
+        complete = user_id not in self.incomplete
+        self._set_row(user_id, row, complete)
+        return True
+
+    def remove(self, user_id: str):
+        """Forget a deleted user and take it out of every row listing it"""
+        self.refresh()
+        changed = {user_id}
+        for other_id in list(self.listed_by.get(user_id, ())):
+            if other_id in self.rows:
+                full = len(self.rows[other_id]) >= self.k
+                row = [(u, s) for u, s in self.rows[other_id] if u != user_id]
+                self._set_row(other_id, row, complete=not full and other_id not in self.incomplete)
+                changed.add(other_id)
+        self._set_row(user_id, None)
+        self._persist(changed)
+
+    def compact(self):
+        """Rewrite the journal with one record per row"""
+        self.journal.header = self._settings()
+        self.journal.write_all(self._record(user_id) for user_id in list(self.rows))
+        self._file_settings = self._settings()
+
+    def rebuild(self, rows: Iterable[Tuple[str, Row]]):
+        """Replace the whole table, e.g. from a batch job"""
+        self._reset()
+        for user_id, row in rows:
+            self._set_row(user_id, row)
+        self.compact()
+
+
+def main():
+    from user_profile import UserProfileManager
+
+    parser = argparse.ArgumentParser(description="Rebuild the materialized match table from every profile")
+    parser.add_argument('--storage-dir', default='data/profiles')
+    parser.add_argument('--k', type=int, default=50, help="Partners kept per user")
+    parser.add_argument('--min-compatibility', type=float, default=0.5)
+    args = parser.parse_args()
+
+    profile_manager = UserProfileManager(storage_dir=args.storage_dir)
+    profile_manager.match_table.k = args.k
+    profile_manager.match_table.min_compatibility = args.min_compatibility
+    profile_manager.build_match_table()
+    print(f"Match table rebuilt for {len(profile_manager.match_table)} users")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import hashlib
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Sequence, Set
+from journal import RecordJournal
+from match_engine import KEY_FORMAT
+from match_index import FIELDS, profile_entry
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+class MinHasher:
+    """Computes MinHash signatures of string sets with a fixed family of hash permutations."""
+
+    def __init__(self, num_perm: int = 64, seed: int = 1):
+        self.num_perm = num_perm
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+        self._token_hashes: Dict[str, int] = {}
+
+    def token_hash(self, token: str) -> int:
+        """Stable 32-bit hash of a token (Python's str hash changes between runs)"""
+        value = self._token_hashes.get(token)
+        if value is None:
+            digest = hashlib.blake2b(token.encode(), digest_size=4).digest()
+            value = self._token_hashes[token] = int.from_bytes(digest, 'little')
+        return value
+
+    def _permute(self, hashes: np.ndarray) -> np.ndarray:
+        """Apply every permutation to every hash: (num_perm, len(hashes))"""
+        return (np.outer(self.a, hashes) + self.b[:, None]) % MERSENNE_PRIME & MAX_HASH
+
+    def signature(self, tokens: Iterable[str]) -> Optional[np.ndarray]:
+        """MinHash signature of a set of tokens, None for an empty set"""
+        hashes = np.fromiter((self.token_hash(t) for t in set(tokens)), dtype=np.uint64)
+        if not len(hashes):
+            return None
+        return self._permute(hashes).min(axis=1).astype(np.uint32)
+
+    def signatures(self, token_sets: Sequence[Iterable[str]], chunk_size: int = 4096) -> np.ndarray:
+        """
+        Signatures of many sets at once, shape (len(token_sets), num_perm).
+        Rows of empty sets are left at the maximum hash value.
+        """
+        result = np.full((len(token_sets), self.num_perm), int(MAX_HASH), dtype=np.uint32)
+        for start in range(0, len(token_sets), chunk_size):
+            chunk = [list({self.token_hash(t) for t in tokens}) for tokens in token_sets[start:start + chunk_size]]
+            lengths = np.array([len(c) for c in chunk])
+            rows = np.flatnonzero(lengths)
+            if not len(rows):
+                continue
+            hashes = np.fromiter((h for c in chunk for h in c), dtype=np.uint64)
+            offsets = np.concatenate(([0], np.cumsum(lengths[rows])[:-1]))
+            minima = np.minimum.reduceat(self._permute(hashes), offsets, axis=1)
+            result[start + rows] = minima.T.astype(np.uint32)
+        return result
+
+
+class MinHashLSH:
+    """Banded LSH index over MinHash signatures of each profile's artist, genre and track sets.
+
+    A profile is a candidate for another when, for at least one field, both
+    signatures agree on every row of some band. With the default 16 bands of
+    4 rows, sets with a Jaccard similarity above ~0.5 collide with high
+    probability while unrelated sets almost never do. Signatures are persisted
+    in a RecordJournal when `index_file` is given; the buckets are rebuilt in
+    memory from them.
+    """
+
+    def __init__(self, index_file: Optional[str] = None, num_perm: int = 64, bands: int = 16, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.hasher = MinHasher(num_perm, seed)
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        self.journal = RecordJournal(index_file, version=KEY_FORMAT) if index_file else None
+        self._reset()
+        self.refresh()
+
+    def _reset(self):
+        self.signatures: Dict[str, Dict[str, Optional[np.ndarray]]] = {}
+        self.buckets: Dict[str, List[Dict[bytes, Set[str]]]] = {
+            field: [{} for _ in range(self.bands)] for field in FIELDS
+        }
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self.signatures
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    def exists(self) -> bool:
+        return self.journal is None or self.journal.is_current()
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        r = self.rows_per_band
+        return [signature[band * r:(band + 1) * r].tobytes() for band in range(self.bands)]
+
+    def profile_signatures(self, profile) -> Dict[str, Optional[np.ndarray]]:
+        entry = profile_entry(profile)
+        return {field: self.hasher.signature(entry[field]) for field in FIELDS}
+
+    def insert(self, user_id: str, signatures: Dict[str, Optional[np.ndarray]]):
+        """Add (or replace) a user's signatures in the buckets"""
+        self._discard(user_id)
+        self.signatures[user_id] = signatures
+        for field, signature in signatures.items():
+            if signature is None:
+                continue
+            for bucket, key in zip(self.buckets[field], self._band_keys(signature)):
+                bucket.setdefault(key, set()).add(user_id)
+
+    def _discard(self, user_id: str):
+        old = self.signatures.pop(user_id, None)
+        if not old:
+            return
+        for field, signature in old.items():
+            if signature is None:
+                continue
+            for bucket, key in zip(self.buckets[field], self._band_keys(signature)):
+                users = bucket.get(key)
+                if users is not None:
+                    users.discard(user_id)
+                    if not users:
+                        del bucket[key]
+
+    def query_signatures(self, signatures: Dict[str, Optional[np.ndarray]]) -> Set[str]:
+        """Users colliding with the given signatures in at least one band of one field"""
+        candidates = set()
+        for field, signature in signatures.items():
+            if signature is None:
+                continue
+            for bucket, key in zip(self.buckets[field], self._band_keys(signature)):
+                candidates.update(bucket.get(key, ()))
+        return candidates
+
+    def query(self, profile) -> Set[str]:
+        """Likely high-Jaccard matches of a profile (excluding itself)"""
+        self.refresh()
+        candidates = self.query_signatures(self.profile_signatures(profile))
+        candidates.discard(profile.user_id)
+        return candidates
+
+    @staticmethod
+    def _record(user_id: str, signatures: Dict[str, Optional[np.ndarray]]) -> dict:
+        return {
+            'user_id': user_id,
+            'signatures': {f: None if s is None else s.tolist() for f, s in signatures.items()}
+        }
+
+    def refresh(self):
+        """Replay signatures written since the last read (e.g. by another manager)"""
+        if self.journal is None:
+            return
+        restarted, records = self.journal.read()
+        if restarted:
+            self._reset()
+        for record in records:
+            if record.get('deleted'):
+                self._discard(record['user_id'])
+            else:
+                self.insert(record['user_id'], {
+                    f: None if s is None else np.array(s, dtype=np.uint32)
+                    for f, s in record['signatures'].items()
+                })
+
+    def update(self, profile):
+        """Re-sign a saved profile"""
+        self.refresh()
+        signatures = self.profile_signatures(profile)
+        self.insert(profile.user_id, signatures)
+        if self.journal is not None:
+            self.journal.append([self._record(profile.user_id, signatures)])
+            if self.journal.needs_compaction(len(self.signatures)):
+                self.compact()
+
+    def remove(self, user_id: str):
+        self.refresh()
+        if user_id in self.signatures:
+            self._discard(user_id)
+            if self.journal is not None:
+                self.journal.append([{'user_id': user_id, 'deleted': True}])
+
+    def compact(self):
+        if self.journal is not None:
+            self.journal.write_all(self._record(u, s) for u, s in self.signatures.items())
+
+    def rebuild(self, profiles: Iterable):
+        """Sign every profile from scratch, batching the MinHash computation per field"""
+        profiles = list(profiles)
+        entries = [profile_entry(p) for p in profiles]
+        per_field = {field: self.hasher.signatures([e[field] for e in entries]) for field in FIELDS}
+        self._reset()
+        for row, profile in enumerate(profiles):
+            self.insert(profile.user_id, {
+                field: per_field[field][row] if entries[row][field] else None for field in FIELDS
+            })
+        self.compact()
@@ -0,0 +1,104 @@
+"""
+Password hashes that carry their algorithm, cost and salt.
+
+Stored hashes look like
+
+    $scrypt$n=32768,r=8,p=1$<salt>$<hash>
+    $pbkdf2-sha256$i=600000$<salt>$<hash>
+
+(salt and hash in unpadded base64), so the cost can be raised later
+without breaking existing accounts: `needs_rehash` tells AuthManager to
+re-hash a password with the current settings on the next successful login.
+Accounts created before these hashes (one SHA-256 of password + salt, the
+salt in a separate field) are still verified, and upgraded the same way.
+
+The cost is chosen to take a few hundred milliseconds on the deployment
+machine: run benchmarks/password_hashing.py there and put the result in
+config.PASSWORD_HASHING. Hashing is slow on purpose, so UI code runs it
+off the Tk main loop (see auth_window).
+"""
+import base64
+import hashlib
+import hmac
+import secrets
+from typing import Dict, Optional, Tuple
+
+SCHEMES = ('scrypt', 'pbkdf2-sha256')
+DEFAULT_SCRYPT = {'n': 2 ** 15, 'r': 8, 'p': 1}
+DEFAULT_PBKDF2_ITERATIONS = 600_000
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    # scrypt needs about 128 * r * n bytes; OpenSSL refuses anything above 32 MiB by default
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * r * (n + p) + (1 << 20), dklen=HASH_BYTES)
+
+
+def _pbkdf2(password: str, salt: bytes, iterations: int) -> bytes:
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations, dklen=HASH_BYTES)
+
+
+def legacy_hash(password: str, salt: str) -> str:
+    """The original scheme: a single hex SHA-256 of password + salt"""
+    return hashlib.sha256((password + salt).encode()).hexdigest()
+
+
+def parse(stored: str) -> Optional[Tuple[str, Dict[str, int], bytes, bytes]]:
+    """(scheme, parameters, salt, hash) of a stored hash, None for a legacy one"""
+    if not stored.startswith('$'):
+        return None
+    _, scheme, params, salt, digest = stored.split('$')
+    parameters = {key: int(value) for key, value in (item.split('=') for item in params.split(','))}
+    return scheme, parameters, _b64decode(salt), _b64decode(digest)
+
+
+class PasswordHasher:
+    """Hashes with the configured scheme and cost and verifies hashes of any supported scheme"""
+
+    def __init__(self, scheme: str = 'scrypt', n: int = DEFAULT_SCRYPT['n'], r: int = DEFAULT_SCRYPT['r'],
+                 p: int = DEFAULT_SCRYPT['p'], iterations: int = DEFAULT_PBKDF2_ITERATIONS):
+        if scheme not in SCHEMES:
+            raise ValueError(f"Unknown password hashing scheme '{scheme}'")
+        if scheme == 'scrypt' and (n < 2 or n & (n - 1)):
+            raise ValueError("scrypt n must be a power of two")
+        self.scheme = scheme
+        self.parameters = {'n': n, 'r': r, 'p': p} if scheme == 'scrypt' else {'i': iterations}
+
+    def hash(self, password: str) -> str:
+        salt = secrets.token_bytes(SALT_BYTES)
+        digest = self._derive(self.scheme, self.parameters, password, salt)
+        params = ','.join(f'{key}={value}' for key, value in self.parameters.items())
+        return f'${self.scheme}${params}${_b64encode(salt)}${_b64encode(digest)}'
+
+    @staticmethod
+    def _derive(scheme: str, parameters: Dict[str, int], password: str, salt: bytes) -> bytes:
+        if scheme == 'scrypt':
+            return _scrypt(password, salt, parameters['n'], parameters['r'], parameters['p'])
+        if scheme == 'pbkdf2-sha256':
+            return _pbkdf2(password, salt, parameters['i'])
+        raise ValueError(f"Unknown password hashing scheme '{scheme}'")
+
+    def verify(self, password: str, stored: str, legacy_salt: Optional[str] = None) -> bool:
+        """Check a password against a stored hash (`legacy_salt`: the salt field of a legacy hash)"""
+        parsed = parse(stored)
+        if parsed is None:
+            if legacy_salt is None:
+                return False
+            return hmac.compare_digest(legacy_hash(password, legacy_salt), stored)
+        scheme, parameters, salt, digest = parsed
+        return hmac.compare_digest(self._derive(scheme, parameters, password, salt), digest)
+
+    def needs_rehash(self, stored: str) -> bool:
+        """True if a stored hash uses another scheme or cost than this hasher"""
+        parsed = parse(stored)
+        return parsed is None or parsed[0] != self.scheme or parsed[1] != self.parameters
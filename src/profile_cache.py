@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from typing import Dict, Hashable
+
+
+class ProfileCache:
+    """Bounded LRU cache of parsed profiles, validated against the store's version token.
+
+    An entry is only returned while the version it was cached with is still
+    the profile's current version (file mtime and size for JSON profiles), so
+    a profile rewritten by another process or by hand is re-read. Hits,
+    misses and stale entries are counted for `stats`.
+    """
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._entries
+
+    def get(self, user_id: str, version: Hashable):
+        """The cached profile if it was cached at `version`, else None"""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            if entry[0] == version:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            # Changed behind our back
+            del self._entries[user_id]
+            self.stale += 1
+        self.misses += 1
+        return None
+
+    def peek(self, user_id: str, version: Hashable):
+        """Like get, without counting the lookup or refreshing the entry's recency"""
+        entry = self._entries.get(user_id)
+        return entry[1] if entry is not None and entry[0] == version else None
+
+    def put(self, user_id: str, version: Hashable, profile):
+        if self.max_size <= 0:
+            return
+        self._entries[user_id] = (version, profile)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def discard(self, user_id: str):
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
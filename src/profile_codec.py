@@ -0,0 +1,214 @@
+"""
+Compact binary profile format.
+
+Layout (little-endian):
+
+    header   magic b'TMPF', format version (u16), flags (u16), age (i32),
+             string blob length (u32), count array length (u32), rating count (u32)
+    strings  every string of the profile, UTF-8, NUL-separated
+    counts   u32 list lengths: preferences, top artists/genres, the four
+             favorite lists, then the number of artists of each preference
+    ratings  float64 rating of each preference (float32 in format version 1)
+
+A second, smaller record holds only what matching reads (see
+`match_features`): the normalization-free artist, genre and top album
+names, the rated track ids and their float64 ratings, tagged with the
+version of the profile it was derived from. File stores keep it in a
+sidecar next to each profile so match scans never parse whole profiles.
+
+Preferences are stored column by column (track ids, names, albums, artists,
+ratings) and all strings are decoded with one `bytes.decode` and one
+`str.split`, so decoding costs a handful of C calls instead of a JSON parse.
+Top songs and albums are free-form Spotify dicts and travel as one compact
+JSON string. Ratings keep full float64 precision, so a decoded profile
+scores exactly like its feature record.
+
+`decode` returns a profile dict whose 'music_preferences' is columnar
+({'track_id': [...], 'name': [...], 'artists': [...], 'album': [...],
+'rating': [...]}); UserProfile.from_dict accepts both shapes and
+`preference_columns` converts either shape to columns.
+"""
+import argparse
+import json
+import os
+import struct
+import sys
+from array import array
+from typing import Dict, List, Tuple
+
+MAGIC = b'TMPF'
+FORMAT_VERSION = 2
+FLAG_HAS_AGE = 1
+
+_HEADER = struct.Struct('<4sHHiIII')
+FEATURES_MAGIC = b'TMMF'
+# magic, format version, profile version (two ints), string blob length, artist/genre/album/track counts
+_FEATURES_HEADER = struct.Struct('<4sHqqIIIII')
+SCALAR_FIELDS = ('user_id', 'username', 'first_name', 'last_name', 'gender', 'location', 'bio', 'profile_picture_path')
+STRING_LISTS = ('top_artists', 'top_genres', 'favorite_artists', 'favorite_songs', 'favorite_genres', 'favorite_albums')
+PREFERENCE_FIELDS = ('track_id', 'name', 'artists', 'album', 'rating')
+
+
+def is_binary(data: bytes) -> bool:
+    return data[:4] == MAGIC
+
+
+def preference_columns(preferences) -> Dict[str, list]:
+    """Columns of music_preferences given as a list of dicts or already columnar"""
+    if isinstance(preferences, dict):
+        return preferences
+    return {field: [p[field] for p in preferences] for field in PREFERENCE_FIELDS}
+
+
+def _little_endian(values: array) -> array:
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def encode(data: dict) -> bytes:
+    """
+    Encode a profile dict (UserProfile.to_dict). Raises ValueError for
+    profiles this format cannot hold (strings containing NUL, an age that is
+    not a 32-bit integer); callers should keep those as JSON.
+    """
+    age = data.get('age')
+    if age is not None and not (isinstance(age, int) and -2 ** 31 <= age < 2 ** 31):
+        raise ValueError(f"Age {age!r} does not fit the binary profile format")
+    columns = preference_columns(data.get('music_preferences', []))
+    strings: List[str] = [data.get(field) or '' for field in SCALAR_FIELDS]
+    strings += columns['track_id']
+    strings += columns['name']
+    strings += columns['album']
+    for artists in columns['artists']:
+        strings += artists
+    string_lists = [data.get(field) or [] for field in STRING_LISTS]
+    for values in string_lists:
+        strings += values
+    strings.append(json.dumps([data.get('top_songs') or [], data.get('top_albums') or []], separators=(',', ':')))
+    blob = _join(strings)
+
+    counts = array('I', [len(columns['track_id'])] + [len(values) for values in string_lists])
+    counts.extend(len(artists) for artists in columns['artists'])
+    ratings = array('d', columns['rating'])
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, FLAG_HAS_AGE if age is not None else 0, age or 0,
+                          len(blob), len(counts), len(ratings))
+    return b''.join((header, blob, _little_endian(counts).tobytes(), _little_endian(ratings).tobytes()))
+
+
+def decode(data: bytes) -> dict:
+    """Decode a binary profile, with columnar music_preferences"""
+    magic, version, flags, age, blob_size, n_counts, n_ratings = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a binary profile")
+    if version > FORMAT_VERSION:
+        raise ValueError(f"Unsupported profile format version {version}")
+    offset = _HEADER.size
+    strings = data[offset:offset + blob_size].decode('utf-8').split('\x00')
+    offset += blob_size
+    counts = array('I')
+    counts.frombytes(data[offset:offset + 4 * n_counts])
+    offset += 4 * n_counts
+    ratings = array('f' if version == 1 else 'd')
+    ratings.frombytes(data[offset:offset + ratings.itemsize * n_ratings])
+    counts = _little_endian(counts).tolist()
+
+    profile = dict(zip(SCALAR_FIELDS, strings))
+    profile['age'] = age if flags & FLAG_HAS_AGE else None
+    n = counts[0]
+    position = len(SCALAR_FIELDS)
+    track_ids = strings[position:position + n]
+    names = strings[position + n:position + 2 * n]
+    albums = strings[position + 2 * n:position + 3 * n]
+    position += 3 * n
+    artists = []
+    for count in counts[len(STRING_LISTS) + 1:]:
+        artists.append(strings[position:position + count])
+        position += count
+    profile['music_preferences'] = {
+        'track_id': track_ids,
+        'name': names,
+        'artists': artists,
+        'album': albums,
+        'rating': _little_endian(ratings).tolist()
+    }
+    for field, count in zip(STRING_LISTS, counts[1:]):
+        profile[field] = strings[position:position + count]
+        position += count
+    profile['top_songs'], profile['top_albums'] = json.loads(strings[position])
+    return profile
+
+
+def _join(strings: List[str]) -> bytes:
+    if not all(isinstance(s, str) for s in strings):
+        raise ValueError("Profile contains non-string names")
+    blob = '\x00'.join(strings)
+    if blob.count('\x00') != len(strings) - 1:
+        raise ValueError("Profile strings contain NUL characters")
+    return blob.encode('utf-8')
+
+
+def match_features(data: dict) -> dict:
+    """The parts of a profile dict used for matching, as stored in feature records"""
+    columns = preference_columns(data.get('music_preferences', []))
+    return {
+        'user_id': data['user_id'],
+        'top_artists': list(data.get('top_artists') or []),
+        'top_genres': list(data.get('top_genres') or []),
+        'albums': [a['name'] for a in data.get('top_albums') or [] if a.get('name')],
+        'track_ids': list(columns['track_id']),
+        'ratings': list(columns['rating'])
+    }
+
+
+def encode_features(features: dict, version: Tuple[int, int]) -> bytes:
+    """Encode match features derived from the profile stored at `version`; ValueError as for `encode`"""
+    lists = [features['top_artists'], features['top_genres'], features['albums'], features['track_ids']]
+    blob = _join([features['user_id']] + [s for values in lists for s in values])
+    header = _FEATURES_HEADER.pack(FEATURES_MAGIC, FORMAT_VERSION, version[0], version[1], len(blob),
+                                   *map(len, lists))
+    return b''.join((header, blob, _little_endian(array('d', features['ratings'])).tobytes()))
+
+
+def decode_features(data: bytes) -> Tuple[Tuple[int, int], dict]:
+    """(profile version, match features) of a feature record"""
+    magic, version, mtime, size, blob_size, *counts = _FEATURES_HEADER.unpack_from(data)
+    if magic != FEATURES_MAGIC or version > FORMAT_VERSION:
+        raise ValueError("Not a match feature record")
+    offset = _FEATURES_HEADER.size
+    strings = data[offset:offset + blob_size].decode('utf-8').split('\x00')
+    ratings = array('d')
+    ratings.frombytes(data[offset + blob_size:offset + blob_size + 8 * counts[3]])
+    features = {'user_id': strings[0]}
+    position = 1
+    for field, count in zip(('top_artists', 'top_genres', 'albums', 'track_ids'), counts):
+        features[field] = strings[position:position + count]
+        position += count
+    features['ratings'] = _little_endian(ratings)
+    return (mtime, size), features
+
+
+def loads(data: bytes) -> dict:
+    """Decode a stored profile in either format: binary or (legacy) JSON"""
+    if is_binary(data):
+        return decode(data)
+    return json.loads(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a directory of JSON profiles to the binary format")
+    parser.add_argument('--storage-dir', default='data/profiles')
+    args = parser.parse_args()
+
+    from profile_store import BinaryProfileStore
+    store = BinaryProfileStore(args.storage_dir)
+    converted = 0
+    for user_id in store.user_ids():
+        if os.path.exists(store.json_path(user_id)):
+            store.write(user_id, store.read(user_id))
+            converted += 1
+    print(f"Converted {converted} profiles in {args.storage_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Hash-prefix sharded directory layout for the file profile stores.
+
+A flat storage directory holds <user_id>.json (or .profile) files side by
+side, and listing or looking up entries slows down once it holds millions of
+them. In the sharded layout every file of a user lives in
+<storage_dir>/ab/cd/, where abcd are the first hex digits of the SHA-1 of
+the user id, so no directory holds more than a few hundred entries at a
+million users. The set of user ids is kept in a manifest (a RecordJournal,
+manifest.jsonl) so enumerating profiles never walks the tree.
+
+`python profile_layout.py --storage-dir data/profiles` migrates a flat
+directory online: the manifest is written first, after which stores opened
+on the directory use the sharded layout and fall back to the flat path of
+files not moved yet; files are then moved with atomic renames. Processes
+still running with the flat layout should be restarted afterwards (running
+the command again moves anything they wrote meanwhile).
+"""
+import argparse
+import hashlib
+import os
+import threading
+from typing import Dict, Iterable, List, Optional
+from journal import RecordJournal
+
+MANIFEST = 'manifest.jsonl'
+LAYOUT_VERSION = 1
+# Files a store keeps per user, in any layout
+PROFILE_EXTENSIONS = ('.json', '.profile')
+USER_FILE_EXTENSIONS = PROFILE_EXTENSIONS + ('.features',)
+
+
+def shard_dir(storage_dir: str, user_id: str) -> str:
+    digest = hashlib.sha1(user_id.encode('utf-8')).hexdigest()
+    return os.path.join(storage_dir, digest[:2], digest[2:4])
+
+
+def is_sharded(storage_dir: str) -> bool:
+    return os.path.exists(os.path.join(storage_dir, MANIFEST))
+
+
+def flat_files(storage_dir: str) -> Iterable[str]:
+    """Names of per-user files left at the top of the storage directory"""
+    with os.scandir(storage_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(USER_FILE_EXTENSIONS) and entry.is_file():
+                yield entry.name
+
+
+class ShardedLayout:
+    """File paths and manifest of a sharded storage directory"""
+
+    def __init__(self, storage_dir: str):
+        self.storage_dir = storage_dir
+        self.journal = RecordJournal(os.path.join(storage_dir, MANIFEST), version=LAYOUT_VERSION)
+        if not self.journal.exists():
+            self.journal.write_all([])
+        self._user_ids: Dict[str, None] = {}
+        # The write-behind thread registers users while readers list them
+        self._lock = threading.Lock()
+        self._created_dirs = set()
+        # Files of a migration in progress may still be at the top level
+        self.flat_fallback = next(iter(flat_files(storage_dir)), None) is not None
+
+    def path(self, user_id: str, extension: str, create: bool = False) -> str:
+        directory = shard_dir(self.storage_dir, user_id)
+        if create and directory not in self._created_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._created_dirs.add(directory)
+        return os.path.join(directory, f"{user_id}{extension}")
+
+    def flat_path(self, user_id: str, extension: str) -> str:
+        return os.path.join(self.storage_dir, f"{user_id}{extension}")
+
+    def locate(self, user_id: str, extension: str) -> str:
+        """Path of a user's existing file, during a migration possibly the flat one"""
+        path = self.path(user_id, extension)
+        if not self.flat_fallback or os.path.exists(path):
+            return path
+        flat = self.flat_path(user_id, extension)
+        # If neither exists the file may have been moved in between: the sharded path is right
+        return flat if os.path.exists(flat) else path
+
+    def _refresh(self):
+        restarted, records = self.journal.read()
+        if restarted:
+            self._user_ids.clear()
+        for record in records:
+            if record.get('deleted'):
+                self._user_ids.pop(record['user_id'], None)
+            else:
+                self._user_ids[record['user_id']] = None
+
+    def user_ids(self) -> List[str]:
+        with self._lock:
+            self._refresh()
+            return list(self._user_ids)
+
+    def add(self, user_ids: Iterable[str]):
+        """Record users in the manifest (before their files are written)"""
+        with self._lock:
+            self._refresh()
+            new = [u for u in dict.fromkeys(user_ids) if u not in self._user_ids]
+            self.journal.append({'user_id': u} for u in new)
+            self._user_ids.update(dict.fromkeys(new))
+
+    def remove(self, user_id: str):
+        with self._lock:
+            self._refresh()
+            if self._user_ids.pop(user_id, 0) is None:
+                self.journal.append([{'user_id': user_id, 'deleted': True}])
+                if self.journal.needs_compaction(len(self._user_ids)):
+                    self.journal.write_all({'user_id': u} for u in self._user_ids)
+
+
+def open_layout(storage_dir: str, layout: Optional[str] = None) -> Optional[ShardedLayout]:
+    """
+    ShardedLayout for 'sharded', None for 'flat'; by default whatever the
+    directory uses (sharded once it has a manifest).
+    """
+    if layout is None:
+        layout = 'sharded' if is_sharded(storage_dir) else 'flat'
+    if layout == 'flat':
+        return None
+    if layout != 'sharded':
+        raise ValueError(f"Unknown profile layout: {layout!r}")
+    if not is_sharded(storage_dir) and next(iter(flat_files(storage_dir)), None) is not None:
+        raise ValueError(f"{storage_dir} holds flat profiles; migrate it with profile_layout.py first")
+    return ShardedLayout(storage_dir)
+
+
+def _move(source: str, target: str):
+    """Move a flat file into its shard; if both exist the newer one wins"""
+    try:
+        if os.stat(target).st_mtime_ns >= os.stat(source).st_mtime_ns:
+            os.remove(source)
+            return
+    except FileNotFoundError:
+        pass
+    try:
+        os.replace(source, target)
+    except FileNotFoundError:
+        # Rewritten or deleted by a store in the meantime
+        pass
+
+
+def migrate_to_sharded(storage_dir: str) -> int:
+    """Move every flat per-user file into the sharded layout, returns the number of files moved"""
+    names = list(flat_files(storage_dir))
+    layout = ShardedLayout(storage_dir)
+    moved = 0
+    while names:
+        stems = [os.path.splitext(name) for name in names]
+        layout.add(stem for stem, extension in stems if extension in PROFILE_EXTENSIONS)
+        for stem, extension in stems:
+            _move(os.path.join(storage_dir, stem + extension), layout.path(stem, extension, create=True))
+            moved += 1
+        # Files written meanwhile by processes still using the flat layout
+        names = list(flat_files(storage_dir))
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate a flat profile directory to the sharded layout")
+    parser.add_argument('--storage-dir', default='data/profiles')
+    args = parser.parse_args()
+
+    moved = migrate_to_sharded(args.storage_dir)
+    print(f"Moved {moved} files of {args.storage_dir} into the sharded layout")
+
+
+if __name__ == "__main__":
+    main()
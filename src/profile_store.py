@@ -0,0 +1,585 @@
+"""
+Profile storage backends used by UserProfileManager.
+
+A store keeps profiles as plain dicts (UserProfile.to_dict) and gives every
+stored profile a version token that changes on each write, which the
+manager uses to notice profiles changed by another process.
+
+JsonProfileStore is the original one-file-per-user layout and BinaryProfileStore
+the same layout in the compact profile_codec format. SqliteProfileStore
+keeps every profile in one SQLite database in WAL mode, with preferences,
+top items and favorites in their own indexed tables, so bulk scans are a few
+sequential queries and readers never block the writer.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import struct
+import threading
+import profile_codec
+from profile_layout import open_layout
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Dict keys of UserProfile.to_dict stored as rows of top_items / favorites
+TOP_KINDS = ('artists', 'genres', 'songs', 'albums')
+FAVORITE_KINDS = ('artists', 'songs', 'genres', 'albums')
+PROFILE_COLUMNS = (
+    'user_id', 'username', 'first_name', 'last_name', 'age', 'gender', 'location', 'bio', 'profile_picture_path'
+)
+
+
+def _write_atomic(path: str, payload: bytes, durable: bool = True) -> Tuple[int, int]:
+    """
+    Write a file atomically: a crash leaves either the old or the new file,
+    never a truncated one. Returns the (mtime, size) version of the written
+    file, which the rename keeps.
+    """
+    temp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_file, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            if durable:
+                os.fsync(f.fileno())
+            stat = os.fstat(f.fileno())
+        os.replace(temp_file, path)
+        return stat.st_mtime_ns, stat.st_size
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class JsonProfileStore:
+    """One pretty-printed <user_id>.json file per profile, versioned by file mtime and size.
+
+    Every write also stores the profile's match features (profile_codec.
+    match_features) in a <user_id>.features sidecar tagged with the
+    profile's version; a missing or outdated sidecar (profiles written by
+    older versions or edited by hand) is rebuilt on the next feature read.
+    Files are kept flat in storage_dir or in the hash-prefix sharded layout
+    of profile_layout (`layout`, default: whichever the directory uses).
+    """
+
+    EXTENSION = '.json'
+
+    def __init__(self, storage_dir: str, layout: Optional[str] = None):
+        self.storage_dir = storage_dir
+        os.makedirs(storage_dir, exist_ok=True)
+        self.layout = open_layout(storage_dir, layout)
+
+    def _path(self, user_id: str, extension: str, create: bool = False) -> str:
+        if self.layout is None:
+            return os.path.join(self.storage_dir, f"{user_id}{extension}")
+        return self.layout.path(user_id, extension, create)
+
+    def _locate(self, user_id: str, extension: str) -> str:
+        """Path to read a user's file from (see ShardedLayout.locate)"""
+        if self.layout is None:
+            return os.path.join(self.storage_dir, f"{user_id}{extension}")
+        return self.layout.locate(user_id, extension)
+
+    def _remove_all(self, user_id: str, extensions: Tuple[str, ...]):
+        for extension in extensions:
+            _remove(self._path(user_id, extension))
+            if self.layout is not None and self.layout.flat_fallback:
+                _remove(self.layout.flat_path(user_id, extension))
+
+    def path(self, user_id: str) -> str:
+        return self._path(user_id, self.EXTENSION)
+
+    def features_path(self, user_id: str) -> str:
+        return self._path(user_id, '.features')
+
+    def read(self, user_id: str) -> Optional[dict]:
+        try:
+            with open(self._locate(user_id, self.EXTENSION), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def read_many(self, user_ids: Iterable[str]) -> Dict[str, dict]:
+        profiles = {}
+        for user_id in user_ids:
+            data = self.read(user_id)
+            if data is not None:
+                profiles[user_id] = data
+        return profiles
+
+    def read_all(self) -> Iterator[dict]:
+        for user_id in self.user_ids():
+            data = self.read(user_id)
+            if data is not None:
+                yield data
+
+    def _write_file(self, user_id: str, extension: str, payload: bytes, stale: Tuple[str, ...] = ()) -> Tuple[int, int]:
+        """Write one of a user's files, registering new users and removing `stale` files"""
+        if self.layout is not None:
+            # Listed before the file exists, so a crash never hides a profile
+            self.layout.add([user_id])
+        version = _write_atomic(self._path(user_id, extension, create=True), payload)
+        self._remove_all(user_id, stale)
+        if self.layout is not None and self.layout.flat_fallback:
+            _remove(self.layout.flat_path(user_id, extension))
+        return version
+
+    def write(self, user_id: str, data: dict):
+        version = self._write_file(user_id, self.EXTENSION, json.dumps(data, indent=2).encode())
+        self._write_features(user_id, profile_codec.match_features(data), version)
+
+    def write_many(self, profiles: Iterable[dict]):
+        for data in profiles:
+            self.write(data['user_id'], data)
+
+    def _write_features(self, user_id: str, features: dict, version: Tuple[int, int]):
+        try:
+            # Derived data: no fsync, a lost sidecar is rebuilt from the profile
+            _write_atomic(self._path(user_id, '.features', create=True),
+                          profile_codec.encode_features(features, version), durable=False)
+        except ValueError:
+            _remove(self.features_path(user_id))
+
+    def read_features_many(self, user_ids: Iterable[str]) -> Dict[str, dict]:
+        """Match features of the given users from their sidecars, skipping missing profiles"""
+        result = {}
+        for user_id in user_ids:
+            version = self.version(user_id)
+            if version is None:
+                continue
+            try:
+                with open(self._locate(user_id, '.features'), 'rb') as f:
+                    features_version, features = profile_codec.decode_features(f.read())
+            except (FileNotFoundError, ValueError, struct.error):
+                features_version = None
+            if features_version != version:
+                data = self.read(user_id)
+                if data is None:
+                    continue
+                features = profile_codec.match_features(data)
+                self._write_features(user_id, features, version)
+            result[user_id] = features
+        return result
+
+    def read_all_features(self) -> Iterator[dict]:
+        return iter(self.read_features_many(self.user_ids()).values())
+
+    def delete(self, user_id: str):
+        self._remove_all(user_id, (self.EXTENSION, '.features'))
+        if self.layout is not None:
+            self.layout.remove(user_id)
+
+    def version(self, user_id: str) -> Optional[Tuple[int, int]]:
+        """(modification time, size) of the profile's file, None if it does not exist"""
+        try:
+            stat = os.stat(self._locate(user_id, self.EXTENSION))
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def user_ids(self) -> List[str]:
+        if self.layout is not None:
+            return self.layout.user_ids()
+        return [f[:-5] for f in os.listdir(self.storage_dir) if f.endswith('.json')]
+
+
+class BinaryProfileStore(JsonProfileStore):
+    """One <user_id>.profile file per profile in the compact binary format (see profile_codec).
+
+    Profiles still stored as <user_id>.json are read transparently and
+    converted the next time they are saved.
+    """
+
+    EXTENSION = '.profile'
+
+    def json_path(self, user_id: str) -> str:
+        return self._path(user_id, '.json')
+
+    def _existing_path(self, user_id: str) -> str:
+        path = self._locate(user_id, self.EXTENSION)
+        return path if os.path.exists(path) else self._locate(user_id, '.json')
+
+    def read(self, user_id: str) -> Optional[dict]:
+        try:
+            with open(self._existing_path(user_id), 'rb') as f:
+                return profile_codec.loads(f.read())
+        except FileNotFoundError:
+            return None
+
+    def write(self, user_id: str, data: dict):
+        try:
+            payload = profile_codec.encode(data)
+        except ValueError:
+            # Not representable in the binary format, keep it as JSON
+            version = self._write_file(user_id, '.json', json.dumps(data, indent=2).encode(), stale=(self.EXTENSION,))
+        else:
+            version = self._write_file(user_id, self.EXTENSION, payload, stale=('.json',))
+        self._write_features(user_id, profile_codec.match_features(data), version)
+
+    def delete(self, user_id: str):
+        self._remove_all(user_id, (self.EXTENSION, '.json', '.features'))
+        if self.layout is not None:
+            self.layout.remove(user_id)
+
+    def version(self, user_id: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self._existing_path(user_id))
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def user_ids(self) -> List[str]:
+        if self.layout is not None:
+            return self.layout.user_ids()
+        user_ids = {}
+        for name in os.listdir(self.storage_dir):
+            stem, extension = os.path.splitext(name)
+            if extension in ('.profile', '.json'):
+                user_ids[stem] = None
+        return list(user_ids)
+
+
+class SqliteProfileStore:
+    """Profiles in one SQLite database (WAL mode), versioned by a store-wide write counter.
+
+    `profiles` holds the scalar fields; `music_preferences`, `top_items` and
+    `favorites` hold one row per list entry, keyed by (user_id[, kind],
+    position) and indexed on the item columns so "who lists this artist /
+    track" queries are index lookups. Top songs and albums are Spotify dicts
+    and are kept as JSON next to their name.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS store_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS profiles (
+            user_id TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            first_name TEXT,
+            last_name TEXT,
+            age INTEGER,
+            gender TEXT,
+            location TEXT,
+            bio TEXT,
+            profile_picture_path TEXT,
+            version INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS music_preferences (
+            user_id TEXT NOT NULL REFERENCES profiles(user_id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            track_id TEXT NOT NULL,
+            name TEXT,
+            artists TEXT,
+            album TEXT,
+            rating REAL NOT NULL,
+            PRIMARY KEY (user_id, position)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS music_preferences_track ON music_preferences(track_id);
+        CREATE TABLE IF NOT EXISTS top_items (
+            user_id TEXT NOT NULL REFERENCES profiles(user_id) ON DELETE CASCADE,
+            kind TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            name TEXT,
+            data TEXT,
+            PRIMARY KEY (user_id, kind, position)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS top_items_name ON top_items(kind, name);
+        CREATE TABLE IF NOT EXISTS favorites (
+            user_id TEXT NOT NULL REFERENCES profiles(user_id) ON DELETE CASCADE,
+            kind TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (user_id, kind, position)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS favorites_name ON favorites(kind, name);
+    """
+
+    # SQLite's default limit on bound parameters is 999
+    CHUNK_SIZE = 500
+
+    def __init__(self, database_file: str):
+        self.database_file = database_file
+        dirname = os.path.dirname(database_file)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._lock = threading.RLock()
+        self.connection = sqlite3.connect(database_file, timeout=30, check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.connection.executescript(self.SCHEMA)
+        self.connection.execute("INSERT OR IGNORE INTO store_meta (key, value) VALUES ('version', 0)")
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+    def _transaction(self):
+        return _Transaction(self.connection, self._lock)
+
+    def _select(self, sql: str, user_ids: List[str]) -> List[tuple]:
+        """Run a `... WHERE user_id IN ({})` query over any number of ids"""
+        rows = []
+        for start in range(0, len(user_ids), self.CHUNK_SIZE):
+            chunk = user_ids[start:start + self.CHUNK_SIZE]
+            rows.extend(self.connection.execute(sql.format(','.join('?' * len(chunk))), chunk))
+        return rows
+
+    def read(self, user_id: str) -> Optional[dict]:
+        return self.read_many([user_id]).get(user_id)
+
+    def read_many(self, user_ids: Iterable[str]) -> Dict[str, dict]:
+        user_ids = list(dict.fromkeys(user_ids))
+        with self._lock:
+            profiles = self._select(
+                f"SELECT {', '.join(PROFILE_COLUMNS)} FROM profiles WHERE user_id IN ({{}})", user_ids
+            )
+            preferences = self._select(
+                "SELECT user_id, track_id, name, artists, album, rating FROM music_preferences "
+                "WHERE user_id IN ({}) ORDER BY user_id, position", user_ids
+            )
+            top_items = self._select(
+                "SELECT user_id, kind, name, data FROM top_items WHERE user_id IN ({}) "
+                "ORDER BY user_id, kind, position", user_ids
+            )
+            favorites = self._select(
+                "SELECT user_id, kind, name FROM favorites WHERE user_id IN ({}) "
+                "ORDER BY user_id, kind, position", user_ids
+            )
+        return self._assemble(profiles, preferences, top_items, favorites)
+
+    def read_all(self) -> Iterator[dict]:
+        """Every profile, with one sequential scan per table"""
+        with self._lock:
+            profiles = self.connection.execute(f"SELECT {', '.join(PROFILE_COLUMNS)} FROM profiles").fetchall()
+            preferences = self.connection.execute(
+                "SELECT user_id, track_id, name, artists, album, rating FROM music_preferences "
+                "ORDER BY user_id, position"
+            ).fetchall()
+            top_items = self.connection.execute(
+                "SELECT user_id, kind, name, data FROM top_items ORDER BY user_id, kind, position"
+            ).fetchall()
+            favorites = self.connection.execute(
+                "SELECT user_id, kind, name FROM favorites ORDER BY user_id, kind, position"
+            ).fetchall()
+        return iter(self._assemble(profiles, preferences, top_items, favorites).values())
+
+    @staticmethod
+    def _assemble(profiles, preferences, top_items, favorites) -> Dict[str, dict]:
+        result = {}
+        for row in profiles:
+            data = dict(zip(PROFILE_COLUMNS, row))
+            data['music_preferences'] = []
+            for kind in TOP_KINDS:
+                data[f'top_{kind}'] = []
+            for kind in FAVORITE_KINDS:
+                data[f'favorite_{kind}'] = []
+            result[data['user_id']] = data
+        # Decode every JSON column of a result set with one json.loads call
+        artist_lists = _loads_all(row[3] for row in preferences)
+        for (user_id, track_id, name, _, album, rating), artists in zip(preferences, artist_lists):
+            result[user_id]['music_preferences'].append({
+                'track_id': track_id,
+                'name': name,
+                'artists': artists,
+                'album': album,
+                'rating': rating
+            })
+        items = iter(_loads_all(row[3] for row in top_items if row[3] is not None))
+        for user_id, kind, name, data in top_items:
+            result[user_id][f'top_{kind}'].append(name if data is None else next(items))
+        for user_id, kind, name in favorites:
+            result[user_id][f'favorite_{kind}'].append(name)
+        return result
+
+    def write(self, user_id: str, data: dict):
+        self.write_many([data])
+
+    def write_many(self, profiles: Iterable[dict]):
+        """Insert or replace profiles in a single transaction"""
+        with self._transaction() as connection:
+            for data in profiles:
+                self._write(connection, data)
+
+    def _write(self, connection: sqlite3.Connection, data: dict):
+        user_id = data['user_id']
+        connection.execute("UPDATE store_meta SET value = value + 1 WHERE key = 'version'")
+        version = connection.execute("SELECT value FROM store_meta WHERE key = 'version'").fetchone()[0]
+        connection.execute(
+            f"INSERT OR REPLACE INTO profiles ({', '.join(PROFILE_COLUMNS)}, version) "
+            f"VALUES ({', '.join('?' * (len(PROFILE_COLUMNS) + 1))})",
+            [data.get(column) for column in PROFILE_COLUMNS] + [version]
+        )
+        # INSERT OR REPLACE does not fire ON DELETE CASCADE without recursive triggers
+        for table in ('music_preferences', 'top_items', 'favorites'):
+            connection.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+        columns = profile_codec.preference_columns(data.get('music_preferences', []))
+        connection.executemany(
+            "INSERT INTO music_preferences (user_id, position, track_id, name, artists, album, rating) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (user_id, position, track_id, name, json.dumps(artists), album, rating)
+                for position, (track_id, name, artists, album, rating) in enumerate(zip(
+                    columns['track_id'], columns['name'], columns['artists'], columns['album'], columns['rating']
+                ))
+            ]
+        )
+        connection.executemany(
+            "INSERT INTO top_items (user_id, kind, position, name, data) VALUES (?, ?, ?, ?, ?)",
+            [
+                (user_id, kind, position, item, None) if isinstance(item, str) else
+                (user_id, kind, position, item.get('name'), json.dumps(item))
+                for kind in TOP_KINDS
+                for position, item in enumerate(data.get(f'top_{kind}') or [])
+            ]
+        )
+        connection.executemany(
+            "INSERT INTO favorites (user_id, kind, position, name) VALUES (?, ?, ?, ?)",
+            [
+                (user_id, kind, position, item)
+                for kind in FAVORITE_KINDS
+                for position, item in enumerate(data.get(f'favorite_{kind}') or [])
+            ]
+        )
+
+    def delete(self, user_id: str):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM profiles WHERE user_id = ?", (user_id,))
+
+    def version(self, user_id: str) -> Optional[int]:
+        with self._lock:
+            row = self.connection.execute("SELECT version FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def user_ids(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self.connection.execute("SELECT user_id FROM profiles")]
+
+    def read_features_many(self, user_ids: Iterable[str]) -> Dict[str, dict]:
+        """Match features of the given users, reading only the columns matching uses"""
+        user_ids = list(dict.fromkeys(user_ids))
+        with self._lock:
+            profiles = self._select("SELECT user_id FROM profiles WHERE user_id IN ({})", user_ids)
+            preferences = self._select(
+                "SELECT user_id, track_id, rating FROM music_preferences "
+                "WHERE user_id IN ({}) ORDER BY user_id, position", user_ids
+            )
+            top_items = self._select(
+                "SELECT user_id, kind, name FROM top_items WHERE user_id IN ({}) "
+                "AND kind IN ('artists', 'genres', 'albums') ORDER BY user_id, kind, position", user_ids
+            )
+        return self._assemble_features(profiles, preferences, top_items)
+
+    def read_all_features(self) -> Iterator[dict]:
+        with self._lock:
+            profiles = self.connection.execute("SELECT user_id FROM profiles").fetchall()
+            preferences = self.connection.execute(
+                "SELECT user_id, track_id, rating FROM music_preferences ORDER BY user_id, position"
+            ).fetchall()
+            top_items = self.connection.execute(
+                "SELECT user_id, kind, name FROM top_items WHERE kind IN ('artists', 'genres', 'albums') "
+                "ORDER BY user_id, kind, position"
+            ).fetchall()
+        return iter(self._assemble_features(profiles, preferences, top_items).values())
+
+    @staticmethod
+    def _assemble_features(profiles, preferences, top_items) -> Dict[str, dict]:
+        result = {
+            user_id: {'user_id': user_id, 'top_artists': [], 'top_genres': [], 'albums': [],
+                      'track_ids': [], 'ratings': []}
+            for user_id, in profiles
+        }
+        for user_id, track_id, rating in preferences:
+            features = result[user_id]
+            features['track_ids'].append(track_id)
+            features['ratings'].append(rating)
+        for user_id, kind, name in top_items:
+            if kind != 'albums':
+                result[user_id][f'top_{kind}'].append(name)
+            elif name:
+                result[user_id]['albums'].append(name)
+        return result
+
+    def users_listing(self, kind: str, name: str) -> List[str]:
+        """Users whose top `kind` ('artists', 'genres', 'songs', 'albums') include `name`"""
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT DISTINCT user_id FROM top_items WHERE kind = ? AND name = ?", (kind, name)
+            )
+            return [row[0] for row in rows]
+
+
+def _loads_all(documents: Iterable[str]) -> list:
+    return json.loads('[' + ','.join(documents) + ']')
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK block holding the store's lock"""
+
+    def __init__(self, connection: sqlite3.Connection, lock):
+        self.connection = connection
+        self.lock = lock
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.lock.acquire()
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.lock.release()
+        return False
+
+
+def open_store(backend: str, storage_dir: str, database_file: Optional[str] = None, layout: Optional[str] = None):
+    """
+    Profile store for a backend name: 'json' (default layout), 'binary' or
+    'sqlite'. `layout` ('flat' or 'sharded') applies to the file backends.
+    """
+    if backend == 'json':
+        return JsonProfileStore(storage_dir, layout)
+    if backend == 'binary':
+        return BinaryProfileStore(storage_dir, layout)
+    if backend == 'sqlite':
+        if database_file is None:
+            database_file = os.path.join(os.path.dirname(os.path.abspath(storage_dir)), 'profiles.db')
+        return SqliteProfileStore(database_file)
+    raise ValueError(f"Unknown profile storage backend '{backend}'")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a directory of JSON profiles into the SQLite profile store")
+    parser.add_argument('--storage-dir', default='data/profiles', help="Directory of <user_id>.json profiles")
+    parser.add_argument('--database', default='data/profiles.db')
+    args = parser.parse_args()
+
+    source = JsonProfileStore(args.storage_dir)
+    target = SqliteProfileStore(args.database)
+    count = 0
+    batch = []
+    for data in source.read_all():
+        batch.append(data)
+        if len(batch) >= 1000:
+            target.write_many(batch)
+            count += len(batch)
+            batch = []
+    target.write_many(batch)
+    count += len(batch)
+    target.close()
+    print(f"Imported {count} profiles into {args.database}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import atexit
+import threading
+import time
+import traceback
+from typing import Callable, Dict, Hashable, List, Optional
+
+
+class WriteBehindQueue:
+    """Writes saved profiles to a profile store from a background thread.
+
+    `submit` only records the latest version of a profile and returns; the
+    worker waits `delay` seconds after the first pending save so that bursts
+    of saves of the same profile (e.g. adding several favorites) collapse into
+    one write, then writes everything pending in one batch. `pending` exposes
+    profiles that are queued or being written so readers always see their own
+    saves, and `flush` writes everything synchronously (logout, shutdown).
+    Pending saves are also flushed at interpreter exit.
+
+    `before_write(profiles)` is called from the writing thread with each
+    batch just before it is written (e.g. to diff it against the stored
+    state), `on_written(user_id, profile, version)` after each profile
+    reaches the store.
+    """
+
+    def __init__(self, store, delay: float = 0.5,
+                 on_written: Optional[Callable[[str, object, Hashable], None]] = None,
+                 before_write: Optional[Callable[[List[object]], None]] = None):
+        self.store = store
+        self.delay = delay
+        self.on_written = on_written
+        self.before_write = before_write
+        self._pending: Dict[str, object] = {}
+        self._writing: Dict[str, object] = {}
+        self._first_pending = 0.0
+        self._closed = False
+        self._condition = threading.Condition()
+        # Held while a batch is written, so flush/discard never interleave with the worker
+        self._write_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='profile-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def __len__(self) -> int:
+        with self._condition:
+            return len(self._pending) + len(self._writing)
+
+    def submit(self, profile):
+        """Queue a profile (a detached copy the caller will not modify) for writing"""
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Profile writer is closed")
+            if not self._pending:
+                self._first_pending = time.monotonic()
+            self._pending[profile.user_id] = profile
+            self._condition.notify()
+
+    def pending(self, user_id: str):
+        """The queued or in-flight profile of a user, None if the store is up to date"""
+        with self._condition:
+            profile = self._pending.get(user_id)
+            return profile if profile is not None else self._writing.get(user_id)
+
+    def discard(self, user_id: str):
+        """Drop a user's queued save, waiting for an in-flight write to finish (before deleting it)"""
+        with self._write_lock:
+            with self._condition:
+                self._pending.pop(user_id, None)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                # Coalescing window, counted from the first pending save
+                remaining = self._first_pending + self.delay - time.monotonic()
+                while remaining > 0 and not self._closed:
+                    self._condition.wait(remaining)
+                    remaining = self._first_pending + self.delay - time.monotonic()
+            try:
+                self._write_pending()
+            except Exception:
+                # Failed profiles were re-queued; retry after the next delay
+                traceback.print_exc()
+
+    def _write_pending(self):
+        with self._write_lock:
+            with self._condition:
+                batch, self._pending = self._pending, {}
+                self._writing = batch
+            try:
+                if batch and self.before_write is not None:
+                    self.before_write(list(batch.values()))
+                if batch:
+                    self.store.write_many(profile.to_dict() for profile in batch.values())
+            except Exception:
+                with self._condition:
+                    # Keep whatever was saved again meanwhile, it is newer
+                    for user_id, profile in batch.items():
+                        self._pending.setdefault(user_id, profile)
+                    self._first_pending = time.monotonic()
+                raise
+            finally:
+                with self._condition:
+                    self._writing = {}
+            if self.on_written is not None:
+                for user_id, profile in batch.items():
+                    self.on_written(user_id, profile, self.store.version(user_id))
+
+    def flush(self):
+        """Write every pending save now, in the calling thread"""
+        self._write_pending()
+
+    def close(self):
+        """Flush and stop the worker thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self.flush()
+        atexit.unregister(self.flush)
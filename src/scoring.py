@@ -0,0 +1,431 @@
+"""
+Pluggable compatibility scoring.
+
+A scoring strategy is a kernel that scores one field (artists, genres or
+tracks) of a querying user against a whole batch of encoded candidates at
+once, using sparse matrix products and bincounts instead of per-pair Python
+code. `compile_scorer` turns a choice of kernel per field and a weight per
+field into a ScoringPipeline; the pipeline's final score is the weighted
+sum of the field scores, clipped to [0, 1].
+
+Built-in kernels:
+    overlap          matching (item, item) pairs over the longer list (the original formula;
+                     shared tracks count 1 - rating difference)
+    jaccard          distinct shared items over distinct items of both users
+    cosine           cosine similarity of the item count vectors
+    rating_weighted  weighted Jaccard: sum of min over sum of max item weights, where a
+                     track weighs its (mean) rating and artists/genres their multiplicity
+    bm25             Jaccard with every item weighted by its BM25 inverse document frequency,
+                     so sharing a niche artist counts more than sharing a popular one
+    idf_overlap      the overlap formula with every pair and list item weighted by its IDF
+"""
+import hashlib
+import math
+import numpy as np
+from scipy import sparse
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+# Weights of the default compatibility formula
+ARTIST_WEIGHT = 0.4
+GENRE_WEIGHT = 0.3
+TRACK_WEIGHT = 0.3
+
+FIELDS = ('artists', 'genres', 'tracks')
+DEFAULT_WEIGHTS = {'artists': ARTIST_WEIGHT, 'genres': GENRE_WEIGHT, 'tracks': TRACK_WEIGHT}
+
+
+def _overlap_score(matches: np.ndarray, own_count: int, other_counts: np.ndarray,
+                   total: Optional[np.ndarray] = None) -> np.ndarray:
+    """Overlap normalized by the longer of the two lists, 0 when nothing matches"""
+    if total is None:
+        total = matches
+    denominator = np.maximum(np.maximum(other_counts, own_count), 1)
+    return np.where(matches > 0, total / denominator, 0.0)
+
+
+def _ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    return np.where(denominator > 0, numerator / np.where(denominator > 0, denominator, 1), 0.0)
+
+
+def track_overlap(encoded, track_cols: np.ndarray, ratings: np.ndarray,
+                  item_weights: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sum of (1 - rating difference) and number of pairs over shared tracks, for
+    every encoded user. With `item_weights` (per track column) each pair's
+    similarity is multiplied by its track's weight.
+    """
+    n_users = len(encoded)
+    total = np.zeros(n_users)
+    matches = np.zeros(n_users)
+    if not len(track_cols) or not len(encoded.track_cols):
+        return total, matches
+    n_cols = int(encoded.track_cols.max()) + 1
+    keep = track_cols < n_cols
+    track_cols, ratings = track_cols[keep], ratings[keep]
+    # A track listed twice by the querying user pairs with the candidate's entry twice;
+    # peel the repeats off into layers so each layer is a plain column lookup.
+    while len(track_cols):
+        layer_cols, first = np.unique(track_cols, return_index=True)
+        lookup = np.full(n_cols, np.nan)
+        lookup[layer_cols] = ratings[first]
+        other = lookup[encoded.track_cols]
+        shared = ~np.isnan(other)
+        similarity = 1.0 - np.abs(encoded.track_ratings[shared] - other[shared])
+        if item_weights is not None:
+            similarity *= item_weights[encoded.track_cols[shared]]
+        total += np.bincount(encoded.track_rows[shared], weights=similarity, minlength=n_users)
+        matches += np.bincount(encoded.track_rows[shared], minlength=n_users)
+        rest = np.ones(len(track_cols), dtype=bool)
+        rest[first] = False
+        track_cols, ratings = track_cols[rest], ratings[rest]
+    return total, matches
+
+
+def track_matrices(encoded) -> Tuple[sparse.csr_matrix, sparse.csr_matrix]:
+    """(count, mean rating) users x tracks matrices of an encoding, built once per encoding"""
+    matrices = encoded._track_matrices
+    if matrices is None:
+        n_cols = int(encoded.track_cols.max()) + 1 if len(encoded.track_cols) else 0
+        shape = (len(encoded), n_cols)
+        # Copies: sum_duplicates sorts in place and must not reorder the encoding's own arrays
+        counts = sparse.csr_matrix((np.ones(len(encoded.track_cols)), encoded.track_cols.copy(),
+                                    encoded.track_indptr.copy()), shape=shape)
+        sums = sparse.csr_matrix((encoded.track_ratings.copy(), encoded.track_cols.copy(),
+                                  encoded.track_indptr.copy()), shape=shape)
+        counts.sum_duplicates()
+        sums.sum_duplicates()
+        # Same entries in the same order, so the data arrays line up
+        means = sparse.csr_matrix((sums.data / counts.data, counts.indices, counts.indptr), shape=shape)
+        matrices = encoded._track_matrices = (counts, means)
+    return matrices
+
+
+def _row_sums(matrix: sparse.csr_matrix, data: np.ndarray) -> np.ndarray:
+    """Per-row sum of values aligned with matrix.data"""
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    return np.bincount(rows, weights=data, minlength=matrix.shape[0])
+
+
+def bm25_idf(document_frequencies: np.ndarray, n_documents: int) -> np.ndarray:
+    """BM25 inverse document frequency, always positive"""
+    df = np.asarray(document_frequencies, dtype=np.float64)
+    return np.log1p((n_documents - df + 0.5) / (df + 0.5))
+
+
+class FieldContext:
+    """Inputs of one field's kernel: the querying user's items and the candidates' encoded items.
+
+    Derived quantities (pair counts, binary matrices, IDF vectors...) are
+    computed on first use and cached, so kernels sharing a field never
+    compute them twice.
+    """
+
+    def __init__(self, field: str, encoded, rows: np.ndarray, cols: np.ndarray, ratings: np.ndarray,
+                 document_frequencies: Optional[np.ndarray] = None, n_documents: Optional[int] = None,
+                 idf: Optional[np.ndarray] = None):
+        self.field = field
+        self.encoded = encoded
+        self.rows = rows
+        self.rated = field == 'tracks'
+        # The querying user's items, duplicates included
+        self.cols = cols
+        self.ratings = ratings
+        self.own_count = len(cols)
+        self.other_counts = getattr(encoded, f'{field[:-1]}_counts')[rows]
+        self._document_frequencies = document_frequencies
+        self._n_documents = n_documents
+        self._idf = idf
+        self._cache = {}
+
+    def _cached(self, name: str, compute: Callable):
+        value = self._cache.get(name)
+        if value is None:
+            value = self._cache[name] = compute()
+        return value
+
+    def _subset(self, matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+        return matrix if len(self.rows) == matrix.shape[0] else matrix[self.rows]
+
+    @property
+    def counts(self) -> sparse.csr_matrix:
+        """Candidates x items count matrix"""
+        def compute():
+            if self.rated:
+                return self._subset(track_matrices(self.encoded)[0])
+            return self._subset(getattr(self.encoded, self.field))
+        return self._cached('counts', compute)
+
+    @property
+    def n_cols(self) -> int:
+        return self.counts.shape[1]
+
+    @property
+    def size(self) -> int:
+        """Length of the query vectors: every item of the candidates or of the querying user"""
+        return max(self.n_cols, int(self.cols.max()) + 1 if len(self.cols) else 0)
+
+    @property
+    def query_counts(self) -> np.ndarray:
+        return self._cached('query_counts', lambda: np.bincount(self.cols, minlength=self.size).astype(np.float64))
+
+    @property
+    def query_binary(self) -> np.ndarray:
+        return self._cached('query_binary', lambda: (self.query_counts > 0).astype(np.float64))
+
+    @property
+    def binary(self) -> sparse.csr_matrix:
+        def compute():
+            counts = self.counts
+            return sparse.csr_matrix((np.ones(len(counts.data)), counts.indices, counts.indptr), shape=counts.shape)
+        return self._cached('binary', compute)
+
+    def _track_overlap(self) -> Tuple[np.ndarray, np.ndarray]:
+        def compute():
+            total, matches = track_overlap(self.encoded, self.cols, self.ratings)
+            return total[self.rows], matches[self.rows]
+        return self._cached('track_overlap', compute)
+
+    @property
+    def pairs(self) -> np.ndarray:
+        """Number of equal (own item, candidate item) pairs, i.e. the count vectors' dot product"""
+        if self.rated:
+            return self._track_overlap()[1]
+        return self._cached('pairs', lambda: self.counts @ self.query_counts[:self.n_cols])
+
+    @property
+    def rating_similarity(self) -> np.ndarray:
+        """Sum of 1 - |rating difference| over shared track pairs"""
+        return self._track_overlap()[0]
+
+    @property
+    def values(self) -> sparse.csr_matrix:
+        """Candidates x items weights: mean rating of a track, multiplicity of an artist/genre"""
+        if self.rated:
+            return self._cached('values', lambda: self._subset(track_matrices(self.encoded)[1]))
+        return self.counts
+
+    @property
+    def query_values(self) -> np.ndarray:
+        if not self.rated:
+            return self.query_counts
+        def compute():
+            sums = np.bincount(self.cols, weights=self.ratings, minlength=self.size)
+            return _ratio(sums, self.query_counts)
+        return self._cached('query_values', compute)
+
+    @property
+    def idf(self) -> np.ndarray:
+        """BM25 IDF of every item; items nobody else lists get the maximum"""
+        def compute():
+            if self._idf is not None:
+                # Precomputed population IDF, padded for items missing from it
+                idf = np.empty(self.size)
+                known = self._idf[:self.size]
+                idf[:len(known)] = known
+                idf[len(known):] = bm25_idf(0, max(self._n_documents or 0, 1))
+                return idf
+            df = np.zeros(self.size)
+            if self._document_frequencies is not None:
+                known = self._document_frequencies[:self.size]
+                df[:len(known)] = known
+                n_documents = self._n_documents
+            else:
+                # Frequencies within the scored batch
+                df[:self.n_cols] = np.bincount(self.counts.indices, minlength=self.n_cols)
+                n_documents = self.counts.shape[0]
+            return bm25_idf(df, max(n_documents, 1))
+        return self._cached('idf', compute)
+
+
+class Scorer(NamedTuple):
+    name: str
+    kernel: Callable[[FieldContext], np.ndarray]
+    # Highest field score reachable with `pairs` matching pairs between lists of the given lengths
+    bound: Callable[[int, int, int], float]
+    # Whether the kernel reads FieldContext.idf
+    uses_idf: bool = False
+
+
+SCORERS: Dict[str, Scorer] = {}
+
+
+def _any_overlap_bound(pairs: int, own_size: int, other_size: int) -> float:
+    return 1.0
+
+
+def register_scorer(name: str, bound: Callable[[int, int, int], float] = _any_overlap_bound,
+                    uses_idf: bool = False):
+    """
+    Decorator adding a field kernel to the registry. A kernel takes a
+    FieldContext and returns one score in [0, 1] per candidate, 0 for
+    candidates sharing nothing with the querying user. `bound` must never
+    underestimate the kernel's score; it lets the matcher skip candidates
+    that cannot reach the threshold. Kernels reading `idf` must say so with
+    `uses_idf`, so the engine supplies population frequencies.
+    """
+    def decorator(kernel: Callable[[FieldContext], np.ndarray]):
+        SCORERS[name] = Scorer(name, kernel, bound, uses_idf)
+        return kernel
+    return decorator
+
+
+@register_scorer('overlap', bound=lambda pairs, own_size, other_size: pairs / max(own_size, other_size))
+def overlap_kernel(f: FieldContext) -> np.ndarray:
+    total = f.rating_similarity if f.rated else None
+    return _overlap_score(f.pairs, f.own_count, f.other_counts, total=total)
+
+
+@register_scorer('jaccard')
+def jaccard_kernel(f: FieldContext) -> np.ndarray:
+    shared = f.binary @ f.query_binary[:f.n_cols]
+    union = np.diff(f.binary.indptr) + f.query_binary.sum() - shared
+    return _ratio(shared, union)
+
+
+@register_scorer('cosine')
+def cosine_kernel(f: FieldContext) -> np.ndarray:
+    counts = f.counts
+    other_norms = np.sqrt(_row_sums(counts, counts.data ** 2))
+    own_norm = math.sqrt(float(f.query_counts @ f.query_counts))
+    return np.minimum(_ratio(f.pairs, other_norms * own_norm), 1.0)
+
+
+@register_scorer('rating_weighted')
+def rating_weighted_kernel(f: FieldContext) -> np.ndarray:
+    values = f.values
+    query_values = f.query_values
+    shared = _row_sums(values, np.minimum(values.data, query_values[values.indices]))
+    union = _row_sums(values, values.data) + query_values.sum() - shared
+    return _ratio(shared, union)
+
+
+@register_scorer('bm25', uses_idf=True)
+def bm25_kernel(f: FieldContext) -> np.ndarray:
+    idf = f.idf
+    weighted_query = f.query_binary * idf
+    shared = f.binary @ weighted_query[:f.n_cols]
+    union = f.binary @ idf[:f.n_cols] + weighted_query.sum() - shared
+    return _ratio(shared, union)
+
+
+@register_scorer('idf_overlap', uses_idf=True)
+def idf_overlap_kernel(f: FieldContext) -> np.ndarray:
+    idf = f.idf
+    if f.rated:
+        total = f._cached('idf_track_overlap', lambda: track_overlap(
+            f.encoded, f.cols, f.ratings, idf[:f.n_cols])[0][f.rows])
+    else:
+        total = f.counts @ (f.query_counts * idf)[:f.n_cols]
+    other_weight = f.counts @ idf[:f.n_cols]
+    own_weight = float(f.query_counts @ idf)
+    return np.minimum(np.where(f.pairs > 0, _ratio(total, np.maximum(other_weight, own_weight)), 0.0), 1.0)
+
+
+class ScoringPipeline:
+    """A compiled scoring configuration: one (kernel, weight) per field with a non-zero weight.
+
+    Calling the pipeline scores a profile against encoded candidates; it is
+    what MatchEngine.score runs. Weights are normalized to sum to 1 so every
+    configuration scores in [0, 1].
+    """
+
+    def __init__(self, name: str, stages: Sequence[Tuple[str, Scorer, float]]):
+        self.name = name
+        self.stages = tuple(stages)
+        self.uses_idf = any(scorer.uses_idf for _, scorer, _ in self.stages)
+
+    def __repr__(self) -> str:
+        stages = ', '.join(f'{field}={scorer.name}*{weight:g}' for field, scorer, weight in self.stages)
+        return f'ScoringPipeline({self.name!r}: {stages})'
+
+    def __reduce__(self):
+        # Kernels are pickled by their registered name, e.g. for worker processes
+        return _pipeline_from_stages, (self.name, [(field, scorer.name, weight) for field, scorer, weight in self.stages])
+
+    def __call__(self, encoded, encoded_row: tuple, rows: np.ndarray,
+                 document_frequencies: Optional[Tuple[int, Dict[str, np.ndarray]]] = None,
+                 idf: Optional[Dict[str, np.ndarray]] = None) -> np.ndarray:
+        """
+        Score one encoded querying user, given as the (artist cols, genre cols,
+        track cols, ratings) tuple of MatchEngine.encode_row, against the
+        `rows` of `encoded`. IDF-based kernels use `document_frequencies`,
+        (number of users, {field: frequency per item}), or the precomputed
+        `idf` {field: weight per item}; without either, frequencies within the
+        scored batch.
+        """
+        idf = idf or {}
+        artist_cols, genre_cols, track_cols, ratings = encoded_row
+        field_cols = {'artists': artist_cols, 'genres': genre_cols, 'tracks': track_cols}
+        n_documents, frequencies = document_frequencies or (None, {})
+        final_score = np.zeros(len(rows))
+        for field, scorer, weight in self.stages:
+            context = FieldContext(field, encoded, rows, field_cols[field], ratings,
+                                   frequencies.get(field), n_documents, idf.get(field))
+            final_score += scorer.kernel(context) * weight
+        return np.clip(final_score, 0, 1)
+
+    def upper_bound(self, pairs: List[int], own_sizes: List[int], other_sizes: List[int]) -> float:
+        """Highest score two users can reach given their number of matching pairs per field"""
+        counts = dict(zip(FIELDS, zip(pairs, own_sizes, other_sizes)))
+        bound = 0.0
+        for field, scorer, weight in self.stages:
+            count, own, other = counts[field]
+            if count:
+                bound += weight * scorer.bound(count, own, other)
+        return min(bound, 1.0)
+
+
+def _pipeline_from_stages(name: str, stages: Sequence[Tuple[str, str, float]]) -> ScoringPipeline:
+    return ScoringPipeline(name, [(field, SCORERS[kernel], weight) for field, kernel, weight in stages])
+
+
+ScoringSpec = Union[str, Dict[str, str]]
+
+
+def compile_scorer(strategy: ScoringSpec = 'overlap', weights: Optional[Dict[str, float]] = None,
+                   name: Optional[str] = None) -> ScoringPipeline:
+    """
+    Build a scoring pipeline. `strategy` is a registered kernel name used for
+    every field, or a {field: kernel name} dict (missing fields use 'overlap').
+    `weights` maps fields to non-negative weights (default 0.4/0.3/0.3).
+    """
+    strategies = dict.fromkeys(FIELDS, strategy) if isinstance(strategy, str) else {
+        field: strategy.get(field, 'overlap') for field in FIELDS
+    }
+    weights = dict(DEFAULT_WEIGHTS if weights is None else weights)
+    unknown = set(weights) - set(FIELDS)
+    if isinstance(strategy, dict):
+        unknown |= set(strategy) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    for field, kernel in strategies.items():
+        if kernel not in SCORERS:
+            raise ValueError(f"Unknown scoring strategy '{kernel}' for {field}")
+    if any(w < 0 for w in weights.values()) or sum(weights.values()) <= 0:
+        raise ValueError("Weights must be non-negative with a positive sum")
+    total = sum(weights.values())
+    stages = [
+        (field, SCORERS[strategies[field]], weights.get(field, 0.0) / total)
+        for field in FIELDS if weights.get(field, 0.0) > 0
+    ]
+    if name is None:
+        kernels = set(strategies.values())
+        if len(kernels) == 1 and weights == DEFAULT_WEIGHTS:
+            name = kernels.pop()
+        else:
+            spec = repr(sorted(strategies.items())) + repr(sorted(weights.items()))
+            name = 'custom-' + hashlib.sha1(spec.encode()).hexdigest()[:8]
+    return ScoringPipeline(name, stages)
+
+
+DEFAULT_SCORER = compile_scorer()
+
+
+def get_scorer(scoring: Union[None, ScoringSpec, ScoringPipeline]) -> ScoringPipeline:
+    """Resolve a pipeline, a kernel name or a {field: kernel name} dict (None: the default formula)"""
+    if scoring is None:
+        return DEFAULT_SCORER
+    if isinstance(scoring, ScoringPipeline):
+        return scoring
+    scorer = compile_scorer(scoring)
+    return DEFAULT_SCORER if scorer.name == DEFAULT_SCORER.name else scorer
@@ -0,0 +1,78 @@
+"""
+Process-wide AuthManager and UserProfileManager shared by every window.
+
+Windows get their managers from `get_services()` instead of constructing
+their own, so accounts, sessions, the profile cache and the match indexes
+are loaded once per process rather than on every login window and logout.
+The auth manager picks up changes made by other processes when it is
+handed out (see AuthManager.refresh); profile reads already validate the
+cache against the store.
+"""
+import os
+import threading
+from typing import Optional
+from auth import AuthManager
+from password_hashing import PasswordHasher
+from user_profile import UserProfileManager
+
+
+class Services:
+    """Lazily created managers; close() flushes and releases them"""
+
+    def __init__(self, data_dir: str = 'data', profile_write_delay: Optional[float] = None,
+                 auth_backend: str = 'journal', password_hashing: Optional[dict] = None):
+        """`password_hashing`: PasswordHasher settings, e.g. config.PASSWORD_HASHING"""
+        self.data_dir = data_dir
+        self.profile_write_delay = profile_write_delay
+        self.auth_backend = auth_backend
+        self.password_hasher = PasswordHasher(**(password_hashing or {}))
+        self._profile_manager: Optional[UserProfileManager] = None
+        self._auth_manager: Optional[AuthManager] = None
+        self._lock = threading.RLock()
+
+    @property
+    def profile_manager(self) -> UserProfileManager:
+        with self._lock:
+            if self._profile_manager is None:
+                self._profile_manager = UserProfileManager(
+                    storage_dir=os.path.join(self.data_dir, 'profiles'),
+                    pictures_dir=os.path.join(self.data_dir, 'profile_pictures'),
+                    write_delay=self.profile_write_delay
+                )
+            return self._profile_manager
+
+    @property
+    def auth_manager(self) -> AuthManager:
+        with self._lock:
+            if self._auth_manager is None:
+                self._auth_manager = AuthManager(
+                    os.path.join(self.data_dir, 'auth.json'), os.path.join(self.data_dir, 'session.json'),
+                    storage_backend=self.auth_backend, profile_manager=self.profile_manager,
+                    password_hasher=self.password_hasher
+                )
+            else:
+                self._auth_manager.refresh()
+            return self._auth_manager
+
+    def close(self):
+        """Write pending profile saves and release the managers (they are recreated on next use)"""
+        with self._lock:
+            if self._auth_manager is not None:
+                self._auth_manager.close()
+                self._auth_manager = None
+            if self._profile_manager is not None:
+                self._profile_manager.close()
+                self._profile_manager = None
+
+
+_services: Optional[Services] = None
+_services_lock = threading.Lock()
+
+
+def get_services(**options) -> Services:
+    """The process-wide Services; `options` (see Services) only apply to the first call"""
+    global _services
+    with _services_lock:
+        if _services is None:
+            _services = Services(**options)
+        return _services
@@ -0,0 +1,176 @@
+"""
+Login sessions of AuthManager, indexed by user and by expiry.
+
+Sessions are kept as {token: {'user_id', 'created_at', 'expires_at',
+'remember_me'}} and persisted, one session per record, to a record store
+(see auth_store). Besides the token lookup the
+store keeps a user_id -> tokens index (for logging a user out everywhere)
+and a heap of expiry times, from which expired sessions are swept every
+`sweep_interval` seconds instead of waiting for someone to present them.
+
+Remember-me sessions slide: every validation pushes their expiry to
+`now + REMEMBER_ME_LIFETIME`. The new expiry is only written to disk when
+it moved by more than `extension_granularity`, so validating a session
+writes nothing in the common case (a session may end up to that much earlier
+than a precise sliding window would allow).
+"""
+import heapq
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+SESSION_LIFETIME = 24 * 3600
+REMEMBER_ME_LIFETIME = 30 * 24 * 3600
+
+
+class SessionStore:
+    """Sessions by token, with a per-user index and an expiry heap swept in the background"""
+
+    def __init__(self, records, extension_granularity: float = 24 * 3600,
+                 sweep_interval: Optional[float] = 3600):
+        self.records = records
+        self.extension_granularity = extension_granularity
+        self.sessions: Dict[str, dict] = {}
+        self._tokens_by_user: Dict[str, Set[str]] = {}
+        # Remember-me tokens, oldest first
+        self._remembered: Dict[str, None] = {}
+        # (expires_at, token); entries of extended or deleted sessions are skipped when popped
+        self._expiries: List[Tuple[float, str]] = []
+        # The sweeper thread modifies the sessions too
+        self._lock = threading.RLock()
+        self._load()
+        self.sweep()
+        self._stop = threading.Event()
+        self._sweeper = None
+        if sweep_interval is not None:
+            self._sweeper = threading.Thread(target=self._run_sweeper, args=(sweep_interval,),
+                                             name='session-sweeper', daemon=True)
+            self._sweeper.start()
+
+    def _load(self):
+        self.sessions.clear()
+        self._tokens_by_user.clear()
+        self._remembered.clear()
+        for token, session in self.records.load().items():
+            self._add(token, session)
+        self._expiries = [(s['expires_at'], t) for t, s in self.sessions.items()]
+        heapq.heapify(self._expiries)
+
+    def refresh(self) -> bool:
+        """Reload if the sessions were changed elsewhere (another process or AuthManager)"""
+        with self._lock:
+            if not self.records.refresh():
+                return False
+            self._load()
+            return True
+
+    def _add(self, token: str, session: dict):
+        self.sessions[token] = session
+        self._tokens_by_user.setdefault(session['user_id'], set()).add(token)
+        if session['remember_me']:
+            self._remembered[token] = None
+
+    def _remove(self, token: str) -> Optional[dict]:
+        session = self.sessions.pop(token, None)
+        if session is not None:
+            tokens = self._tokens_by_user[session['user_id']]
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[session['user_id']]
+            self._remembered.pop(token, None)
+        return session
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def __contains__(self, token: str) -> bool:
+        return token in self.sessions
+
+    def create(self, token: str, user_id: str, remember_me: bool = False, now: Optional[float] = None) -> dict:
+        now = time.time() if now is None else now
+        session = {
+            'user_id': user_id,
+            'created_at': now,
+            'expires_at': now + (REMEMBER_ME_LIFETIME if remember_me else SESSION_LIFETIME),
+            'remember_me': remember_me
+        }
+        with self._lock:
+            self._add(token, session)
+            heapq.heappush(self._expiries, (session['expires_at'], token))
+            self.records.put(token, session)
+        return session
+
+    def validate(self, token: str, now: Optional[float] = None) -> Optional[str]:
+        """user_id of a live session, extending remember-me sessions; None if unknown or expired"""
+        now = time.time() if now is None else now
+        with self._lock:
+            session = self.sessions.get(token)
+            if session is None:
+                return None
+            if now > session['expires_at']:
+                self._remove(token)
+                self.records.delete(token)
+                return None
+            if session['remember_me']:
+                expires_at = now + REMEMBER_ME_LIFETIME
+                if expires_at - session['expires_at'] > self.extension_granularity:
+                    session['expires_at'] = expires_at
+                    heapq.heappush(self._expiries, (expires_at, token))
+                    self.records.put(token, session)
+            return session['user_id']
+
+    def delete(self, token: str):
+        with self._lock:
+            if self._remove(token) is not None:
+                self.records.delete(token)
+
+    def delete_user(self, user_id: str):
+        """Delete every session of a user"""
+        with self._lock:
+            tokens = list(self._tokens_by_user.get(user_id, ()))
+            for token in tokens:
+                self._remove(token)
+            self.records.delete_many(tokens)
+
+    def tokens(self, user_id: str) -> Set[str]:
+        with self._lock:
+            return set(self._tokens_by_user.get(user_id, ()))
+
+    def remembered(self, now: Optional[float] = None) -> Iterator[Tuple[str, dict]]:
+        """Live remember-me sessions, oldest first"""
+        now = time.time() if now is None else now
+        with self._lock:
+            live = [(token, self.sessions[token]) for token in self._remembered
+                    if now <= self.sessions[token]['expires_at']]
+        return iter(live)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Delete expired sessions, returns how many"""
+        now = time.time() if now is None else now
+        removed = []
+        with self._lock:
+            while self._expiries and self._expiries[0][0] < now:
+                expires_at, token = heapq.heappop(self._expiries)
+                session = self.sessions.get(token)
+                # Skip entries superseded by an extension and already deleted sessions
+                if session is not None and session['expires_at'] == expires_at:
+                    self._remove(token)
+                    removed.append(token)
+            # Superseded entries accumulate with extensions; rebuild once they dominate
+            if len(self._expiries) > 2 * len(self.sessions) + 64:
+                self._expiries = [(s['expires_at'], t) for t, s in self.sessions.items()]
+                heapq.heapify(self._expiries)
+            self.records.delete_many(removed)
+        return len(removed)
+
+    def _run_sweeper(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.sweep()
+            except OSError:
+                # Store not writable right now; try again next time
+                pass
+
+    def close(self):
+        """Stop the sweeper thread"""
+        self._stop.set()
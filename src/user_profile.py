@@ -1,21 +1,375 @@
-from dataclasses import dataclass
-from typing import List, Dict, Optional
-import json
+from array import array
+from collections.abc import MutableSequence
+from dataclasses import dataclass, fields
+from itertools import accumulate, chain
+from typing import List, Dict, Hashable, Iterable, Iterator, NamedTuple, Optional, Tuple, Union
+import heapq
 import os
+import threading
+import numpy as np
+from change_feed import ChangeFeed, FeedCursor
+from item_frequencies import ItemFrequencies
+from match_engine import MatchEngine, normalize_key
+from match_index import InvertedIndex, entry_sizes, profile_entry, score_upper_bound
+from match_table import MatchTable
+from minhash_lsh import MinHashLSH
+from profile_cache import ProfileCache
+from profile_store import open_store
+from profile_writer import WriteBehindQueue
+from scoring import DEFAULT_SCORER, ScoringPipeline, ScoringSpec, get_scorer
+from vocabulary import Vocabularies
 
 @dataclass
 class MusicPreference:
+    __slots__ = ('track_id', 'name', 'artists', 'album', 'rating')
+
     track_id: str
     name: str
     artists: List[str]
     album: str
     rating: float  # 0-1 scale indicating how much the user likes this track
 
+class _PreferenceRow(MusicPreference):
+    """
+    MusicPreference read from a PreferenceTable. Read-only, since edits
+    could not reach the table: assign or upsert a MusicPreference instead
+    (copy.copy gives an editable one).
+    """
+    __slots__ = ()
+
+    def __init__(self, track_id: str, name: str, artists: Iterable[str], album: str, rating: float):
+        for field, value in zip(MusicPreference.__slots__, (track_id, name, tuple(artists), album, rating)):
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("preferences read from a PreferenceTable are read-only; "
+                             "assign or upsert a MusicPreference instead")
+
+    def __delattr__(self, name):
+        self.__setattr__(name, None)
+
+    def _fields(self) -> tuple:
+        return self.track_id, self.name, list(self.artists), self.album, self.rating
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, MusicPreference):
+            return self._fields() == _PreferenceRow._fields(other)
+        return NotImplemented
+
+    def __reduce__(self):
+        return MusicPreference, self._fields()
+
+def _shift(ends: array, index: int, delta: int):
+    """Add delta to every offset from index on, after an insertion or deletion"""
+    if delta:
+        # In place through the array's buffer, without a Python-level loop
+        tail = np.frombuffer(ends, dtype=np.uintc)[index:]
+        if delta > 0:
+            tail += delta
+        else:
+            tail -= -delta
+
+class _StringColumn:
+    """Strings packed into one UTF-8 buffer, each followed by a NUL, with the end offset of each"""
+    __slots__ = ('data', 'ends', 'plain')
+
+    def __init__(self, strings: Iterable[str] = ()):
+        self.data = bytearray()
+        self.ends = array('I')
+        # No string contains NUL, so the buffer can be split on it
+        self.plain = True
+        self.extend(strings)
+
+    def __len__(self) -> int:
+        return len(self.ends)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, _StringColumn) and self.ends == other.ends and self.data == other.data
+
+    def extend(self, strings: Iterable[str]):
+        strings = list(strings)
+        if not strings:
+            return
+        joined = '\x00'.join(strings)
+        if joined.count('\x00') != len(strings) - 1:
+            self.plain = False
+        if joined.isascii():
+            lengths = [len(s) + 1 for s in strings]
+        else:
+            lengths = [len(s.encode('utf-8')) + 1 for s in strings]
+        base = self.ends[-1] if self.ends else 0
+        self.ends.extend(accumulate(lengths, initial=base))
+        del self.ends[-len(strings) - 1]
+        self.data += joined.encode('utf-8')
+        self.data += b'\x00'
+
+    def _span(self, index: int) -> Tuple[int, int]:
+        return self.ends[index - 1] if index else 0, self.ends[index]
+
+    def __getitem__(self, index: int) -> str:
+        start, end = self._span(index)
+        return self.data[start:end - 1].decode('utf-8')
+
+    def insert(self, index: int, value: str):
+        if '\x00' in value:
+            self.plain = False
+        encoded = value.encode('utf-8') + b'\x00'
+        start = self.ends[index - 1] if index else 0
+        self.data[start:start] = encoded
+        self.ends.insert(index, start)
+        _shift(self.ends, index, len(encoded))
+
+    def __delitem__(self, index: int):
+        start, end = self._span(index)
+        del self.data[start:end]
+        del self.ends[index]
+        _shift(self.ends, index, start - end)
+
+    def tolist(self) -> List[str]:
+        if not self.ends:
+            return []
+        if self.plain:
+            return self.data[:-1].decode('utf-8').split('\x00')
+        return [self[i] for i in range(len(self.ends))]
+
+    def copy(self) -> '_StringColumn':
+        clone = _StringColumn()
+        clone.data = bytearray(self.data)
+        clone.ends = array('I', self.ends)
+        clone.plain = self.plain
+        return clone
+
+class PreferenceTable(MutableSequence):
+    """
+    Column store for a profile's music preferences, used as a list of
+    MusicPreference.
+
+    Track ids and names are packed into one UTF-8 buffer per column,
+    ratings into a float array, and artist and album names are ids into a
+    per-table label pool (a heavy listener's history repeats the same
+    artists and albums thousands of times), the artists of preference i
+    being artist_ids[artist_ends[i - 1]:artist_ends[i]]. Indexing and
+    iteration build read-only MusicPreference snapshots (artists as a
+    tuple); assign, append or `upsert` a preference to change the table.
+    Matching code reads the `track_ids` and `ratings` columns directly.
+    `position`, `get` and `upsert` look tracks up by id in O(1) through a
+    track_id index built on first use and kept up to date by appends.
+    """
+
+    def __init__(self, preferences: Iterable[MusicPreference] = ()):
+        self._track_ids = _StringColumn()
+        self._names = _StringColumn()
+        self.ratings = array('d')
+        self.album_ids = array('I')
+        self.artist_ids = array('I')
+        self.artist_ends = array('I')
+        self._labels: List[str] = []
+        self._label_ids: Dict[str, int] = {}
+        # track_id -> position of its first preference, built on the first lookup
+        self._positions: Optional[Dict[str, int]] = None
+        self.extend(preferences)
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, list]) -> 'PreferenceTable':
+        """Table from columns as produced by profile_codec.decode"""
+        table = cls()
+        table._track_ids.extend(columns['track_id'])
+        table._names.extend(columns['name'])
+        table.ratings = array('d', columns['rating'])
+        table.album_ids = array('I', map(table._label, columns['album']))
+        table.artist_ids = array('I', map(table._label, chain.from_iterable(columns['artists'])))
+        table.artist_ends = array('I', accumulate(map(len, columns['artists'])))
+        return table
+
+    @classmethod
+    def from_dicts(cls, preferences: List[dict]) -> 'PreferenceTable':
+        return cls.from_columns({field: [p[field] for p in preferences]
+                                 for field in ('track_id', 'name', 'artists', 'album', 'rating')})
+
+    @property
+    def track_ids(self) -> List[str]:
+        """Track id of every preference (a new list)"""
+        return self._track_ids.tolist()
+
+    @property
+    def names(self) -> List[str]:
+        return self._names.tolist()
+
+    def _label(self, name: str) -> int:
+        label = self._label_ids.get(name)
+        if label is None:
+            label = self._label_ids[name] = len(self._labels)
+            self._labels.append(name)
+        return label
+
+    def _artist_span(self, index: int) -> Tuple[int, int]:
+        return self.artist_ends[index - 1] if index else 0, self.artist_ends[index]
+
+    def _row(self, index: int) -> MusicPreference:
+        start, end = self._artist_span(index)
+        labels = self._labels
+        return _PreferenceRow(
+            track_id=self._track_ids[index],
+            name=self._names[index],
+            artists=[labels[a] for a in self.artist_ids[start:end]],
+            album=labels[self.album_ids[index]],
+            rating=self.ratings[index]
+        )
+
+    def position(self, track_id: str) -> int:
+        """Position of the first preference for a track, -1 if there is none"""
+        if self._positions is None:
+            positions = {}
+            for i, t in enumerate(self.track_ids):
+                positions.setdefault(t, i)
+            self._positions = positions
+        return self._positions.get(track_id, -1)
+
+    def get(self, track_id: str) -> Optional[MusicPreference]:
+        index = self.position(track_id)
+        return self._row(index) if index >= 0 else None
+
+    def upsert(self, preference: MusicPreference) -> bool:
+        """Replace the preference for the same track or append it, True if it was appended"""
+        index = self.position(preference.track_id)
+        if index >= 0:
+            self[index] = preference
+            return False
+        self.append(preference)
+        return True
+
+    def _index(self, index: int) -> int:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("preference index out of range")
+        return index
+
+    def __len__(self) -> int:
+        return len(self.ratings)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._row(i) for i in range(*index.indices(len(self)))]
+        return self._row(self._index(index))
+
+    def __iter__(self) -> Iterator[MusicPreference]:
+        return map(self._row, range(len(self)))
+
+    def __setitem__(self, index: int, preference: MusicPreference):
+        index = self._index(index)
+        if self._track_ids[index] != preference.track_id:
+            del self[index]
+            self.insert(index, preference)
+            return
+        # Same track: update in place, the positions stay valid
+        if self._names[index] != preference.name:
+            del self._names[index]
+            self._names.insert(index, preference.name)
+        self.ratings[index] = preference.rating
+        self.album_ids[index] = self._label(preference.album)
+        start, end = self._artist_span(index)
+        self.artist_ids[start:end] = array('I', map(self._label, preference.artists))
+        _shift(self.artist_ends, index, len(preference.artists) - (end - start))
+
+    def __delitem__(self, index: int):
+        index = self._index(index)
+        start, end = self._artist_span(index)
+        del self._track_ids[index]
+        del self._names[index]
+        del self.ratings[index]
+        del self.album_ids[index]
+        del self.artist_ids[start:end]
+        del self.artist_ends[index]
+        _shift(self.artist_ends, index, start - end)
+        self._positions = None
+
+    def insert(self, index: int, preference: MusicPreference):
+        index = min(max(index + len(self) if index < 0 else index, 0), len(self))
+        start = self.artist_ends[index - 1] if index else 0
+        self._track_ids.insert(index, preference.track_id)
+        self._names.insert(index, preference.name)
+        self.ratings.insert(index, preference.rating)
+        self.album_ids.insert(index, self._label(preference.album))
+        self.artist_ids[start:start] = array('I', map(self._label, preference.artists))
+        self.artist_ends.insert(index, start)
+        _shift(self.artist_ends, index, len(preference.artists))
+        if index < len(self) - 1:
+            self._positions = None
+        elif self._positions is not None:
+            self._positions.setdefault(preference.track_id, index)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, PreferenceTable):
+            return (self._track_ids == other._track_ids and self._names == other._names
+                    and self.ratings == other.ratings and self.to_dicts() == other.to_dicts())
+        if isinstance(other, list):
+            return list(self) == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"PreferenceTable({list(self)!r})"
+
+    def copy(self) -> 'PreferenceTable':
+        clone = PreferenceTable.__new__(PreferenceTable)
+        clone._track_ids = self._track_ids.copy()
+        clone._names = self._names.copy()
+        clone.ratings = array('d', self.ratings)
+        clone.album_ids = array('I', self.album_ids)
+        clone.artist_ids = array('I', self.artist_ids)
+        clone.artist_ends = array('I', self.artist_ends)
+        clone._labels = list(self._labels)
+        clone._label_ids = dict(self._label_ids)
+        clone._positions = None
+        return clone
+
+    def to_dicts(self) -> List[dict]:
+        labels = self._labels
+        artists = [labels[a] for a in self.artist_ids]
+        starts = [0]
+        starts.extend(self.artist_ends)
+        return [
+            {
+                'track_id': track_id,
+                'name': name,
+                'artists': artists[start:end],
+                'album': labels[album],
+                'rating': rating
+            } for track_id, name, album, rating, start, end in zip(
+                self.track_ids, self.names, self.album_ids, self.ratings, starts, self.artist_ends
+            )
+        ]
+
+def _preferences_from_data(preferences) -> PreferenceTable:
+    """PreferenceTable from a list of dicts (JSON) or from columns (binary codec)"""
+    if isinstance(preferences, dict):
+        return PreferenceTable.from_columns(preferences)
+    return PreferenceTable.from_dicts(preferences)
+
+def _match_keys(top_artists: List[str], top_genres: List[str]) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    return tuple(normalize_key(a) for a in top_artists), tuple(normalize_key(g) for g in top_genres)
+
+def _item_ids(vocabularies: Vocabularies, match_keys: Tuple[Tuple[str, ...], Tuple[str, ...]],
+              track_ids: List[str], album_names: List[str]) -> Dict[str, array]:
+    artist_keys, genre_keys = match_keys
+    return {
+        'artists': vocabularies.artists.ids(artist_keys),
+        'genres': vocabularies.genres.ids(genre_keys),
+        'tracks': vocabularies.tracks.ids(track_ids),
+        'albums': vocabularies.albums.ids(normalize_key(name) for name in album_names)
+    }
+
+def _item_arrays(ids: Dict[str, array]) -> Dict[str, np.ndarray]:
+    return {
+        kind: np.frombuffer(values, dtype=np.uint32) if len(values) else np.zeros(0, dtype=np.uint32)
+        for kind, values in ids.items()
+    }
+
 @dataclass
 class UserProfile:
     user_id: str
     username: str
-    music_preferences: List[MusicPreference]
+    music_preferences: PreferenceTable  # a list of MusicPreference is converted on assignment
     top_artists: List[str]
     top_genres: List[str]
     top_songs: List[dict]
@@ -33,6 +387,74 @@ class UserProfile:
     bio: str = ""
     profile_picture_path: str = ""
     
+    # Normalized artist/genre keys for matching, see match_keys()
+    _match_keys = None
+    # (vocabularies, {kind: array('I')}) cache of item_ids()
+    _item_ids = None
+    
+    def __setattr__(self, name, value):
+        if name == 'music_preferences' and not isinstance(value, PreferenceTable):
+            value = PreferenceTable(value)
+        super().__setattr__(name, value)
+        if name in ('top_artists', 'top_genres'):
+            super().__setattr__('_match_keys', None)
+            super().__setattr__('_item_ids', None)
+        elif name in ('music_preferences', 'top_albums'):
+            super().__setattr__('_item_ids', None)
+    
+    def match_keys(self) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+        """
+        Normalized (casefolded, NFKC, interned) keys of top_artists and top_genres,
+        duplicates kept. Computed once and cached; the profile manager refreshes
+        them on load and save, which also covers in-place edits of the lists.
+        """
+        if self._match_keys is None:
+            self.refresh_match_keys()
+        return self._match_keys
+    
+    def refresh_match_keys(self):
+        super().__setattr__('_match_keys', _match_keys(self.top_artists, self.top_genres))
+        super().__setattr__('_item_ids', None)
+    
+    def item_ids(self, vocabularies: Vocabularies) -> Dict[str, array]:
+        """
+        The profile's artists, genres, rated tracks and top albums as global
+        vocabulary ids (array('I'), duplicates and order kept). Cached until
+        one of the underlying lists changes.
+        """
+        if self._item_ids is None or self._item_ids[0] is not vocabularies:
+            ids = _item_ids(vocabularies, self.match_keys(), self.music_preferences.track_ids,
+                            [a['name'] for a in self.top_albums if a.get('name')])
+            super().__setattr__('_item_ids', (vocabularies, ids))
+        return self._item_ids[1]
+    
+    def item_arrays(self, vocabularies: Vocabularies) -> Dict[str, np.ndarray]:
+        """Same as item_ids() as zero-copy uint32 NumPy arrays"""
+        return _item_arrays(self.item_ids(vocabularies))
+    
+    def get_preference(self, track_id: str) -> Optional[MusicPreference]:
+        """The preference for a track (first one if listed twice), None if the track is not rated"""
+        return self.music_preferences.get(track_id)
+    
+    def upsert_preference(self, preference: MusicPreference) -> bool:
+        """Replace the preference for the same track_id or add it, True if it was added"""
+        added = self.music_preferences.upsert(preference)
+        super().__setattr__('_item_ids', None)
+        return added
+    
+    def copy(self) -> 'UserProfile':
+        """
+        Copy with its own lists (list items are shared and treated as immutable:
+        callers replace preferences and top items rather than editing them).
+        Cached match keys and item ids carry over.
+        """
+        clone = object.__new__(UserProfile)
+        for name, value in self.__dict__.items():
+            if isinstance(value, (list, PreferenceTable)):
+                value = value.copy()
+            object.__setattr__(clone, name, value)
+        return clone
+    
     def __post_init__(self):
         # Initialize empty lists for favorites if None
         if self.favorite_artists is None:
@@ -48,15 +470,7 @@ class UserProfile:
         return {
             'user_id': self.user_id,
             'username': self.username,
-            'music_preferences': [
-                {
-                    'track_id': p.track_id,
-                    'name': p.name,
-                    'artists': p.artists,
-                    'album': p.album,
-                    'rating': p.rating
-                } for p in self.music_preferences
-            ],
+            'music_preferences': self.music_preferences.to_dicts(),
             'top_artists': self.top_artists,
             'top_genres': self.top_genres,
             'top_songs': self.top_songs,
@@ -79,15 +493,7 @@ class UserProfile:
         return cls(
             user_id=data['user_id'],
             username=data['username'],
-            music_preferences=[
-                MusicPreference(
-                    track_id=p['track_id'],
-                    name=p['name'],
-                    artists=p['artists'],
-                    album=p['album'],
-                    rating=p['rating']
-                ) for p in data['music_preferences']
-            ],
+            music_preferences=_preferences_from_data(data['music_preferences']),
             top_artists=data['top_artists'],
             top_genres=data['top_genres'],
             top_songs=data.get('top_songs', []),
@@ -105,24 +511,326 @@ class UserProfile:
             profile_picture_path=data.get('profile_picture_path', '')
         )
 
+class TrackRatings(NamedTuple):
+    """The two PreferenceTable columns matching reads"""
+    track_ids: List[str]
+    ratings: array
+
+class MatchFeatures:
+    """
+    The parts of a profile that matching reads: top artists and genres, rated
+    track ids with their ratings and top album names. Loaded without parsing
+    the rest of the profile (see UserProfileManager.load_match_features) and
+    accepted by the match index, engine and LSH index in place of a
+    UserProfile; `music_preferences` only has the `track_ids` and `ratings`
+    columns.
+    """
+    __slots__ = ('user_id', 'top_artists', 'top_genres', 'album_names', 'music_preferences',
+                 '_match_keys', '_item_ids')
+    
+    def __init__(self, user_id: str, top_artists: List[str], top_genres: List[str],
+                 album_names: List[str], track_ids: List[str], ratings: array):
+        self.user_id = user_id
+        self.top_artists = top_artists
+        self.top_genres = top_genres
+        self.album_names = album_names
+        self.music_preferences = TrackRatings(track_ids, ratings)
+        self._match_keys = None
+        self._item_ids = None
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'MatchFeatures':
+        """From a store's feature record (see profile_codec.match_features)"""
+        return cls(data['user_id'], data['top_artists'], data['top_genres'], data['albums'],
+                   data['track_ids'], array('d', data['ratings']))
+    
+    @classmethod
+    def from_profile(cls, profile: UserProfile) -> 'MatchFeatures':
+        preferences = profile.music_preferences
+        features = cls(profile.user_id, profile.top_artists, profile.top_genres,
+                       [a['name'] for a in profile.top_albums if a.get('name')],
+                       preferences.track_ids, preferences.ratings)
+        features._match_keys = profile.match_keys()
+        features._item_ids = profile._item_ids
+        return features
+    
+    def match_keys(self) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+        if self._match_keys is None:
+            self._match_keys = _match_keys(self.top_artists, self.top_genres)
+        return self._match_keys
+    
+    def item_ids(self, vocabularies: Vocabularies) -> Dict[str, array]:
+        if self._item_ids is None or self._item_ids[0] is not vocabularies:
+            self._item_ids = (vocabularies, _item_ids(vocabularies, self.match_keys(),
+                                                      self.music_preferences.track_ids, self.album_names))
+        return self._item_ids[1]
+    
+    def item_arrays(self, vocabularies: Vocabularies) -> Dict[str, np.ndarray]:
+        return _item_arrays(self.item_ids(vocabularies))
+
 class UserProfileManager:
-    def __init__(self, storage_dir: str = 'data/profiles', pictures_dir: str = 'data/profile_pictures'):
+    def __init__(self, storage_dir: str = 'data/profiles', pictures_dir: str = 'data/profile_pictures',
+                 index_file: Optional[str] = None, table_file: Optional[str] = None,
+                 approximate_matching: bool = False,
+                 scoring: Union[None, ScoringSpec, ScoringPipeline] = None,
+                 storage_backend: str = 'json', database_file: Optional[str] = None,
+                 cache_size: int = 256, write_delay: Optional[float] = None,
+                 storage_layout: Optional[str] = None, feed_dir: Optional[str] = None):
+        """
+        `scoring` selects the compatibility formula: a scoring pipeline, a kernel
+        name such as 'jaccard' or 'bm25', or a {field: kernel name} dict
+        (see scoring.compile_scorer). Default: the 0.4/0.3/0.3 overlap formula.
+        `storage_backend` is 'json' (one file per user in storage_dir), 'binary'
+        (the same in the compact profile_codec format, reading existing JSON
+        files) or 'sqlite' (`database_file`, default profiles.db next to storage_dir).
+        The file backends keep storage_dir flat or, with `storage_layout`
+        'sharded', in hash-prefix subdirectories with a manifest of user ids
+        (see profile_layout); by default whichever layout the directory uses.
+        Up to `cache_size` parsed profiles are kept in memory. With a
+        `write_delay` (seconds), saves are written behind by a background
+        thread, coalescing repeated saves of a profile; call flush() or
+        close() before exiting. The change diff and the updates of the match
+        index, engine and table then run on that thread too, after the write,
+        so matching sees a save once it is written.
+        Every save and deletion is recorded in the change feed in `feed_dir`
+        (default: changes/ next to storage_dir, see change_feed).
+        """
         self.storage_dir = storage_dir
         self.pictures_dir = pictures_dir
-        os.makedirs(storage_dir, exist_ok=True)
         os.makedirs(pictures_dir, exist_ok=True)
+        self.store = open_store(storage_backend, storage_dir, database_file, storage_layout)
+        self.profile_cache = ProfileCache(cache_size)
+        # Guards the cache and engine versions, also updated by the writer thread
+        self._lock = threading.RLock()
+        # Serializes updates of the match index, LSH index, engine and table with queries.
+        # Never held while waiting for the writer (flush, discard), which takes it after each write.
+        self._matching_lock = threading.RLock()
+        self.writer = None
+        if write_delay is not None:
+            self.writer = WriteBehindQueue(self.store, write_delay, on_written=self._profile_written,
+                                           before_write=self._diff_batch)
+        data_dir = os.path.dirname(os.path.abspath(storage_dir))
+        # Global artist/genre/track/album -> integer id mapping
+        self.vocabulary = Vocabularies(os.path.join(data_dir, 'vocabulary'))
+        # Append-only log of saved and deleted profiles for incremental consumers
+        self.change_feed = ChangeFeed(feed_dir or os.path.join(data_dir, 'changes'))
+        # Tails the feed for saves and deletions by other processes, which outdate engine rows
+        self._feed_cursor = FeedCursor(self.change_feed, self.change_feed.end())
+        # Fields changed by saves being written, for their change feed records
+        self._pending_changes: Dict[str, Dict[str, None]] = {}
+        self.scorer = get_scorer(scoring)
+        # Population document frequencies per vocabulary id, maintained by the match index
+        self.item_frequencies = ItemFrequencies(self.vocabulary)
+        # Encoded profiles for batch matching, refreshed when their stored version changes
+        self.match_engine = MatchEngine(self.vocabulary, self.scorer, self.item_frequencies)
+        self._engine_versions: Dict[str, Hashable] = {}
+        # Artist/genre/track -> users index used to find match candidates
+        if index_file is None:
+            index_file = os.path.join(data_dir, 'match_index.jsonl')
+        self.match_index = InvertedIndex(index_file, self.item_frequencies)
+        if not self.match_index.exists():
+            self.rebuild_match_index()
+        # Materialized top-K partners per user, patched on every save; one table per formula
+        if table_file is None:
+            suffix = '' if self.scorer is DEFAULT_SCORER else f'_{self.scorer.name}'
+            table_file = os.path.join(os.path.dirname(index_file), f'match_table{suffix}.jsonl')
+        self.match_table = MatchTable(table_file)
+        if not self.match_table.exists():
+            # Rows are filled in lazily by get_matches until the next batch rebuild
+            self.match_table.rebuild([])
+        # Optional MinHash/LSH index for approximate matching on very large user bases
+        self.approximate_matching = approximate_matching
+        self.lsh_index = None
+        if approximate_matching:
+            self.lsh_index = MinHashLSH(os.path.join(os.path.dirname(index_file), 'minhash_lsh.jsonl'))
+            if not self.lsh_index.exists():
+                self.lsh_index.rebuild(self.load_all_match_features())
     
     def save_profile(self, profile: UserProfile):
-        file_path = os.path.join(self.storage_dir, f"{profile.user_id}.json")
-        with open(file_path, 'w') as f:
-            json.dump(profile.to_dict(), f, indent=2)
+        profile.refresh_match_keys()
+        # Detached from the caller's object, which may keep being edited
+        saved = profile.copy()
+        if self.writer is not None:
+            # Diffed, written and matched on the writer thread
+            self.writer.submit(saved)
+            return
+        self._pending_changes[profile.user_id] = dict.fromkeys(self._changed_fields(profile))
+        self.store.write(profile.user_id, profile.to_dict())
+        self._profile_written(profile.user_id, saved, self.store.version(profile.user_id))
+    
+    def _changed_fields(self, profile: UserProfile) -> List[str]:
+        """Fields of a profile about to be written that differ from its stored state"""
+        version = self.store.version(profile.user_id)
+        if version is None:
+            return [f.name for f in fields(UserProfile)]
+        with self._lock:
+            previous = self.profile_cache.peek(profile.user_id, version)
+        if previous is None:
+            data = self.store.read(profile.user_id)
+            if data is None:
+                return [f.name for f in fields(UserProfile)]
+            previous = UserProfile.from_dict(data)
+        return [f.name for f in fields(UserProfile) if getattr(profile, f.name) != getattr(previous, f.name)]
+    
+    def _diff_batch(self, profiles: List[UserProfile]):
+        """Writer thread: record the changed fields of a batch about to be written"""
+        for profile in profiles:
+            changed = dict.fromkeys(self._changed_fields(profile))
+            with self._lock:
+                self._pending_changes[profile.user_id] = changed
+    
+    def _profile_written(self, user_id: str, profile: UserProfile, version: Hashable):
+        """
+        A saved profile reached the store: remember its version for the engine
+        and the cache, record the change and update the matching structures
+        """
+        with self._lock:
+            self._engine_versions[user_id] = version
+            self.profile_cache.put(user_id, version, profile)
+            changed = self._pending_changes.pop(user_id, None)
+        if changed:
+            self.change_feed.append(user_id, 'save', list(changed), version)
+        with self._matching_lock:
+            # Registers any new artist/genre/track/album in the vocabulary
+            profile.item_ids(self.vocabulary)
+            index_changed = self.match_index.update(profile)
+            if index_changed and self.lsh_index is not None:
+                self.lsh_index.update(profile)
+            matching_changed = self.match_engine.update(profile) or index_changed
+            if matching_changed:
+                # Re-score this user's row and column of the match table
+                scores = self._score_all(profile, self.match_table.min_compatibility)
+                self.match_table.update_user(user_id, scores)
+    
+    def flush(self):
+        """Write pending saves now (write-behind mode), e.g. on logout"""
+        if self.writer is not None:
+            self.writer.flush()
+    
+    def close(self):
+        """Flush pending saves and stop the background writer"""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+    
+    def delete_profile(self, user_id: str):
+        """Delete a user's stored profile and drop it from the match index"""
+        if self.writer is not None:
+            self.writer.discard(user_id)
+        self.store.delete(user_id)
+        with self._lock:
+            self.profile_cache.discard(user_id)
+            self._pending_changes.pop(user_id, None)
+        self.change_feed.append(user_id, 'delete', [])
+        with self._matching_lock:
+            self.match_index.remove(user_id)
+            self.match_table.remove(user_id)
+            if self.lsh_index is not None:
+                self.lsh_index.remove(user_id)
+            self.match_engine.remove(user_id)
+            self._engine_versions.pop(user_id, None)
+    
+    def list_user_ids(self) -> List[str]:
+        """Ids of every stored profile"""
+        self.flush()
+        return self.store.user_ids()
+    
+    def rebuild_match_index(self):
+        """Rebuild the match index from every stored profile"""
+        self.flush()
+        with self._matching_lock:
+            # Saves written meanwhile update the rebuilt index once it is released
+            self.match_index.rebuild(self._read_all_match_features())
     
     def load_profile(self, user_id: str) -> UserProfile:
-        file_path = os.path.join(self.storage_dir, f"{user_id}.json")
-        if not os.path.exists(file_path):
-            return None
-        with open(file_path, 'r') as f:
-            return UserProfile.from_dict(json.load(f))
+        """
+        Load a profile, from the cache while its stored version is unchanged.
+        Every call returns a separate copy, so unsaved edits never leak into
+        other callers.
+        """
+        return self.load_profiles([user_id]).get(user_id)
+    
+    def load_profiles(self, user_ids: List[str]) -> Dict[str, UserProfile]:
+        """Load many profiles at once (a few queries with the SQLite backend), skipping missing ones"""
+        profiles = {}
+        versions = {}
+        for user_id in user_ids:
+            pending = self.writer.pending(user_id) if self.writer is not None else None
+            if pending is not None:
+                profiles[user_id] = pending.copy()
+                continue
+            version = self.store.version(user_id)
+            with self._lock:
+                if version is None:
+                    self.profile_cache.discard(user_id)
+                    continue
+                cached = self.profile_cache.get(user_id, version)
+            if cached is not None:
+                profiles[user_id] = cached.copy()
+            else:
+                versions[user_id] = version
+        for user_id, data in self.store.read_many(versions).items():
+            profile = UserProfile.from_dict(data)
+            profile.refresh_match_keys()
+            with self._lock:
+                self.profile_cache.put(user_id, versions[user_id], profile)
+            profiles[user_id] = profile.copy()
+        return profiles
+    
+    def load_match_features(self, user_id: str) -> Optional[MatchFeatures]:
+        """Only the parts of a profile matching reads, without parsing the whole profile"""
+        return self.load_match_features_many([user_id]).get(user_id)
+    
+    def load_match_features_many(self, user_ids: List[str]) -> Dict[str, MatchFeatures]:
+        """Match features of many users, skipping missing ones"""
+        features = {}
+        versions = {}
+        for user_id in user_ids:
+            pending = self.writer.pending(user_id) if self.writer is not None else None
+            if pending is not None:
+                features[user_id] = MatchFeatures.from_profile(pending)
+                continue
+            version = self.store.version(user_id)
+            if version is not None:
+                versions[user_id] = version
+        features.update(self._match_features(versions))
+        return features
+    
+    def _match_features(self, versions: Dict[str, Hashable]) -> Dict[str, MatchFeatures]:
+        """Features of users at the given store versions, from cached profiles or the store's feature records"""
+        features = {}
+        misses = []
+        for user_id, version in versions.items():
+            with self._lock:
+                cached = self.profile_cache.peek(user_id, version)
+            if cached is not None:
+                features[user_id] = MatchFeatures.from_profile(cached)
+            else:
+                misses.append(user_id)
+        for user_id, data in self.store.read_features_many(misses).items():
+            features[user_id] = MatchFeatures.from_dict(data)
+        return features
+    
+    def load_all_match_features(self) -> Iterator[MatchFeatures]:
+        """Match features of every stored profile, read in bulk"""
+        self.flush()
+        return self._read_all_match_features()
+    
+    def _read_all_match_features(self) -> Iterator[MatchFeatures]:
+        for data in self.store.read_all_features():
+            yield MatchFeatures.from_dict(data)
+    
+    def cache_stats(self) -> Dict[str, float]:
+        """Hit/miss statistics of the profile cache"""
+        return self.profile_cache.stats()
+    
+    def load_all_profiles(self) -> Iterator[UserProfile]:
+        """Every stored profile, read in bulk"""
+        self.flush()
+        for data in self.store.read_all():
+            profile = UserProfile.from_dict(data)
+            profile.refresh_match_keys()
+            yield profile
     
     def save_profile_picture(self, user_id: str, image_path: str) -> str:
         """Save a profile picture and return the saved path"""
@@ -162,66 +870,224 @@ class UserProfileManager:
     def calculate_compatibility(self, profile1: UserProfile, profile2: UserProfile) -> float:
         """
         Calculate compatibility score between two users based on their music preferences.
-        Returns a score between 0 and 1.
-        """
-        # Calculate artist overlap
-        artist_scores = []
-        for artist1 in profile1.top_artists:
-            for artist2 in profile2.top_artists:
-                if artist1.lower() == artist2.lower():
-                    artist_scores.append(1.0)
-        
-        # Calculate genre overlap
-        genre_scores = []
-        for genre1 in profile1.top_genres:
-            for genre2 in profile2.top_genres:
-                if genre1.lower() == genre2.lower():
-                    genre_scores.append(1.0)
-        
-        # Calculate track preference similarity
-        track_scores = []
-        for pref1 in profile1.music_preferences:
-            for pref2 in profile2.music_preferences:
-                if pref1.track_id == pref2.track_id:
-                    # Calculate how similar their ratings are
-                    rating_diff = abs(pref1.rating - pref2.rating)
-                    track_scores.append(1.0 - rating_diff)
-        
-        # Weight the different factors
-        artist_weight = 0.4
-        genre_weight = 0.3
-        track_weight = 0.3
-        
-        artist_score = sum(artist_scores) / max(len(profile1.top_artists), len(profile2.top_artists)) if artist_scores else 0
-        genre_score = sum(genre_scores) / max(len(profile1.top_genres), len(profile2.top_genres)) if genre_scores else 0
-        track_score = sum(track_scores) / max(len(profile1.music_preferences), len(profile2.music_preferences)) if track_scores else 0
-        
-        final_score = (
-            artist_score * artist_weight +
-            genre_score * genre_weight +
-            track_score * track_weight
-        )
-        
-        return min(max(final_score, 0), 1)  # Ensure score is between 0 and 1
+        Returns a score between 0 and 1, the same find_matches reports (IDF
+        kernels weigh items by their frequency in the whole population).
+        """
+        with self._matching_lock:
+            return float(self.match_engine.score(profile1, self.match_engine.encode([profile2]))[0])
+    
+    def _poll_changes(self):
+        """Forget the engine version of every user saved or deleted elsewhere since the last poll"""
+        gap, records = self._feed_cursor.poll()
+        with self._lock:
+            if gap:
+                self._engine_versions.clear()
+            for record in records:
+                version = record.get('version')
+                if isinstance(version, list):
+                    version = tuple(version)  # JSON turned the file stores' versions into lists
+                if self._engine_versions.get(record['user_id']) != version:
+                    self._engine_versions.pop(record['user_id'], None)
+    
+    def _refresh_engine_rows(self, user_ids: List[str]) -> List[str]:
+        """
+        Make sure the engine holds the current encoding of the given users,
+        reading only the match features of the stale ones. Returns the users
+        whose profile still exists, in order. Rows written by this manager
+        are current; the change feed tells which ones other processes
+        outdated, so only users without a known version are looked up.
+        """
+        self._poll_changes()
+        present = []
+        stale = {}
+        for user_id in user_ids:
+            if user_id in self._engine_versions and user_id in self.match_engine:
+                present.append(user_id)
+                continue
+            # Saves not written yet are matched by their stored version until the writer updates the engine
+            version = self.store.version(user_id)
+            if version is None:
+                # Deleted behind our back
+                self.match_index.remove(user_id)
+                self.match_engine.remove(user_id)
+                self._engine_versions.pop(user_id, None)
+                continue
+            stale[user_id] = version
+            present.append(user_id)
+        if not stale:
+            return present
+        features = self._match_features(stale)
+        for user_id, version in stale.items():
+            if user_id in features:
+                self.match_engine.update(features[user_id])
+                self._engine_versions[user_id] = version
+        return [user_id for user_id in present if user_id not in stale or user_id in features]
+    
+    def _match_candidates(self, user_profile: UserProfile, min_compatibility: float) -> List[Tuple[float, str]]:
+        """
+        (upper bound, user_id) of every user that may reach the threshold, best bound first.
+        Only users sharing at least one item with the profile can score above 0.
+        """
+        entry = profile_entry(user_profile)
+        own_sizes = entry_sizes(entry)
+        with self._matching_lock:
+            self.match_index.refresh()
+            bounds = {
+                other_id: score_upper_bound(pairs, own_sizes, self.match_index.sizes(other_id), self.scorer)
+                for other_id, pairs in self.match_index.overlaps(entry).items()
+            }
+            if min_compatibility <= 0:
+                # Even users without any overlap qualify
+                for other_id in self.match_index.entries:
+                    bounds.setdefault(other_id, 0.0)
+        bounds.pop(user_profile.user_id, None)
+        candidates = [(bound, other_id) for other_id, bound in bounds.items() if bound >= min_compatibility]
+        candidates.sort(reverse=True)
+        return candidates
     
-    def find_matches(self, user_id: str, min_compatibility: float = 0.5) -> List[tuple[UserProfile, float]]:
+    def _score_candidates(self, user_profile: UserProfile, candidates: List[Tuple[float, str]],
+                          batch_size: Optional[int] = None) -> Iterator[Tuple[List[Tuple[str, float]], float]]:
+        """
+        Score ranked candidates in batches. Yields each batch's (user_id, score) pairs
+        together with the upper bound of the best candidate not scored yet (-1 when done).
+        """
+        batch_size = batch_size or max(len(candidates), 1)
+        for start in range(0, len(candidates), batch_size):
+            with self._matching_lock:
+                batch = self._refresh_engine_rows([other_id for _, other_id in candidates[start:start + batch_size]])
+                scores = self.match_engine.score(user_profile, self.match_engine.subset(batch))
+            next_start = start + batch_size
+            next_bound = candidates[next_start][0] if next_start < len(candidates) else -1.0
+            yield list(zip(batch, scores.tolist())), next_bound
+    
+    def _score_all(self, user_profile: UserProfile, min_compatibility: float) -> Dict[str, float]:
+        """Exact score of every user that may reach the threshold"""
+        candidates = self._match_candidates(user_profile, min_compatibility)
+        scores = {}
+        for scored, _ in self._score_candidates(user_profile, candidates):
+            scores.update(scored)
+        return scores
+    
+    def find_matches(self, user_id: str, min_compatibility: float = 0.5,
+                     approximate: Optional[bool] = None) -> List[tuple[UserProfile, float]]:
         """
         Find potential matches for a user based on music compatibility.
         Returns a list of tuples containing (profile, compatibility_score).
+        In approximate mode only the likely high-Jaccard candidates returned by the
+        MinHash/LSH index are scored (exactly), so some matches may be missed.
         """
         user_profile = self.load_profile(user_id)
         if not user_profile:
             return []
+        if approximate is None:
+            approximate = self.approximate_matching
         
-        matches = []
-        for filename in os.listdir(self.storage_dir):
-            if filename.endswith('.json') and filename != f"{user_id}.json":
-                other_profile = self.load_profile(filename[:-5])  # Remove .json extension
-                if other_profile:
-                    compatibility = self.calculate_compatibility(user_profile, other_profile)
-                    if compatibility >= min_compatibility:
-                        matches.append((other_profile, compatibility))
+        if approximate:
+            if self.lsh_index is None:
+                raise ValueError("Approximate matching is not enabled for this profile manager")
+            with self._matching_lock:
+                candidates = [(1.0, other_id) for other_id in self.lsh_index.query(user_profile)]
+        else:
+            candidates = self._match_candidates(user_profile, min_compatibility)
+        
+        # Score every candidate that may reach the threshold in one batch
+        scored_matches = []
+        for scored, _ in self._score_candidates(user_profile, candidates):
+            scored_matches.extend((other_id, score) for other_id, score in scored if score >= min_compatibility)
         
         # Sort matches by compatibility score
-        matches.sort(key=lambda x: x[1], reverse=True)
-        return matches 
\ No newline at end of file
+        scored_matches.sort(key=lambda x: x[1], reverse=True)
+        return self._load_matches(scored_matches)
+    
+    def _top_match_ids(self, user_profile: UserProfile, k: int, min_compatibility: float) -> List[Tuple[str, float]]:
+        """(user_id, score) of the k best matches, best first, with early termination"""
+        candidates = self._match_candidates(user_profile, min_compatibility)
+        top = []  # Min-heap of (score, user_id), at most k entries
+        for scored, next_bound in self._score_candidates(user_profile, candidates, batch_size=max(k, 64)):
+            for other_id, score in scored:
+                if score < min_compatibility:
+                    continue
+                if len(top) < k:
+                    heapq.heappush(top, (score, other_id))
+                elif score > top[0][0]:
+                    heapq.heapreplace(top, (score, other_id))
+            if len(top) == k and next_bound <= top[0][0]:
+                break
+        return [(other_id, score) for score, other_id in sorted(top, reverse=True)]
+    
+    def find_top_matches(self, user_id: str, k: int = 10, min_compatibility: float = 0.5) -> List[tuple[UserProfile, float]]:
+        """
+        Find the k best matches for a user, best first.
+        Candidates are scored in order of their upper bound and the scan stops as soon
+        as no remaining candidate can beat the current k-th score.
+        """
+        user_profile = self.load_profile(user_id)
+        if not user_profile or k <= 0:
+            return []
+        return self._load_matches(self._top_match_ids(user_profile, k, min_compatibility))
+    
+    def _load_matches(self, scored: List[Tuple[str, float]]) -> List[tuple[UserProfile, float]]:
+        profiles = self.load_profiles([other_id for other_id, _ in scored])
+        return [(profiles[other_id], score) for other_id, score in scored if other_id in profiles]
+    
+    def get_matches(self, user_id: str) -> List[tuple[UserProfile, float]]:
+        """
+        Look up a user's matches in the materialized match table.
+        A missing or incomplete row is computed on the spot and stored.
+        """
+        with self._matching_lock:
+            row = self.match_table.get(user_id)
+            if row is None:
+                user_profile = self.load_profile(user_id)
+                if not user_profile:
+                    return []
+                row = self._top_match_ids(user_profile, self.match_table.k, self.match_table.min_compatibility)
+                self.match_table.put(user_id, row)
+        return self._load_matches(row)
+    
+    def build_match_table(self, workers: Optional[int] = 1, shard_size: int = 2048):
+        """
+        Batch job: recompute every user's row of the match table from scratch.
+        With workers != 1 the scoring is spread over a process pool (None: all cores).
+        """
+        if workers != 1:
+            from batch_match import parallel_match_rows
+            with self._matching_lock:
+                self.match_index.refresh()
+                user_ids = self._refresh_engine_rows(list(self.match_index.entries))
+                encoded = self.match_engine.subset(user_ids)
+                idf_inputs = self.match_engine.idf_inputs() if self.scorer.uses_idf else (None, None)
+            rows = parallel_match_rows(
+                encoded, self.match_table.k, self.match_table.min_compatibility,
+                workers=workers, shard_size=shard_size, scorer=self.scorer, idf_inputs=idf_inputs
+            )
+        else:
+            rows = []
+            for features in self.load_all_match_features():
+                scores = self._score_all(features, self.match_table.min_compatibility)
+                rows.append((features.user_id, self.match_table.top_k(scores.items())))
+        with self._matching_lock:
+            self.match_table.rebuild(rows)
+    
+    def iter_matches(self, user_id: str, min_compatibility: float = 0.5,
+                     batch_size: int = 64) -> Iterator[tuple[UserProfile, float]]:
+        """
+        Lazily yield (profile, compatibility_score) best first, e.g. to fill the
+        Matches list one page at a time. A match is yielded as soon as no unscored
+        candidate can beat it, so only the first pages' candidates get scored.
+        """
+        user_profile = self.load_profile(user_id)
+        if not user_profile:
+            return
+        
+        candidates = self._match_candidates(user_profile, min_compatibility)
+        pending = []  # Max-heap of (-score, user_id) scored but not yielded yet
+        for scored, next_bound in self._score_candidates(user_profile, candidates, batch_size=batch_size):
+            for other_id, score in scored:
+                if score >= min_compatibility:
+                    heapq.heappush(pending, (-score, other_id))
+            while pending and -pending[0][0] >= next_bound:
+                neg_score, other_id = heapq.heappop(pending)
+                other_profile = self.load_profile(other_id)
+                if other_profile:
+                    yield other_profile, -neg_score
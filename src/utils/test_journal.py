@@ -0,0 +1,43 @@
+import pytest
+
+from journal import RecordJournal
+
+
+def test_append_cuts_a_torn_tail(tmp_path):
+    path = str(tmp_path / 'records.jsonl')
+    writer = RecordJournal(path, version=1)
+    writer.append([{'key': 'a', 'value': 1}])
+    # A writer that died mid-append
+    with open(path, 'ab') as f:
+        f.write(b'{"key":"b","val')
+
+    reader = RecordJournal(path, version=1)
+    assert reader.read() == (False, [{'key': 'a', 'value': 1}])
+
+    RecordJournal(path, version=1).append([{'key': 'c', 'value': 3}])
+    assert reader.read() == (False, [{'key': 'c', 'value': 3}])
+    with open(path, 'rb') as f:
+        assert f.read().endswith(b'{"key":"a","value":1}\n{"key":"c","value":3}\n')
+
+    fresh = RecordJournal(path, version=1)
+    assert fresh.read() == (False, [{'key': 'a', 'value': 1}, {'key': 'c', 'value': 3}])
+    assert fresh.is_current()
+
+
+def test_header_only_tail_is_cut(tmp_path):
+    path = str(tmp_path / 'records.jsonl')
+    with open(path, 'wb') as f:
+        f.write(b'{"_versi')
+    journal = RecordJournal(path, version=2)
+    journal.append([{'key': 'a'}])
+    assert RecordJournal(path, version=2).read() == (False, [{'key': 'a'}])
+    assert journal.file_version == 2
+
+
+def test_corrupt_complete_line_raises(tmp_path):
+    path = str(tmp_path / 'records.jsonl')
+    RecordJournal(path).append([{'key': 'a'}])
+    with open(path, 'ab') as f:
+        f.write(b'not json\n{"key":"b"}\n')
+    with pytest.raises(ValueError, match='Corrupt record'):
+        RecordJournal(path).read()
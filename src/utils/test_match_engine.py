@@ -0,0 +1,69 @@
+import random
+
+import pytest
+
+from user_profile import MusicPreference, UserProfile, UserProfileManager
+
+
+def pairwise_compatibility(profile1, profile2):
+    """The original pair-by-pair 0.4/0.3/0.3 formula the match engine replaced"""
+    artist_scores = [1.0 for a in profile1.top_artists for b in profile2.top_artists if a.lower() == b.lower()]
+    genre_scores = [1.0 for a in profile1.top_genres for b in profile2.top_genres if a.lower() == b.lower()]
+    track_scores = [1.0 - abs(p.rating - q.rating)
+                    for p in profile1.music_preferences for q in profile2.music_preferences
+                    if p.track_id == q.track_id]
+    artist_score = sum(artist_scores) / max(len(profile1.top_artists), len(profile2.top_artists)) if artist_scores else 0
+    genre_score = sum(genre_scores) / max(len(profile1.top_genres), len(profile2.top_genres)) if genre_scores else 0
+    track_score = (sum(track_scores) / max(len(profile1.music_preferences), len(profile2.music_preferences))
+                   if track_scores else 0)
+    return min(max(artist_score * 0.4 + genre_score * 0.3 + track_score * 0.3, 0), 1)
+
+
+def random_profiles(count, seed=1):
+    rng = random.Random(seed)
+    artists = [f"Artist {i}" for i in range(40)] + ["artist 1", "ARTIST 2"]
+    genres = [f"genre {i}" for i in range(15)]
+    tracks = [f"t{i}" for i in range(60)]
+    return [
+        UserProfile(
+            user_id=f"u{i}",
+            username=f"user{i}",
+            music_preferences=[MusicPreference(rng.choice(tracks), 'name', ['a'], 'album', round(rng.random(), 1))
+                               for _ in range(rng.randint(0, 12))],
+            top_artists=[rng.choice(artists) for _ in range(rng.randint(0, 8))],
+            top_genres=[rng.choice(genres) for _ in range(rng.randint(0, 5))],
+            top_songs=[],
+            top_albums=[]
+        ) for i in range(count)
+    ]
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = UserProfileManager(str(tmp_path / 'profiles'), str(tmp_path / 'pictures'))
+    yield manager
+    manager.close()
+
+
+def test_scores_match_pairwise_formula(manager):
+    profiles = random_profiles(120)
+    for profile in profiles:
+        manager.save_profile(profile)
+    for profile in profiles[:15]:
+        for other in profiles:
+            assert manager.calculate_compatibility(profile, other) == pytest.approx(
+                pairwise_compatibility(profile, other), abs=1e-9)
+
+
+def test_find_matches_match_pairwise_formula(manager):
+    profiles = random_profiles(120, seed=2)
+    for profile in profiles:
+        manager.save_profile(profile)
+    for profile in profiles[:15]:
+        expected = {other.user_id: pairwise_compatibility(profile, other) for other in profiles
+                    if other.user_id != profile.user_id}
+        expected = {user_id: score for user_id, score in expected.items() if score >= 0.1}
+        found = {match.user_id: score for match, score in manager.find_matches(profile.user_id, 0.1)}
+        assert found.keys() == expected.keys()
+        for user_id, score in found.items():
+            assert score == pytest.approx(expected[user_id], abs=1e-9)
@@ -0,0 +1,64 @@
+import copy
+import pickle
+
+import pytest
+
+from user_profile import MusicPreference, PreferenceTable
+
+
+def preferences():
+    return [MusicPreference(f"t{i}", f"Track {i}", [f"Artist {a}" for a in range(i % 4)], f"Album {i % 3}", i / 10)
+            for i in range(10)]
+
+
+def test_mutations_match_a_list():
+    expected = preferences()
+    table = PreferenceTable(expected)
+    edits = [
+        lambda prefs: prefs.__setitem__(2, MusicPreference('t2', 'Renamed', ['X', 'Y', 'Z', 'W'], 'New', 0.9)),
+        lambda prefs: prefs.__setitem__(5, MusicPreference('other', 'Other', [], 'Album 1', 0.5)),
+        lambda prefs: prefs.__delitem__(0),
+        lambda prefs: prefs.insert(3, MusicPreference('new', 'New', ['Artist 1', 'Q'], '', 1.0)),
+        lambda prefs: prefs.insert(-1, MusicPreference('late', 'Late', ['R'], 'Album 2', 0.0)),
+        lambda prefs: prefs.append(MusicPreference('last', 'Last', ['Artist 3'], 'Album 0', 0.2)),
+        lambda prefs: prefs.pop(4),
+    ]
+    for edit in edits:
+        edit(expected)
+        edit(table)
+        assert table == expected
+        assert table.to_dicts() == [
+            {'track_id': p.track_id, 'name': p.name, 'artists': list(p.artists), 'album': p.album, 'rating': p.rating}
+            for p in expected
+        ]
+    assert [table.position(p.track_id) for p in expected] == list(range(len(expected)))
+
+
+def test_upsert():
+    table = PreferenceTable(preferences())
+    assert table.upsert(MusicPreference('t4', 'Track 4', ['A', 'B', 'C', 'D', 'E'], 'Album 1', 0.05)) is False
+    assert table.get('t4') == MusicPreference('t4', 'Track 4', ['A', 'B', 'C', 'D', 'E'], 'Album 1', 0.05)
+    assert table[5] == preferences()[5]
+    assert table.upsert(MusicPreference('t10', 'Track 10', ['A'], 'Album 1', 0.5)) is True
+    assert len(table) == 11 and table.position('t10') == 10
+
+
+def test_rows_are_read_only():
+    table = PreferenceTable(preferences())
+    row = table[3]
+    with pytest.raises(AttributeError):
+        row.rating = 0.0
+    with pytest.raises(AttributeError):
+        del row.name
+    editable = copy.copy(row)
+    editable.rating = 0.0
+    assert type(editable) is MusicPreference and table[3].rating == 0.3
+    assert pickle.loads(pickle.dumps(row)) == row
+
+
+def test_copy_is_independent():
+    table = PreferenceTable(preferences())
+    clone = table.copy()
+    clone[0] = MusicPreference('t0', 'Track 0', ['New'], 'Album 0', 1.0)
+    clone.append(MusicPreference('extra', 'Extra', [], '', 0.5))
+    assert table == preferences()
@@ -0,0 +1,58 @@
+from array import array
+import struct
+
+import pytest
+
+import profile_codec
+from user_profile import MusicPreference, UserProfile
+
+
+def sample_profile():
+    return UserProfile(
+        user_id='u1',
+        username='listener',
+        music_preferences=[
+            MusicPreference('t1', 'First', ['Artist A', 'Artist B'], 'Album', 0.1),
+            MusicPreference('t2', 'Second ☃', [], '', 0.3333333333333333),
+            MusicPreference('t3', 'Third', ['Artist A'], 'Album', 1.0),
+        ],
+        top_artists=['Artist A', 'Artist B'],
+        top_genres=['indie'],
+        top_songs=[{'name': 'First', 'id': 't1', 'artists': ['Artist A']}],
+        top_albums=[{'name': 'Album', 'image': None}],
+        bio='hé',
+        age=31
+    )
+
+
+def as_version_1(data: bytes, n_ratings: int) -> bytes:
+    """Rewrite a current encoding in format version 1, which stored ratings as float32"""
+    ratings = array('d')
+    ratings.frombytes(data[len(data) - 8 * n_ratings:])
+    header = bytearray(data[:len(data) - 8 * n_ratings])
+    struct.pack_into('<H', header, 4, 1)
+    return bytes(header) + array('f', ratings).tobytes()
+
+
+def test_round_trip():
+    profile = sample_profile()
+    data = profile.to_dict()
+    assert UserProfile.from_dict(profile_codec.decode(profile_codec.encode(data))).to_dict() == data
+
+
+def test_decodes_version_1():
+    profile = sample_profile()
+    data = profile.to_dict()
+    decoded = profile_codec.decode(as_version_1(profile_codec.encode(data), len(profile.music_preferences)))
+    ratings = decoded['music_preferences'].pop('rating')
+    assert ratings == pytest.approx([p['rating'] for p in data['music_preferences']], abs=1e-7)
+    decoded['music_preferences']['rating'] = [p['rating'] for p in data['music_preferences']]
+    assert UserProfile.from_dict(decoded).to_dict() == data
+
+
+def test_rejects_unencodable_profiles():
+    data = sample_profile().to_dict()
+    with pytest.raises(ValueError):
+        profile_codec.encode(dict(data, bio='a\x00b'))
+    with pytest.raises(ValueError):
+        profile_codec.encode(dict(data, age=2 ** 31))
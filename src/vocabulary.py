@@ -0,0 +1,126 @@
+import json
+import os
+from array import array
+from typing import Dict, Iterable, List, Optional
+from journal import cut_partial_record
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are not coordinated between processes
+    fcntl = None
+
+KINDS = ('artists', 'genres', 'tracks', 'albums')
+
+
+class Vocabulary:
+    """Append-only mapping of entity keys (names or Spotify ids) to dense integer ids.
+
+    Ids are assigned in insertion order and never change, so they can be
+    stored anywhere (match matrices, snapshots, ML models). When a `path` is
+    given, every new key is appended to a JSON-lines file whose line number is
+    the id; appends take an exclusive lock and first read keys added by other
+    processes, so two writers never give one key two ids.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._ids: Dict[str, int] = {}
+        self._keys: List[str] = []
+        self._offset = 0
+        if path:
+            dirname = os.path.dirname(path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self.refresh()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._ids
+
+    def refresh(self):
+        """Load keys appended since the last read"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            self._read(f)
+
+    def _read(self, f):
+        for line in f:
+            if not line.endswith(b'\n'):
+                break  # Partially written key, pick it up next time
+            self._offset += len(line)
+            key = json.loads(line)
+            self._ids[key] = len(self._keys)
+            self._keys.append(key)
+
+    def lookup(self, key: str) -> Optional[int]:
+        """Id of a key, None if it was never added"""
+        return self._ids.get(key)
+
+    def key(self, key_id: int) -> str:
+        return self._keys[key_id]
+
+    def id(self, key: str) -> int:
+        """Id of a key, assigning the next one if it is new"""
+        key_id = self._ids.get(key)
+        if key_id is None:
+            key_id = self._add([key])[0]
+        return key_id
+
+    def ids(self, keys: Iterable[str]) -> array:
+        """Ids of many keys as a compact array('I'), adding new keys in one append"""
+        keys = list(keys)
+        missing = [k for k in dict.fromkeys(keys) if k not in self._ids]
+        if missing:
+            self._add(missing)
+        ids = self._ids
+        return array('I', [ids[k] for k in keys])
+
+    def _add(self, keys: List[str]) -> List[int]:
+        if not self.path:
+            for key in keys:
+                self._ids[key] = len(self._keys)
+                self._keys.append(key)
+            return [self._ids[k] for k in keys]
+        with open(self.path, 'ab+') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                # Another process may have added some of these keys meanwhile
+                f.seek(self._offset)
+                self._read(f)
+                new_keys = [k for k in keys if k not in self._ids]
+                if new_keys:
+                    # Drop a key left half-written by a crashed writer, or ours would be glued onto it
+                    cut_partial_record(f)
+                    data = b''.join((json.dumps(k) + '\n').encode() for k in new_keys)
+                    f.write(data)
+                    f.flush()
+                    for key in new_keys:
+                        self._ids[key] = len(self._keys)
+                        self._keys.append(key)
+                    self._offset += len(data)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        return [self._ids[k] for k in keys]
+
+
+class Vocabularies:
+    """One Vocabulary per entity kind: artists, genres, tracks and albums"""
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory
+        for kind in KINDS:
+            path = os.path.join(directory, f'{kind}.jsonl') if directory else None
+            setattr(self, kind, Vocabulary(path))
+
+    def __getitem__(self, kind: str) -> Vocabulary:
+        return getattr(self, kind)
+
+    def refresh(self):
+        for kind in KINDS:
+            self[kind].refresh()